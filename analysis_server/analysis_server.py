@@ -4,23 +4,70 @@
 import os
 import time
 import json
+import csv
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import google.generativeai as genai
-from typing import Dict, Any
+from cachetools import TTLCache
+from typing import Awaitable, Callable, Dict, Any, Tuple
 import PyPDF2
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from datetime import datetime, date
 from pydantic import BaseModel
 import uvicorn
 import os
+import numpy as np
+from collections import Counter
 from dotenv import load_dotenv
+import risk_scoring
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
+# Generated risk narratives are reused for NARRATIVE_CACHE_TTL seconds, up to
+# NARRATIVE_CACHE_MAX_BYTES of narrative text
+NARRATIVE_CACHE_TTL = float(os.getenv("NARRATIVE_CACHE_TTL", 3600))
+NARRATIVE_CACHE_MAX_BYTES = int(os.getenv("NARRATIVE_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+
+# Gemini calls run on a dedicated pool, at most GEMINI_MAX_CONCURRENCY at a
+# time. A call waits at most GEMINI_QUEUE_TIMEOUT seconds for a slot (the
+# request is then rejected with 503) and GEMINI_TIMEOUT seconds for the model.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 8))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", 10))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 30))
+
+# Bulk scoring works through uploads BULK_CHUNK_ROWS drivers at a time, with
+# at most BULK_NARRATIVE_CONCURRENCY Gemini narratives generated at once
+BULK_CHUNK_ROWS = int(os.getenv("BULK_CHUNK_ROWS", 5000))
+BULK_NARRATIVE_CONCURRENCY = int(os.getenv("BULK_NARRATIVE_CONCURRENCY", 4))
+
+# The risk analyzer and the Gemini gateway are created once per server
+# process and shared by all requests; the warm-up runs in the background so
+# startup is not blocked
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.gemini_gateway = GeminiGateway(GEMINI_MAX_CONCURRENCY, GEMINI_QUEUE_TIMEOUT, GEMINI_TIMEOUT)
+    app.state.risk_analyzer = SimplifiedRiskAnalyzer(
+        GEMINI_API_KEY, NarrativeCache(ttl=NARRATIVE_CACHE_TTL, max_bytes=NARRATIVE_CACHE_MAX_BYTES),
+        request_timeout=GEMINI_TIMEOUT
+    )
+    if chatbot:
+        chatbot.request_timeout = GEMINI_TIMEOUT
+    warm_up = asyncio.create_task(run_in_threadpool(app.state.risk_analyzer.warm_up))
+    yield
+    warm_up.cancel()
+    app.state.gemini_gateway.shutdown()
+
 # Create FastAPI app
 app = FastAPI(title="SafeDrive Chatbot API", 
-              description="API for the SafeDrive Admin Assistant chatbot")
+              description="API for the SafeDrive Admin Assistant chatbot",
+              lifespan=lifespan)
 
 # Add CORS middleware to allow cross-origin requests from frontend
 app.add_middleware(
@@ -31,13 +78,292 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class GeminiBusyError(Exception):
+    """No Gemini call slot became free within the queue timeout"""
+
+class GeminiTimeoutError(Exception):
+    """A Gemini call did not finish within its deadline"""
+
+class GeminiGateway:
+    """
+    Runs blocking Gemini SDK work off the event loop.
+
+    Calls go to a dedicated thread pool through a semaphore, so at most
+    `max_concurrency` run at once however many requests are waiting, and
+    the event loop (and /health) stays responsive while the model is slow.
+    A call waits at most `queue_timeout` seconds for a slot and then has
+    `timeout` seconds to finish. The callers also pass `timeout` to the SDK
+    as its request deadline, so a timed-out call's thread is freed too;
+    the gateway deadline adds a small grace period on top of it. A slot is
+    only released once its pool thread is done, also after a timeout, so
+    in_flight and the semaphore always match the busy threads and a queued
+    call never waits unmeasured inside the pool.
+    """
+
+    def __init__(self, max_concurrency: int = 8, queue_timeout: float = 10.0, timeout: float = 30.0,
+                 history_size: int = 1000):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        # Recent queue waits and call latencies in seconds
+        self._queue_waits = deque(maxlen=history_size)
+        self._latencies = deque(maxlen=history_size)
+        # Time from the start of a streaming call to its first item
+        self._first_items = deque(maxlen=history_size)
+
+    async def run(self, fn, *args):
+        """
+        Run fn(*args) on the Gemini pool
+
+        :raises GeminiBusyError: If no slot became free within queue_timeout
+        :raises GeminiTimeoutError: If the call took longer than timeout
+        """
+        called = await self._acquire()
+        try:
+            result = await asyncio.wait_for(self._submit(called, fn, *args), self.timeout + 1.0)
+            self.completed += 1
+            return result
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise GeminiTimeoutError(f"Gemini call timed out after {self.timeout:g}s")
+        except Exception:
+            self.errors += 1
+            raise
+
+    async def stream(self, fn, *args):
+        """
+        Run the generator function fn(*args) on the Gemini pool and yield
+        its items as they are produced. Each item, the first included, must
+        arrive within timeout. Closing this generator (e.g. when the client
+        disconnects) stops and closes fn's generator after its next item.
+
+        :raises GeminiBusyError: If no slot became free within queue_timeout
+        :raises GeminiTimeoutError: If an item took longer than timeout
+        """
+        called = await self._acquire()
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stop = threading.Event()
+        end = object()
+
+        def put(item, error=None):
+            try:
+                loop.call_soon_threadsafe(items.put_nowait, (item, error))
+            except RuntimeError:
+                # Event loop already closed
+                pass
+
+        def pump():
+            generator = fn(*args)
+            try:
+                for item in generator:
+                    put(item)
+                    if stop.is_set():
+                        break
+            except Exception as e:
+                put(end, e)
+            else:
+                put(end)
+            finally:
+                generator.close()
+
+        self._submit(called, pump)
+        first = True
+        try:
+            while True:
+                try:
+                    item, error = await asyncio.wait_for(items.get(), self.timeout + 1.0)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    raise GeminiTimeoutError(f"No Gemini output for {self.timeout:g}s")
+                if item is end:
+                    if error is not None:
+                        self.errors += 1
+                        raise error
+                    self.completed += 1
+                    return
+                if first:
+                    self._first_items.append(time.perf_counter() - called)
+                    first = False
+                yield item
+        finally:
+            stop.set()
+
+    async def _acquire(self) -> float:
+        """Wait for a call slot; returns when the call started"""
+        started = time.perf_counter()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise GeminiBusyError(f"All {self.max_concurrency} Gemini call slots busy for {self.queue_timeout:g}s")
+        finally:
+            self.queued -= 1
+
+        called = time.perf_counter()
+        self._queue_waits.append(called - started)
+        self.in_flight += 1
+        return called
+
+    def _submit(self, called: float, fn, *args) -> asyncio.Future:
+        """
+        Start fn(*args) on the pool under the slot acquired at `called`. The
+        slot is released when the thread finishes, not when the caller stops
+        waiting: cancelling the returned future cannot stop a running thread.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._release(called)
+            raise
+
+        def done(_):
+            try:
+                loop.call_soon_threadsafe(self._release, called)
+            except RuntimeError:
+                # Event loop already closed
+                pass
+
+        future.add_done_callback(done)
+        return asyncio.wrap_future(future)
+
+    def _release(self, called: float):
+        self._latencies.append(time.perf_counter() - called)
+        self.in_flight -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _percentiles(samples):
+        if not samples:
+            return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+        p50, p95, p99 = np.percentile(np.asarray(samples) * 1000, [50, 95, 99])
+        return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "queue_wait": self._percentiles(self._queue_waits),
+            "latency": self._percentiles(self._latencies),
+            "stream_first_chunk": self._percentiles(self._first_items),
+        }
+
+class NarrativeCache:
+    """
+    LRU + TTL cache for generated narratives, bounded by the total size of
+    the cached text.
+
+    Concurrent lookups of a key that is not cached yet share one generation
+    task, so N identical requests make one Gemini call and take one gateway
+    slot. A caller that goes away stops waiting without cancelling the
+    generation, unless it was the last one waiting. Failed generations are
+    not cached. Used from the event loop only.
+    """
+
+    def __init__(self, ttl: float = 3600, max_bytes: int = 8 * 1024 * 1024):
+        self._cache = TTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=lambda text: len(text.encode("utf-8")))
+        # key -> [generation task, number of callers waiting for it]
+        self._in_flight: Dict[Tuple, list] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key: Tuple, generate: Callable[[], Awaitable[str]]) -> str:
+        """
+        Cached narrative for `key`, awaiting `generate()` on a miss
+
+        :param key: Hashable, normalized inputs of the narrative
+        :param generate: Produces the narrative; exceptions propagate to
+                         every caller waiting on the same key
+        """
+        text = self._cache.get(key)
+        if text is not None:
+            self.hits += 1
+            return text
+        entry = self._in_flight.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._in_flight[key] = [asyncio.ensure_future(self._generate(key, generate)), 0]
+        else:
+            self.coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not task.done():
+                task.cancel()
+
+    async def _generate(self, key: Tuple, generate: Callable[[], Awaitable[str]]) -> str:
+        try:
+            text = await generate()
+        finally:
+            del self._in_flight[key]
+        try:
+            self._cache[key] = text
+        except ValueError:
+            # Larger than the whole cache
+            pass
+        return text
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._cache),
+            "bytes": self._cache.currsize,
+            "max_bytes": self._cache.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "in_flight": len(self._in_flight),
+        }
+
 class SimplifiedRiskAnalyzer:
-    def __init__(self, api_key: str):
+    """
+    Risk scoring plus Gemini narratives, meant to be created once and shared.
+
+    genai.configure() drops the library's cached API clients, so configuring
+    per request would open a new gRPC channel (TLS handshake included) for
+    every analysis. One instance keeps one GenerativeModel, whose client and
+    channel are reused by every call. analyze_risk runs on the event loop:
+    scoring and narrative cache hits never wait for Gemini, and only the
+    generate_content call of a cache miss goes through the GeminiGateway.
+    """
+
+    def __init__(self, api_key: str, narrative_cache: "NarrativeCache" = None, request_timeout: float = None):
         """
         Initialize Gemini API client with provided API key
         
         :param api_key: Your Google AI Studio API key
+        :param narrative_cache: Cache for generated narratives (default: a
+                                new one with default limits)
+        :param request_timeout: Deadline in seconds for each Gemini request
         """
+        self.narrative_cache = narrative_cache or NarrativeCache()
+        self.request_options = {"timeout": request_timeout} if request_timeout else None
+        self.ready = False
+        self.warm_up_seconds = None
         try:
             # Configure the Gemini API with the provided key
             genai.configure(api_key=api_key)
@@ -49,6 +375,23 @@ class SimplifiedRiskAnalyzer:
             print(f"API Configuration Error: {e}")
             self.model = None
 
+    def warm_up(self):
+        """
+        Open the model's API channel with a token count request, which is
+        cheap and generates nothing, so the first analysis does not pay for
+        connection setup
+        """
+        if not self.model:
+            return
+        started = time.perf_counter()
+        try:
+            self.model.count_tokens("warm-up", request_options=self.request_options)
+            self.ready = True
+            self.warm_up_seconds = time.perf_counter() - started
+            print(f"Risk analyzer warm after {self.warm_up_seconds:.2f}s")
+        except Exception as e:
+            print(f"Risk analyzer warm-up failed: {e}")
+
     def calculate_age(self, birth_date: str) -> int:
         """
         Calculate age based on birth date
@@ -69,11 +412,12 @@ class SimplifiedRiskAnalyzer:
         except Exception:
             return None
 
-    def analyze_risk(self, driver_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def analyze_risk(self, driver_data: Dict[str, Any], gemini_gateway: GeminiGateway) -> Dict[str, Any]:
         """
         Simplified risk analysis using binary risk factors
         
         :param driver_data: Driver and vehicle information with binary risk factors
+        :param gemini_gateway: Runs the Gemini call of an uncached narrative
         :return: Detailed risk analysis
         """
         # Calculate driver's age
@@ -105,7 +449,7 @@ class SimplifiedRiskAnalyzer:
         risk_score = self._calculate_risk_score(risk_profile)
         
         # Generate Gemini-powered risk reasoning
-        risk_reasoning = self._generate_gemini_reasoning(risk_profile)
+        risk_reasoning = await self.generate_gemini_reasoning(risk_profile, gemini_gateway)
         
         # Determine insurance recommendation
         insurance_recommendation = self._generate_insurance_recommendation(risk_score, risk_profile)
@@ -250,36 +594,81 @@ class SimplifiedRiskAnalyzer:
         risk_level = self._classify_risk_level(risk_score)
         return recommendations.get(risk_level, recommendations['MODERATE RISK'])
 
-    def _generate_gemini_reasoning(self, risk_profile: Dict[str, Any]) -> str:
+    # Placeholders the cached narratives use for the per-driver details
+    DRIVER_NAME_PLACEHOLDER = "[DRIVER_NAME]"
+    VEHICLE_NUMBER_PLACEHOLDER = "[VEHICLE_NUMBER]"
+
+    @staticmethod
+    def _age_group(age: int) -> str:
+        # Same bands as _calculate_age_risk
+        if age is None:
+            return "unknown"
+        if age < 25:
+            return "under 25"
+        if age > 65:
+            return "over 65"
+        return "25 to 65"
+
+    @staticmethod
+    def _normalize(value) -> str:
+        return " ".join(str(value).lower().split())
+
+    def _narrative_key(self, risk_profile: Dict[str, Any]) -> Tuple:
+        """The inputs a narrative depends on, without the per-driver details"""
+        return (
+            self._age_group(risk_profile['personal_details']['age']),
+            self._normalize(risk_profile['personal_details']['gender']),
+            int(risk_profile['risk_factors']['drowsiness'] == 1),
+            int(risk_profile['risk_factors']['overspeeding'] == 1),
+            self._normalize(risk_profile['vehicle_details']['vehicle_model']),
+            self._normalize(risk_profile['vehicle_details']['model_name']),
+        )
+
+    async def generate_gemini_reasoning(self, risk_profile: Dict[str, Any], gemini_gateway: GeminiGateway) -> str:
         """
         Generate AI-powered risk reasoning
         
+        Narratives are generated for the normalized profile (age group,
+        gender, risk flags and vehicle model) with placeholders for the
+        driver name and vehicle number, cached, and personalized afterwards.
+        
         :param risk_profile: Comprehensive risk profile
+        :param gemini_gateway: Runs the Gemini call on a cache miss
         :return: Detailed reasoning narrative
         """
         if not self.model:
             return "API not configured. Unable to generate reasoning."
         
-        # Extract risk factors for clearer prompt
-        drowsiness = "Yes" if risk_profile['risk_factors']['drowsiness'] == 1 else "No"
-        overspeeding = "Yes" if risk_profile['risk_factors']['overspeeding'] == 1 else "No"
+        key = self._narrative_key(risk_profile)
+        try:
+            narrative = await self.narrative_cache.get(key, lambda: gemini_gateway.run(self._request_reasoning, key))
+        except Exception as e:
+            return f"Reasoning Generation Error: {str(e)}"
+        
+        return (narrative
+                .replace(self.DRIVER_NAME_PLACEHOLDER, str(risk_profile['personal_details']['name']))
+                .replace(self.VEHICLE_NUMBER_PLACEHOLDER, str(risk_profile['vehicle_details']['vehicle_number'])))
+
+    def _request_reasoning(self, key: Tuple) -> str:
+        """Ask Gemini for the narrative of a normalized profile"""
+        age_group, gender, drowsiness, overspeeding, vehicle_model, model_name = key
         
         # Construct detailed prompt for Gemini
         prompt = f"""Provide a comprehensive risk analysis for the following driver and vehicle:
 
         Driver Profile:
-        - Name: {risk_profile['personal_details']['name']}
-        - Age: {risk_profile['personal_details']['age']} years
-        - Gender: {risk_profile['personal_details']['gender']}
+        - Name: {self.DRIVER_NAME_PLACEHOLDER}
+        - Age group: {age_group}
+        - Gender: {gender}
 
         Vehicle Information:
-        - Vehicle Number: {risk_profile['vehicle_details']['vehicle_number']}
-        - Vehicle Model: {risk_profile['vehicle_details']['vehicle_model']}
-        - Model Name: {risk_profile['vehicle_details']['model_name']}
+        - Vehicle Number: {self.VEHICLE_NUMBER_PLACEHOLDER}
+        - Vehicle Model: {vehicle_model}
+        - Model Name: {model_name}
 
         Risk Factors:
-        - Drowsiness Detected: {drowsiness}
-        - Overspeeding Detected: {overspeeding}
+        - Drowsiness Detected: {"Yes" if drowsiness else "No"}
+        - Overspeeding Detected: {"Yes" if overspeeding else "No"}
 
         Provide a concise small accurate analysis that includes:
         1. Comprehensive risk assessment
@@ -287,15 +676,15 @@ class SimplifiedRiskAnalyzer:
         3. Recommendations for risk mitigation
         4. Detailed reasoning behind risk factors
 
+        Refer to the driver as {self.DRIVER_NAME_PLACEHOLDER} and to the vehicle number as
+        {self.VEHICLE_NUMBER_PLACEHOLDER}, exactly as written.
+
         Ensure the analysis is professional, data-driven, and actionable.
         """
         
-        try:
-            # Generate reasoning using Gemini
-            response = self.model.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            return f"Reasoning Generation Error: {str(e)}"
+        # Generate reasoning using Gemini
+        response = self.model.generate_content(prompt, request_options=self.request_options)
+        return response.text
 
 class AnalysisRequest(BaseModel):
     driver_data: Dict[str, Any]
@@ -343,6 +732,7 @@ class InsuranceProviderChatbot:
         self.model = model
         self.system_documentation = system_documentation
         self.conversations = {}  # Store conversations by ID
+        self.request_timeout = None  # Deadline in seconds for each Gemini request
         self.init_system_prompt()
         
     def init_system_prompt(self):
@@ -405,13 +795,11 @@ class InsuranceProviderChatbot:
         self.conversations[new_id] = []
         return new_id, self.conversations[new_id]
         
-    def process_query(self, query, conversation_id=None, use_documentation=True):
-        # Get or create conversation history
-        conv_id, conversation_history = self.get_or_create_conversation(conversation_id)
-        
-        # Add the user query to conversation history
-        conversation_history.append({"role": "user", "content": query})
-        
+    def request_options(self):
+        return {"timeout": self.request_timeout} if self.request_timeout else None
+
+    def build_prompt(self, conversation_history, query, use_documentation=True):
+        """Prompt parts for a query; conversation_history already ends with the query"""
         # Prepare the prompt with system instructions and conversation history
         prompt_parts = [self.system_prompt]
         
@@ -428,20 +816,74 @@ class InsuranceProviderChatbot:
             prompt_parts.append(context_query)
         else:
             prompt_parts.append(f"QUERY: {query}")
+        return prompt_parts
+
+    def stream_query(self, conv_id, query, use_documentation=True):
+        """
+        Generate the response to a query chunk by chunk (a blocking
+        generator of text chunks). The query and the full response are
+        added to the conversation history once the stream ends, also when
+        it fails or the client goes away, so a conversation never holds a
+        question without its answer.
+        """
+        _, conversation_history = self.get_or_create_conversation(conv_id)
+        turn = conversation_history + [{"role": "user", "content": query}]
+        prompt_parts = self.build_prompt(turn, query, use_documentation)
+        
+        chunks = []
+        try:
+            response = self.model.generate_content(prompt_parts, stream=True,
+                                                   request_options=self.request_options())
+            for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunk without text, e.g. only a finish reason
+                    continue
+                chunks.append(text)
+                yield text
+        except Exception as e:
+            chunks.append(("\n\n" if chunks else "") + f"Error generating response: {str(e)}")
+            raise
+        finally:
+            conversation_history.append({"role": "user", "content": query})
+            conversation_history.append({"role": "assistant", "content": "".join(chunks)})
+
+    def _request_response(self, prompt_parts):
+        """Ask Gemini for the response to a prompt (blocking)"""
+        response = self.model.generate_content(prompt_parts, request_options=self.request_options())
+        return response.text
+
+    async def process_query(self, query, gemini_gateway: GeminiGateway, conversation_id=None,
+                            use_documentation=True):
+        """
+        Answer a query. Only the Gemini call runs on the gateway; a busy or
+        timed-out gateway is recorded in the conversation and re-raised.
+        """
+        # Get or create conversation history
+        conv_id, conversation_history = self.get_or_create_conversation(conversation_id)
+        
+        # Add the user query to conversation history
+        conversation_history.append({"role": "user", "content": query})
+        
+        prompt_parts = self.build_prompt(conversation_history, query, use_documentation)
             
         # Generate response using Gemini
         try:
-            response = self.model.generate_content(prompt_parts)
-            response_text = response.text
-            
-            # Add the response to conversation history
-            conversation_history.append({"role": "assistant", "content": response_text})
-            
-            return conv_id, response_text
+            response_text = await gemini_gateway.run(self._request_response, prompt_parts)
+        except (GeminiBusyError, GeminiTimeoutError) as e:
+            conversation_history.append({"role": "assistant",
+                                         "content": f"Error generating response: {str(e)}"})
+            raise
         except Exception as e:
             error_message = f"Error generating response: {str(e)}"
             conversation_history.append({"role": "assistant", "content": error_message})
             return conv_id, error_message
+            
+        # Add the response to conversation history
+        conversation_history.append({"role": "assistant", "content": response_text})
+        
+        return conv_id, response_text
 
 # Initialize the chatbot
 try:  # In production, use env variables
@@ -464,8 +906,12 @@ except Exception as e:
     chatbot = None
 
 # FastAPI routes
+def get_gemini_gateway(request: Request) -> GeminiGateway:
+    return request.app.state.gemini_gateway
+
 @app.post("/chatbot", response_model=ChatbotResponse)
-async def process_chat_message(request: ChatbotRequest = Body(...)):
+async def process_chat_message(request: ChatbotRequest = Body(...),
+                               gemini_gateway: GeminiGateway = Depends(get_gemini_gateway)):
     print("Request: ", request)
     if not chatbot:
         raise HTTPException(status_code=500, detail="Chatbot not initialized properly")
@@ -473,11 +919,15 @@ async def process_chat_message(request: ChatbotRequest = Body(...)):
     if not request.message or request.message.strip() == "":
         raise HTTPException(status_code=400, detail="Message cannot be empty")
     
-    # Process the message
-    conversation_id, response = chatbot.process_query(
-        query=request.message,
-        conversation_id=request.conversation_id
-    )
+    # Only the Gemini call itself goes to the Gemini pool
+    try:
+        conversation_id, response = await chatbot.process_query(
+            request.message, gemini_gateway, request.conversation_id
+        )
+    except GeminiBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except GeminiTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     
     # Return the response
     return ChatbotResponse(
@@ -485,17 +935,68 @@ async def process_chat_message(request: ChatbotRequest = Body(...)):
         conversation_id=conversation_id
     )
 
+# Format one server-sent event
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/chatbot/stream")
+async def stream_chat_message(request: ChatbotRequest = Body(...),
+                              gemini_gateway: GeminiGateway = Depends(get_gemini_gateway)):
+    """
+    Streaming variant of /chatbot using server-sent events: "start" with the
+    conversation id, a "chunk" with the text of each piece of model output
+    as it arrives, then "done" with the time to the first chunk and the
+    total time, or "error".
+    """
+    if not chatbot:
+        raise HTTPException(status_code=500, detail="Chatbot not initialized properly")
+    
+    if not request.message or request.message.strip() == "":
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+
+    received = time.perf_counter()
+    conversation_id, _ = chatbot.get_or_create_conversation(request.conversation_id)
+
+    async def events():
+        yield sse_event("start", {"conversation_id": conversation_id})
+        first_chunk_ms = None
+        characters = 0
+        try:
+            async for text in gemini_gateway.stream(chatbot.stream_query, conversation_id, request.message):
+                if first_chunk_ms is None:
+                    first_chunk_ms = (time.perf_counter() - received) * 1000
+                characters += len(text)
+                yield sse_event("chunk", {"text": text})
+        except (GeminiBusyError, GeminiTimeoutError) as e:
+            yield sse_event("error", {"message": str(e)})
+            return
+        except Exception as e:
+            yield sse_event("error", {"message": f"Error generating response: {str(e)}"})
+            return
+
+        total_ms = (time.perf_counter() - received) * 1000
+        print(f"Chat stream {conversation_id}: first chunk after {first_chunk_ms or 0:.0f}ms, "
+              f"{characters} characters in {total_ms:.0f}ms")
+        yield sse_event("done", {"conversation_id": conversation_id, "first_chunk_ms": first_chunk_ms,
+                                 "total_ms": total_ms, "characters": characters})
+
+    # No-cache and no proxy buffering, so chunks reach the client as they are sent
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def get_risk_analyzer(request: Request) -> SimplifiedRiskAnalyzer:
+    return request.app.state.risk_analyzer
+
 @app.post("/analyze-risk", response_model=AnalysisResponse)
-async def analyze_claims(request: AnalysisRequest = Body(...)):
+async def analyze_claims(request: AnalysisRequest = Body(...),
+                         risk_analyzer: SimplifiedRiskAnalyzer = Depends(get_risk_analyzer),
+                         gemini_gateway: GeminiGateway = Depends(get_gemini_gateway)):
     # Sample driver data with simplified binary risk factors
     driver_data = request.driver_data
     
     try:
-        # Replace with your actual API key
-        risk_analyzer = SimplifiedRiskAnalyzer(GEMINI_API_KEY)
-        
-        # Perform risk analysis
-        analysis_result = risk_analyzer.analyze_risk(driver_data)
+        # Only an uncached narrative's Gemini call goes to the Gemini pool
+        analysis_result = await risk_analyzer.analyze_risk(driver_data, gemini_gateway)
         
         # Print results
         print(json.dumps(analysis_result, indent=2))
@@ -510,13 +1011,149 @@ async def analyze_claims(request: AnalysisRequest = Body(...)):
         print(f"Analysis failed: {e}")
         return AnalysisResponse(
             status="error",
-            message=e,
+            message=str(e),
             data={}  # Empty data for error case
         )
 
+# Split a streamed request body into lines (bytes; decoding is up to the
+# caller, so one bad line does not end the stream)
+async def body_lines(request: Request):
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+class UploadStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse for a body generator that reads the request body
+    itself. Starlette's disconnect listener would take the body messages
+    away from request.stream(), so it only starts listening once
+    `body_read` is set; until then a disconnect surfaces as ClientDisconnect
+    in request.stream().
+    """
+    def __init__(self, content, body_read: asyncio.Event, **kwargs):
+        super().__init__(content, **kwargs)
+        self.body_read = body_read
+
+    async def listen_for_disconnect(self, receive) -> None:
+        await self.body_read.wait()
+        await super().listen_for_disconnect(receive)
+
+# Score one chunk of normalized records; returns its columns and result records
+def score_chunk(row_numbers, normalized):
+    columns = risk_scoring.to_columns(normalized)
+    scores = risk_scoring.score(columns)
+    return columns, risk_scoring.result_rows(columns, scores, row_numbers)
+
+@app.post("/analyze-risk/bulk")
+async def analyze_risk_bulk(request: Request, format: str = None, narratives: bool = False,
+                            risk_analyzer: SimplifiedRiskAnalyzer = Depends(get_risk_analyzer),
+                            gemini_gateway: GeminiGateway = Depends(get_gemini_gateway)):
+    """
+    Score a whole portfolio of drivers. The body is JSON Lines (one
+    driver_data object per line) or CSV with a header row of driver_data
+    field names; pass format=jsonl|csv or set the Content-Type. Results are
+    streamed back as newline-delimited JSON while the upload is read:
+    one "result" per driver, an "error" for each unreadable row and a final
+    "summary". Scores are computed with NumPy over chunks of rows. With
+    narratives=true every result also carries gemini_insights; results of a
+    chunk are then sent as their narratives complete.
+    """
+    format = format or ("csv" if "csv" in request.headers.get("content-type", "") else "jsonl")
+    if format not in ("jsonl", "csv"):
+        raise HTTPException(status_code=400, detail="format must be jsonl or csv")
+    narrative_slots = asyncio.Semaphore(BULK_NARRATIVE_CONCURRENCY)
+
+    async def with_narrative(result, columns, i):
+        risk_profile = {
+            'personal_details': {'name': result['driver_name'], 'age': result['age'],
+                                 'gender': columns['gender'][i]},
+            'vehicle_details': {'vehicle_number': result['vehicle_number'],
+                                'vehicle_model': columns['vehicle_model'][i],
+                                'model_name': columns['model_name'][i]},
+            'risk_factors': {'drowsiness': columns['drowsiness_state'][i],
+                             'overspeeding': columns['overspeeding'][i]}
+        }
+        async with narrative_slots:
+            result['gemini_insights'] = await risk_analyzer.generate_gemini_reasoning(risk_profile, gemini_gateway)
+        return result
+
+    async def process(row_numbers, normalized):
+        columns, results = await run_in_threadpool(score_chunk, row_numbers, normalized)
+        for result in results:
+            levels[result['risk_level']] += 1
+        if not narratives:
+            yield "".join(json.dumps(result) + "\n" for result in results)
+            return
+        tasks = [asyncio.ensure_future(with_narrative(result, columns, i)) for i, result in enumerate(results)]
+        try:
+            for done in asyncio.as_completed(tasks):
+                yield json.dumps(await done) + "\n"
+        finally:
+            # The client went away or a narrative failed: stop the rest
+            for task in tasks:
+                task.cancel()
+
+    levels = Counter()
+    body_read = asyncio.Event()
+
+    async def stream():
+        started = time.perf_counter()
+        header = None
+        row = errors = 0
+        row_numbers, normalized = [], []
+        async for line in body_lines(request):
+            if not line.strip():
+                continue
+            try:
+                # UnicodeDecodeError is a ValueError
+                line = line.decode("utf-8")
+                if format == "csv" and header is None:
+                    header = [name.strip() for name in next(csv.reader([line]))]
+                    continue
+                record = (risk_scoring.parse_csv_line(line, header) if format == "csv"
+                          else risk_scoring.parse_jsonl_line(line))
+                normalized.append(risk_scoring.normalize_record(record))
+                row_numbers.append(row)
+            except (ValueError, TypeError) as e:
+                errors += 1
+                yield json.dumps({"type": "error", "row": row, "message": str(e)}) + "\n"
+            row += 1
+            if len(normalized) >= BULK_CHUNK_ROWS:
+                async for output in process(row_numbers, normalized):
+                    yield output
+                row_numbers, normalized = [], []
+        body_read.set()
+        if normalized:
+            async for output in process(row_numbers, normalized):
+                yield output
+
+        elapsed = time.perf_counter() - started
+        scored = sum(levels.values())
+        yield json.dumps({"type": "summary", "rows": row, "scored": scored, "errors": errors,
+                          "risk_levels": dict(levels), "elapsed_s": elapsed,
+                          "rows_per_second": scored / elapsed if elapsed else 0}) + "\n"
+
+    return UploadStreamingResponse(stream(), body_read, media_type="application/x-ndjson")
+
 @app.get("/health")
-async def health_check():
-    return {"status": "healthy", "chatbot_initialized": chatbot is not None}
+async def health_check(risk_analyzer: SimplifiedRiskAnalyzer = Depends(get_risk_analyzer),
+                       gemini_gateway: GeminiGateway = Depends(get_gemini_gateway)):
+    return {
+        "status": "healthy",
+        "chatbot_initialized": chatbot is not None,
+        "risk_analyzer": {
+            "configured": risk_analyzer.model is not None,
+            "warm": risk_analyzer.ready,
+            "warm_up_seconds": risk_analyzer.warm_up_seconds,
+            "narrative_cache": risk_analyzer.narrative_cache.stats()
+        },
+        "gemini": gemini_gateway.stats()
+    }
 
 # Run the server if executed directly
 if __name__ == "__main__":
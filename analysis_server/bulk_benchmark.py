@@ -0,0 +1,141 @@
+"""
+Rows-per-second benchmark for bulk risk scoring.
+
+Generates a synthetic portfolio and scores it either in-process with the
+vectorized risk_scoring module (compared against the per-driver
+SimplifiedRiskAnalyzer path when the Gemini SDK is importable), or through a
+running server's /analyze-risk/bulk endpoint.
+
+    python bulk_benchmark.py inprocess --rows 100000
+    python bulk_benchmark.py http --rows 50000 --format csv --url http://localhost:8002/analyze-risk/bulk
+"""
+import argparse
+import csv
+import io
+import json
+import time
+import urllib.request
+
+import numpy as np
+
+import risk_scoring
+
+MODELS = [("Maruti", "Swift"), ("Hyundai", "Creta"), ("Tata", "Nexon"), ("Honda", "City"), ("Mahindra", "XUV700")]
+
+
+def generate_records(rows: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    birth_days = rng.integers(np.datetime64("1940-01-01").astype(int), np.datetime64("2006-12-31").astype(int), rows)
+    records = []
+    for i in range(rows):
+        make, model = MODELS[i % len(MODELS)]
+        records.append({
+            "driver_name": f"Driver {i}",
+            "birth_date": str(np.datetime64(int(birth_days[i]), "D")),
+            "gender": "Male" if rng.random() < 0.6 else "Female",
+            "vehicle_number": f"KA{i % 100:02d}AB{i % 10000:04d}",
+            "vehicle_model": make,
+            "model_name": model,
+            "drowsiness_state": int(rng.random() < 0.2),
+            "overspeeding": int(rng.random() < 0.3),
+        })
+    return records
+
+
+def encode(records, format: str) -> bytes:
+    if format == "jsonl":
+        return "".join(json.dumps(record) + "\n" for record in records).encode()
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=list(records[0]))
+    writer.writeheader()
+    writer.writerows(records)
+    return out.getvalue().encode()
+
+
+# Parse, score and serialize the way the endpoint does, without the server
+def run_vectorized(body: bytes, format: str, chunk_rows: int):
+    started = time.perf_counter()
+    lines = body.decode().splitlines()
+    header = next(csv.reader([lines.pop(0)])) if format == "csv" else None
+    levels = []
+    for start in range(0, len(lines), chunk_rows):
+        normalized = [risk_scoring.normalize_record(risk_scoring.parse_csv_line(line, header) if header
+                                                    else risk_scoring.parse_jsonl_line(line))
+                      for line in lines[start:start + chunk_rows]]
+        columns = risk_scoring.to_columns(normalized)
+        results = risk_scoring.result_rows(columns, risk_scoring.score(columns),
+                                           list(range(start, start + len(normalized))))
+        "".join(json.dumps(result) + "\n" for result in results)
+        levels.extend(result["risk_level"] for result in results)
+    return time.perf_counter() - started, levels
+
+
+# The single-driver analyze_risk path minus the narrative, once per record
+def run_per_driver(records):
+    from analysis_server import SimplifiedRiskAnalyzer
+
+    analyzer = SimplifiedRiskAnalyzer(None)
+    started = time.perf_counter()
+    levels = []
+    for record in records:
+        profile = {
+            "personal_details": {"age": analyzer.calculate_age(record["birth_date"]), "gender": record["gender"]},
+            "risk_factors": {"drowsiness": record["drowsiness_state"], "overspeeding": record["overspeeding"]},
+        }
+        risk_score = analyzer._calculate_risk_score(profile)
+        analyzer._generate_insurance_recommendation(risk_score, profile)
+        levels.append(analyzer._classify_risk_level(risk_score))
+    return time.perf_counter() - started, levels
+
+
+def run_http(body: bytes, format: str, url: str):
+    content_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    request = urllib.request.Request(f"{url}?format={format}", data=body, method="POST",
+                                     headers={"Content-Type": content_type})
+    started = time.perf_counter()
+    first_result = None
+    summary = None
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            message = json.loads(line)
+            if first_result is None and message["type"] == "result":
+                first_result = time.perf_counter() - started
+            if message["type"] == "summary":
+                summary = message
+    return time.perf_counter() - started, first_result, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bulk risk scoring")
+    parser.add_argument("mode", choices=["inprocess", "http"])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--chunk-rows", type=int, default=5000)
+    parser.add_argument("--url", default="http://localhost:8002/analyze-risk/bulk")
+    args = parser.parse_args()
+
+    records = generate_records(args.rows)
+    body = encode(records, args.format)
+    print(f"{args.rows} drivers, {len(body) / 2 ** 20:.1f} MiB of {args.format}")
+
+    if args.mode == "http":
+        elapsed, first_result, summary = run_http(body, args.format, args.url)
+        print(f"  endpoint      {args.rows / elapsed:12,.0f} rows/s  ({elapsed:.2f}s, "
+              f"first result after {first_result * 1000:.0f}ms)")
+        print(f"  server-side   {summary['rows_per_second']:12,.0f} rows/s  errors {summary['errors']}")
+        return
+
+    elapsed, levels = run_vectorized(body, args.format, args.chunk_rows)
+    print(f"  vectorized    {args.rows / elapsed:12,.0f} rows/s  ({elapsed:.2f}s incl. parsing and JSON output)")
+    try:
+        baseline, baseline_levels = run_per_driver(records)
+    except ImportError as e:
+        print(f"  per-driver    skipped ({e})")
+        return
+    print(f"  per-driver    {args.rows / baseline:12,.0f} rows/s  ({baseline:.2f}s scoring only)")
+    mismatches = sum(a != b for a, b in zip(levels, baseline_levels))
+    print(f"  risk levels matching the per-driver path: {args.rows - mismatches}/{args.rows}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Vectorized risk scoring for bulk (portfolio) analysis.
+
+Computes the same age, risk score and risk level as
+SimplifiedRiskAnalyzer.analyze_risk, but with NumPy over whole columns
+instead of one driver dict at a time. Keep the weights and bands here in
+sync with _calculate_risk_score, _calculate_age_risk,
+_calculate_gender_risk and _classify_risk_level.
+"""
+import csv
+import json
+import re
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+
+COLUMNS = ("driver_name", "birth_date", "gender", "vehicle_number", "vehicle_model", "model_name",
+           "drowsiness_state", "overspeeding")
+
+DROWSINESS_WEIGHT = 0.6
+OVERSPEEDING_WEIGHT = 0.4
+
+# Highest threshold first, as in _classify_risk_level
+RISK_LEVELS = ((0.75, "EXTREME RISK"), (0.5, "HIGH RISK"), (0.25, "MODERATE RISK"))
+LOWEST_RISK_LEVEL = "LOW RISK"
+
+PADDED_DATE = re.compile(r"(?!0000)[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+INSURANCE_STATUS = {"EXTREME RISK": ("DENY", "100%+"), "HIGH RISK": ("CONDITIONAL", "50-100%"),
+                    "MODERATE RISK": ("APPROVED", "20-50%"), "LOW RISK": ("STANDARD", "0-20%")}
+
+
+def parse_birth_dates(values: Iterable) -> np.ndarray:
+    """
+    Birth dates as datetime64[D], read the way calculate_age reads them
+    (strptime "%Y-%m-%d"); missing or invalid dates become NaT
+    """
+    values = list(values)
+    parsed = np.full(len(values), np.datetime64("NaT"), dtype="datetime64[D]")
+    # NumPy reads zero-padded dates exactly like strptime, and much faster;
+    # it would also take "1990" or "1990-01", so everything else goes
+    # through strptime one by one
+    padded = [i for i, value in enumerate(values) if isinstance(value, str) and PADDED_DATE.fullmatch(value)]
+    try:
+        parsed[padded] = np.array([values[i] for i in padded], dtype="datetime64[D]")
+    except ValueError:
+        # Some padded date does not exist, such as 1990-02-30
+        padded = []
+    rest = set(range(len(values))).difference(padded)
+    for i in rest:
+        try:
+            parsed[i] = datetime.strptime(values[i], "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            pass
+    return parsed
+
+
+def ages(birth_dates: np.ndarray, today: date = None) -> np.ndarray:
+    """
+    Age in whole years on `today`; negative for birth dates in the future
+    and meaningless where the birth date is NaT
+    """
+    today = today or date.today()
+    years = birth_dates.astype("datetime64[Y]")
+    months = birth_dates.astype("datetime64[M]")
+    birth_year = years.astype(np.int64) + 1970
+    birth_month = (months - years).astype(np.int64) + 1
+    birth_day = (birth_dates - months).astype(np.int64) + 1
+
+    age = today.year - birth_year
+    # Birthday not reached yet this year
+    age -= (today.month < birth_month) | ((today.month == birth_month) & (today.day < birth_day))
+    return age
+
+
+def score(columns: Dict[str, np.ndarray], today: date = None) -> Dict[str, np.ndarray]:
+    """
+    Score a batch of drivers
+
+    :param columns: birth_date (datetime64[D]), gender (str), drowsiness_state
+                    and overspeeding (numeric) arrays of equal length
+    :return: age, age_known (False where the birth date is unknown),
+             risk_score and risk_level arrays
+    """
+    age_known = ~np.isnat(columns["birth_date"])
+    age = np.where(age_known, ages(columns["birth_date"], today), 0)
+    age_risk = np.select([~age_known, age < 25, age > 65], [0.1, 0.15, 0.10], 0.05)
+    gender_risk = np.where(np.char.lower(columns["gender"].astype(str)) == "male", 0.05, 0.02)
+
+    risk_score = np.minimum(
+        columns["drowsiness_state"] * DROWSINESS_WEIGHT + columns["overspeeding"] * OVERSPEEDING_WEIGHT
+        + age_risk + gender_risk,
+        1
+    )
+    risk_level = np.select([risk_score >= threshold for threshold, _ in RISK_LEVELS],
+                           [level for _, level in RISK_LEVELS], LOWEST_RISK_LEVEL)
+    return {"age": age, "age_known": age_known, "risk_score": risk_score, "risk_level": risk_level}
+
+
+def _flag(value) -> float:
+    """Risk flag as a number; accepts numbers, booleans and 0/1/true/false/yes/no strings"""
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in ("", "0", "false", "no"):
+            return 0.0
+        if text in ("1", "true", "yes"):
+            return 1.0
+        return float(text)
+    return float(value or 0)
+
+
+def normalize_record(record: Dict[str, Any]) -> tuple:
+    """
+    One driver_data dict as a tuple of COLUMNS values, with analyze_risk's
+    defaults for missing fields
+
+    :raises ValueError: If a risk flag is not a number or boolean
+    """
+    return (
+        str(record.get("driver_name", "N/A")),
+        record.get("birth_date") or None,
+        str(record.get("gender") or "N/A"),
+        str(record.get("vehicle_number", "N/A")),
+        str(record.get("vehicle_model", "N/A")),
+        str(record.get("model_name", "N/A")),
+        _flag(record.get("drowsiness_state", 0)),
+        _flag(record.get("overspeeding", 0)),
+    )
+
+
+def to_columns(normalized: List[tuple]) -> Dict[str, np.ndarray]:
+    """Column arrays from normalize_record tuples"""
+    columns = dict(zip(COLUMNS, zip(*normalized))) if normalized else dict.fromkeys(COLUMNS, ())
+    columns["birth_date"] = parse_birth_dates(columns["birth_date"])
+    columns["gender"] = np.array(columns["gender"], dtype=object)
+    columns["drowsiness_state"] = np.array(columns["drowsiness_state"], dtype=np.float64)
+    columns["overspeeding"] = np.array(columns["overspeeding"], dtype=np.float64)
+    return columns
+
+
+def parse_jsonl_line(line: str) -> Dict[str, Any]:
+    """driver_data dict from one JSON line; it may also be wrapped as {"driver_data": {...}}"""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("Each line must be a JSON object")
+    return record.get("driver_data", record)
+
+
+def parse_csv_line(line: str, header: List[str]) -> Dict[str, Any]:
+    """driver_data dict from one CSV line (quoted fields must not contain newlines)"""
+    return dict(zip(header, next(csv.reader([line]))))
+
+
+def result_rows(columns: Dict[str, np.ndarray], scores: Dict[str, np.ndarray], row_numbers: List[int]) -> List[Dict]:
+    """Per-driver output records of a scored batch"""
+    rows = []
+    for row, name, number, age, age_known, risk_score, level in zip(
+            row_numbers, columns["driver_name"], columns["vehicle_number"], scores["age"].tolist(),
+            scores["age_known"].tolist(), scores["risk_score"].tolist(), scores["risk_level"].tolist()):
+        status, premium_loading = INSURANCE_STATUS[level]
+        rows.append({
+            "type": "result",
+            "row": row,
+            "driver_name": name,
+            "vehicle_number": number,
+            "age": age if age_known else None,
+            "risk_score": risk_score,
+            "risk_level": level,
+            "insurance_status": status,
+            "premium_loading": premium_loading,
+        })
+    return rows
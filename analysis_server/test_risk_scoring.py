@@ -0,0 +1,81 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+import risk_scoring
+
+DRIVER = {"driver_name": "A", "birth_date": "1990-06-15", "gender": "Male", "vehicle_number": "KA01",
+          "vehicle_model": "Tata", "model_name": "Nexon", "drowsiness_state": 1, "overspeeding": 0}
+
+BIRTH_DATES = [
+    "1990-06-15",
+    "2010-01-01",
+    "1950-12-31",
+    # Single-digit month and day are accepted by strptime
+    "1990-1-5",
+    # Year or month only, and other things strptime rejects
+    "1990",
+    "1990-01",
+    "1990-02-30",
+    "0000-01-01",
+    "1990-01-01T00:00",
+    " 1990-01-01",
+    "",
+    None,
+    19900101,
+    # In the future: a negative age, scored like a young driver
+    f"{date.today().year + 1}-01-01",
+    "2999-12-31",
+]
+
+
+def score_records(records):
+    columns = risk_scoring.to_columns([risk_scoring.normalize_record(record) for record in records])
+    scores = risk_scoring.score(columns)
+    return risk_scoring.result_rows(columns, scores, list(range(len(records))))
+
+
+def test_parse_birth_dates_matches_strptime():
+    parsed = risk_scoring.parse_birth_dates(["1990-1-5", "1990", "1990-01", "1990-02-30", "2000-02-29"])
+    assert parsed.tolist() == [date(1990, 1, 5), None, None, None, date(2000, 2, 29)]
+
+
+def test_ages_around_birthday():
+    birth_dates = risk_scoring.parse_birth_dates(["2000-03-01", "2000-03-02", "2000-02-29"])
+    assert risk_scoring.ages(birth_dates, date(2024, 3, 1)).tolist() == [24, 23, 24]
+    assert risk_scoring.ages(birth_dates, date(2023, 3, 1)).tolist() == [23, 22, 23]
+
+
+def test_future_birth_date_is_not_unknown():
+    result, unknown = score_records([dict(DRIVER, birth_date="2999-12-31"), dict(DRIVER, birth_date=None)])
+    assert result["age"] < 0
+    assert unknown["age"] is None
+    assert result["risk_score"] == pytest.approx(0.6 + 0.15 + 0.05)
+    assert unknown["risk_score"] == pytest.approx(0.6 + 0.1 + 0.05)
+
+
+def test_matches_per_driver_analysis():
+    analysis_server = pytest.importorskip("analysis_server")
+    analyzer = analysis_server.SimplifiedRiskAnalyzer(None)
+
+    records = [dict(DRIVER, birth_date=birth_date, gender=gender, drowsiness_state=drowsiness,
+                    overspeeding=overspeeding)
+               for birth_date in BIRTH_DATES
+               for gender in ("Male", "female", "N/A")
+               for drowsiness, overspeeding in ((0, 0), (1, 0), (0, 1), (1, 1))]
+
+    for record, result in zip(records, score_records(records)):
+        age = analyzer.calculate_age(record["birth_date"])
+        profile = {"personal_details": {"age": age, "gender": record["gender"]},
+                   "risk_factors": {"drowsiness": record["drowsiness_state"],
+                                    "overspeeding": record["overspeeding"]}}
+        risk_score = analyzer._calculate_risk_score(profile)
+        assert result["age"] == age, record
+        assert result["risk_score"] == pytest.approx(risk_score), record
+        assert result["risk_level"] == analyzer._classify_risk_level(risk_score), record
+
+
+def test_empty_batch():
+    assert score_records([]) == []
+    assert risk_scoring.parse_birth_dates([]).dtype == np.dtype("datetime64[D]")
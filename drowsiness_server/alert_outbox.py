@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TwilioSmsSender:
+    """
+    Sends SMS through Twilio with one long-lived client.
+
+    The client (and its HTTP connection pool) is created on first use and
+    reused for every message instead of being rebuilt per alert.
+    """
+
+    def __init__(self, account_sid: str, auth_token: str, from_number: str):
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.from_number = from_number
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from twilio.rest import Client
+            self._client = Client(self.account_sid, self.auth_token)
+        return self._client
+
+    def send(self, to: str, body: str) -> str:
+        message = self.client.messages.create(body=body, from_=self.from_number, to=to)
+        return message.sid
+
+
+class LoggingSmsSender:
+    """Local SMS sender for development and tests: logs and records messages"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, to: str, body: str) -> str:
+        sid = f"local-{uuid.uuid4().hex[:12]}"
+        self.sent.append({"to": to, "body": body, "sid": sid})
+        logger.info(f"Would send SMS to {to}: {body!r}")
+        return sid
+
+
+class AlertOutbox:
+    """
+    Background outbox for SMS alerts.
+
+    Producers (the frame pipeline and HTTP handlers) only call enqueue(),
+    which returns an alert id immediately. Worker tasks deliver each alert to
+    all of its contacts concurrently, retrying failed sends with exponential
+    backoff. At most `send_concurrency` SMS sends are in flight at once
+    across all alerts, so a burst of alerts cannot exhaust the thread pool
+    or the provider's rate limit. Alerts carrying an idempotency key are
+    only queued once per key, and the delivery status of recent alerts can
+    be queried by id. With a `status_store` (a SessionStore), every status
+    change is also published there for `status_ttl` seconds, so workers
+    that did not queue an alert can report its status too.
+
+    Any object with a send(to, body) -> message id method can be used as the
+    sender, so tests can swap in a local fake.
+    """
+
+    def __init__(self, sender, workers: int = 2, max_attempts: int = 3,
+                 retry_backoff: float = 1.0, history_size: int = 1000, send_concurrency: int = 8,
+                 status_store=None, status_ttl: float = 86400):
+        self.sender = sender
+        self.status_store = status_store
+        self.status_ttl = status_ttl
+        self.workers = workers
+        self.send_concurrency = send_concurrency
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.history_size = history_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._alerts: "OrderedDict[str, Dict]" = OrderedDict()
+        self._by_key: Dict[str, str] = {}
+        self._send_slots: Optional[asyncio.Semaphore] = None
+        self.sends_in_flight = 0
+        self._revision = 0
+        self._status_writes = set()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._send_slots = asyncio.Semaphore(self.send_concurrency)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.gather(*self._status_writes, return_exceptions=True)
+
+    def enqueue(self, kind: str, message: str, contacts: List[str], idempotency_key: str = None,
+                alert_id: str = None) -> str:
+        """
+        Queue an alert for delivery.
+
+        :param kind: Alert type, e.g. "drowsiness" or "accident"
+        :param message: SMS body
+        :param contacts: Phone numbers to notify
+        :param idempotency_key: Alerts with a key already seen are not queued
+                                again; the original alert id is returned
+        :param alert_id: Id to queue the alert under, e.g. one already
+                         claimed in a shared store (default: a new id)
+        :return: Alert id for status queries
+        """
+        if idempotency_key is not None and idempotency_key in self._by_key:
+            return self._by_key[idempotency_key]
+
+        alert_id = alert_id or uuid.uuid4().hex
+        self._alerts[alert_id] = {
+            "alert_id": alert_id,
+            "kind": kind,
+            "status": "queued",
+            "created_at": time.time(),
+            "completed_at": None,
+            "message": message,
+            "idempotency_key": idempotency_key,
+            "contacts": {
+                contact: {"status": "pending", "attempts": 0, "sid": None, "error": None}
+                for contact in contacts
+            },
+        }
+        if idempotency_key is not None:
+            self._by_key[idempotency_key] = alert_id
+        self._trim_history()
+        self._publish(alert_id)
+
+        self._queue.put_nowait(alert_id)
+        return alert_id
+
+    def status(self, alert_id: str) -> Optional[Dict]:
+        alert = self._alerts.get(alert_id)
+        if alert is None:
+            return None
+        sent = sum(1 for c in alert["contacts"].values() if c["status"] == "sent")
+        return {**alert, "sent_count": sent, "total_contacts": len(alert["contacts"])}
+
+    def _publish(self, alert_id: str):
+        """Write the alert's current status to the status store in the background"""
+        if self.status_store is None:
+            return
+        # Writes may finish out of order; the store keeps the highest revision
+        self._revision += 1
+        task = asyncio.get_running_loop().run_in_executor(None, self.status_store.save_alert_status, alert_id,
+                                                          self.status(alert_id), self._revision, self.status_ttl)
+        self._status_writes.add(task)
+        task.add_done_callback(self._published)
+
+    def _published(self, task):
+        self._status_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to publish alert status: {task.exception()}")
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "tracked_alerts": len(self._alerts),
+            "sends_in_flight": self.sends_in_flight,
+            "send_concurrency": self.send_concurrency,
+        }
+
+    def _trim_history(self):
+        # Forget the oldest finished alerts (and their idempotency keys)
+        while len(self._alerts) > self.history_size:
+            alert_id, alert = next(iter(self._alerts.items()))
+            if alert["status"] in ("queued", "sending"):
+                break
+            del self._alerts[alert_id]
+            if alert["idempotency_key"] is not None:
+                self._by_key.pop(alert["idempotency_key"], None)
+
+    async def _worker(self):
+        while True:
+            alert_id = await self._queue.get()
+            try:
+                await self._deliver(self._alerts[alert_id])
+            except Exception as e:
+                logger.error(f"Alert {alert_id} delivery failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, alert):
+        alert["status"] = "sending"
+        self._publish(alert["alert_id"])
+        await asyncio.gather(*[self._send_to(alert, contact) for contact in alert["contacts"]])
+
+        sent = sum(1 for c in alert["contacts"].values() if c["status"] == "sent")
+        if sent == len(alert["contacts"]):
+            alert["status"] = "delivered"
+        elif sent:
+            alert["status"] = "partial"
+        else:
+            alert["status"] = "failed"
+        alert["completed_at"] = time.time()
+        self._publish(alert["alert_id"])
+        logger.info(f"{alert['kind'].capitalize()} alert {alert['alert_id']} {alert['status']}: "
+                    f"sent to {sent} of {len(alert['contacts'])} contacts")
+
+    async def _send_to(self, alert, contact):
+        loop = asyncio.get_running_loop()
+        delivery = alert["contacts"][contact]
+
+        for attempt in range(1, self.max_attempts + 1):
+            delivery["attempts"] = attempt
+            try:
+                # The SMS client is blocking; keep it off the event loop
+                async with self._send_slots:
+                    self.sends_in_flight += 1
+                    try:
+                        delivery["sid"] = await loop.run_in_executor(None, self.sender.send, contact,
+                                                                     alert["message"])
+                    finally:
+                        self.sends_in_flight -= 1
+                delivery["status"] = "sent"
+                delivery["error"] = None
+                logger.info(f"Alert sent to {contact}: {delivery['sid']}")
+                return
+            except Exception as e:
+                delivery["error"] = str(e)
+                logger.error(f"Failed to send alert to {contact} (attempt {attempt}/{self.max_attempts}): {e}")
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+        delivery["status"] = "failed"
@@ -0,0 +1,392 @@
+"""
+Offline replay benchmark for the drowsiness pipeline.
+
+Replays a recorded frame sequence (a video file or a directory of JPEGs)
+either in-process through decode_base64_image -> process_frame -> encode, or
+over a running server's /ws/drowsiness endpoint, and reports per-stage
+timings, frames per second, end-to-end latency percentiles and memory.
+
+The keyframes mode runs full FaceMesh inference and keyframe tracking side
+by side on the same frames and reports how far the tracked EAR and eye
+landmarks are from full inference.
+
+    python benchmark.py inprocess recordings/trip.mp4 --output run.json
+    python benchmark.py websocket frames/ --url ws://localhost:8001/ws/drowsiness --protocol binary
+    python benchmark.py inprocess recordings/trip.mp4 --compare run.json
+    python benchmark.py keyframes recordings/trip.mp4 --keyframe-interval 3
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+
+import cv2
+import numpy as np
+
+
+# Load frames as JPEG bytes, the way a client would send them
+def load_frames(source: str, limit: int = None, quality: int = 90):
+    frames = []
+    if os.path.isdir(source):
+        names = sorted(n for n in os.listdir(source) if n.lower().endswith((".jpg", ".jpeg")))
+        for name in names[:limit]:
+            with open(os.path.join(source, name), "rb") as f:
+                frames.append(f.read())
+    else:
+        capture = cv2.VideoCapture(source)
+        while limit is None or len(frames) < limit:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frames.append(cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+        capture.release()
+
+    if not frames:
+        raise SystemExit(f"No frames could be read from {source}")
+    return frames
+
+
+def summarize(samples):
+    """Latency summary in milliseconds; NaN statistics when there are no samples"""
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    if not values.size:
+        return {"count": 0, **dict.fromkeys(("mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"), float("nan"))}
+    return {
+        "count": int(values.size),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def memory_report():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        max_rss *= 1024
+    report = {"max_rss_mb": max_rss / 2 ** 20}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report["python_heap_peak_mb"] = peak / 2 ** 20
+    return report
+
+
+# Resident memory in MB of the server process that answers /metrics (one of
+# them when the server runs several workers), or None if it cannot be read
+def server_memory_mb(ws_url: str):
+    parts = urllib.parse.urlsplit(ws_url)
+    url = urllib.parse.urlunsplit(("https" if parts.scheme == "wss" else "http", parts.netloc, "/metrics", "", ""))
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            for line in response.read().decode("utf-8").splitlines():
+                if line.startswith("process_resident_memory_bytes "):
+                    return float(line.split()[1]) / 2 ** 20
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# Cold import time of the server module, in a fresh interpreter
+def measure_server_import():
+    code = "import time; t = time.perf_counter(); import drowsiness_server; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, "FRAME_EXECUTOR": "process"}, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+# Replay frames through the pipeline functions in this process
+def run_inprocess(frames, repeat: int, annotate: bool):
+    startup = {"server_import_s": measure_server_import()}
+    from detector import DrowsinessDetector, decode_base64_image, decode_min_size
+    # Same decode scale the server would use for this response mode
+    min_size = decode_min_size(annotate)
+
+    # Clients send base64 data URLs; encoding them is not part of the server cost
+    payloads = ["data:image/jpeg;base64," + base64.b64encode(f).decode("ascii") for f in frames]
+
+    # Building the first detector loads mediapipe and starts the FaceMesh
+    # graph; the first frame initializes the models. Both are reported as
+    # startup cost and kept out of the steady-state numbers.
+    started = time.perf_counter()
+    detector = DrowsinessDetector()
+    startup["detector_init_s"] = time.perf_counter() - started
+    started = time.perf_counter()
+    detector.process_frame(decode_base64_image(payloads[0], min_size), annotate=annotate)
+    startup["first_frame_s"] = time.perf_counter() - started
+    detector.reset()
+
+    stages = {"decode": [], "process_frame": [], "encode": []}
+    # Breakdown of process_frame as timed inside the detector
+    detector_stages = {}
+    end_to_end = []
+    faces = 0
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for payload in payloads:
+            t0 = time.perf_counter()
+            frame = decode_base64_image(payload, min_size)
+            t1 = time.perf_counter()
+            timings = {}
+            processed_frame, results = detector.process_frame(frame, annotate=annotate, timings=timings)
+            t2 = time.perf_counter()
+            if annotate:
+                _, buffer = cv2.imencode(".jpg", processed_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                base64.b64encode(buffer).decode("utf-8")
+            t3 = time.perf_counter()
+
+            stages["decode"].append(t1 - t0)
+            stages["process_frame"].append(t2 - t1)
+            stages["encode"].append(t3 - t2)
+            end_to_end.append(t3 - t0)
+            for stage, seconds in timings.items():
+                detector_stages.setdefault(stage, []).append(seconds)
+            faces += results["hasDetectedFace"]
+    elapsed = time.perf_counter() - started
+    memory = memory_report()
+    tracemalloc.stop()
+
+    return {
+        "frames": len(end_to_end),
+        "elapsed_s": elapsed,
+        "fps": len(end_to_end) / elapsed,
+        "face_detection_rate": faces / len(end_to_end),
+        "latency": summarize(end_to_end),
+        "stages": {name: summarize(samples) for name, samples in {**stages, **detector_stages}.items()},
+        "memory": memory,
+        "startup": startup,
+    }
+
+
+# Compare keyframe tracking against full inference on every frame
+def run_keyframes(frames, repeat: int, interval: int):
+    from detector import DrowsinessDetector, decode_image_bytes, eye_aspect_ratios
+    from drowsiness_state import EYE_AR_THRESH
+
+    decoded = [decode_image_bytes(f) for f in frames]
+    full = DrowsinessDetector(keyframe_interval=1)
+    tracked = DrowsinessDetector(keyframe_interval=interval)
+
+    full_times, tracked_times = [], []
+    ear_errors, point_errors, reference_ears = [], [], []
+    both_found = closed_agree = missed = 0
+
+    for _ in range(repeat):
+        for frame in decoded:
+            t0 = time.perf_counter()
+            reference = full.detect_eyes(frame)
+            t1 = time.perf_counter()
+            points = tracked.detect_eyes(frame)
+            t2 = time.perf_counter()
+            full_times.append(t1 - t0)
+            tracked_times.append(t2 - t1)
+
+            if reference is None or points is None:
+                missed += (reference is None) != (points is None)
+                continue
+            reference_ear = float(eye_aspect_ratios(reference).mean())
+            reference_ears.append(reference_ear)
+            ear = float(eye_aspect_ratios(points).mean())
+            # Landmark error in pixels of the frame
+            pixel_error = np.linalg.norm((points - reference) * frame.shape[1::-1], axis=1)
+
+            both_found += 1
+            ear_errors.append(abs(ear - reference_ear))
+            point_errors.append(float(pixel_error.mean()))
+            closed_agree += (ear < EYE_AR_THRESH) == (reference_ear < EYE_AR_THRESH)
+
+    ear_errors = np.asarray(ear_errors)
+    return {
+        "frames": len(full_times),
+        "keyframe_interval": interval,
+        "keyframe_ratio": tracked.keyframes / len(tracked_times),
+        "elapsed_s": sum(tracked_times),
+        "fps": len(tracked_times) / sum(tracked_times),
+        "full_inference_fps": len(full_times) / sum(full_times),
+        "latency": summarize(tracked_times),
+        "stages": {"full_inference": summarize(full_times), "keyframe_tracking": summarize(tracked_times)},
+        "accuracy": {
+            "frames_compared": both_found,
+            "detection_mismatches": missed,
+            "ear_mae": float(ear_errors.mean()) if both_found else None,
+            "ear_p95_error": float(np.percentile(ear_errors, 95)) if both_found else None,
+            "ear_max_error": float(ear_errors.max()) if both_found else None,
+            "landmark_mean_error_px": float(np.mean(point_errors)) if both_found else None,
+            "eye_closed_agreement": closed_agree / both_found if both_found else None,
+            # Frame-to-frame EAR change of full inference itself, for scale
+            "reference_ear_jitter": float(np.abs(np.diff(reference_ears)).mean()) if both_found > 1 else None,
+        },
+        "memory": memory_report(),
+    }
+
+
+# Replay frames over the real WebSocket endpoint, one in flight per stream.
+# The server sends nothing for a frame it cannot decode, so a reply that
+# does not arrive within reply_timeout seconds counts as a dropped frame.
+async def run_websocket(frames, repeat: int, url: str, protocol: str, response: str, streams: int,
+                        reply_timeout: float = 5.0):
+    import websockets
+    from protocol import unpack_result
+
+    url = f"{url}{'&' if '?' in url else '?'}protocol={protocol}&response={response}"
+    if protocol == "binary":
+        payloads = frames
+    else:
+        payloads = [json.dumps({"frame": "data:image/jpeg;base64," + base64.b64encode(f).decode("ascii")})
+                    for f in frames]
+
+    async def stream():
+        latencies, faces, dropped = [], 0, 0
+        async with websockets.connect(url, max_size=None) as ws:
+            # Warm-up frame for the session's detector
+            await ws.send(payloads[0])
+            try:
+                await asyncio.wait_for(ws.recv(), reply_timeout)
+            except asyncio.TimeoutError:
+                dropped += 1
+            for _ in range(repeat):
+                for payload in payloads:
+                    t0 = time.perf_counter()
+                    await ws.send(payload)
+                    try:
+                        reply = await asyncio.wait_for(ws.recv(), reply_timeout)
+                    except asyncio.TimeoutError:
+                        dropped += 1
+                        continue
+                    latencies.append(time.perf_counter() - t0)
+                    result = unpack_result(reply) if protocol == "binary" else json.loads(reply)
+                    faces += result["face_detected"]
+        return latencies, faces, dropped
+
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(*[stream() for _ in range(streams)])
+    elapsed = time.perf_counter() - started
+
+    latencies = [sample for samples, _, _ in outcomes for sample in samples]
+    faces = sum(f for _, f, _ in outcomes)
+    server_memory = await asyncio.get_running_loop().run_in_executor(None, server_memory_mb, url)
+    return {
+        "frames": len(latencies),
+        "dropped_frames": sum(d for _, _, d in outcomes),
+        "streams": streams,
+        "elapsed_s": elapsed,
+        "fps": len(latencies) / elapsed,
+        "face_detection_rate": faces / len(latencies) if latencies else 0.0,
+        "latency": summarize(latencies),
+        # Memory of this client process; the server's comes from its /metrics
+        "memory": memory_report(),
+        "server_memory": {"rss_mb": server_memory},
+    }
+
+
+# Print relative change of the headline numbers against a previous run
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def pct(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    rows = [("fps", current["fps"], baseline["fps"])]
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        rows.append((f"latency {key}", current["latency"][key], baseline["latency"][key]))
+    for key, value in current.get("startup", {}).items():
+        if value is not None and baseline.get("startup", {}).get(key) is not None:
+            rows.append((f"startup {key} ms", value * 1000, baseline["startup"][key] * 1000))
+    for stage, summary in current.get("stages", {}).items():
+        if stage in baseline.get("stages", {}):
+            rows.append((f"{stage} p50_ms", summary["p50_ms"], baseline["stages"][stage]["p50_ms"]))
+
+    print(f"\nCompared with {baseline_path}:")
+    for name, new, old in rows:
+        print(f"  {name:<24} {old:10.2f} -> {new:10.2f}  {pct(new, old)}")
+
+
+def print_report(report):
+    if "accuracy" in report:
+        print(f"Keyframe interval {report['keyframe_interval']}: {report['fps']:.1f} fps "
+              f"(full inference {report['full_inference_fps']:.1f} fps), "
+              f"keyframes {report['keyframe_ratio']:.0%} of frames")
+        print("  accuracy " + ", ".join(f"{k} {v:.4g}" for k, v in report["accuracy"].items() if v is not None))
+    else:
+        print(f"{report['frames']} frames in {report['elapsed_s']:.2f}s: {report['fps']:.1f} fps, "
+              f"face detected in {report['face_detection_rate']:.0%}")
+        if report.get("dropped_frames"):
+            print(f"  {report['dropped_frames']} frames dropped (no reply within the timeout)")
+    latency = report["latency"]
+    print(f"  end-to-end  p50 {latency['p50_ms']:.2f}ms  p95 {latency['p95_ms']:.2f}ms  p99 {latency['p99_ms']:.2f}ms")
+    for stage, summary in report.get("stages", {}).items():
+        print(f"  {stage:<14} p50 {summary['p50_ms']:.2f}ms  p95 {summary['p95_ms']:.2f}ms  mean {summary['mean_ms']:.2f}ms")
+    print("  memory " + ", ".join(f"{k} {v:.1f}" for k, v in report["memory"].items()))
+    if report.get("server_memory", {}).get("rss_mb") is not None:
+        print(f"  server memory rss_mb {report['server_memory']['rss_mb']:.1f}")
+    if "startup" in report:
+        print("  startup " + ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in report["startup"].items() if v is not None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded frames through the drowsiness pipeline")
+    parser.add_argument("mode", choices=["inprocess", "websocket", "keyframes"])
+    parser.add_argument("source", help="Video file or directory of JPEG frames")
+    parser.add_argument("--limit", type=int, help="Use at most this many frames from the source")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the sequence this many times")
+    parser.add_argument("--response", choices=["frame", "results"], default="frame",
+                        help="Annotated frames or results-only responses")
+    parser.add_argument("--url", default="ws://localhost:8001/ws/drowsiness")
+    parser.add_argument("--protocol", choices=["json", "binary"], default="json")
+    parser.add_argument("--streams", type=int, default=1, help="Concurrent WebSocket sessions")
+    parser.add_argument("--reply-timeout", type=float, default=5.0,
+                        help="Seconds to wait for a reply before counting the frame as dropped")
+    parser.add_argument("--keyframe-interval", type=int, default=3,
+                        help="Keyframe interval compared against full inference in keyframes mode")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Previous JSON results to compare against")
+    args = parser.parse_args()
+
+    frames = load_frames(args.source, args.limit)
+    first = cv2.imdecode(np.frombuffer(frames[0], np.uint8), cv2.IMREAD_COLOR)
+
+    if args.mode == "inprocess":
+        report = run_inprocess(frames, args.repeat, args.response == "frame")
+    elif args.mode == "keyframes":
+        report = run_keyframes(frames, args.repeat, args.keyframe_interval)
+    else:
+        report = asyncio.run(run_websocket(frames, args.repeat, args.url, args.protocol,
+                                           args.response, args.streams, args.reply_timeout))
+
+    report.update({
+        "mode": args.mode,
+        "source": args.source,
+        "source_frames": len(frames),
+        "resolution": [int(first.shape[1]), int(first.shape[0])],
+        "response": args.response,
+        "protocol": args.protocol if args.mode == "websocket" else None,
+        "timestamp": time.time(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+    })
+
+    print_report(report)
+    if args.compare:
+        compare(report, args.compare)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
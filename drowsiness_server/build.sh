@@ -13,8 +13,8 @@ apt-get update && apt-get install -y \
     libxrender1
 
 # Install packages incrementally
-echo "Installing numpy, scipy..."
-pip install numpy scipy
+echo "Installing numpy..."
+pip install numpy
 
 echo "Installing OpenCV..."
 pip install opencv-python-headless
@@ -23,7 +23,7 @@ echo "Installing MediaPipe..."
 pip install mediapipe
 
 echo "Installing remaining dependencies..."
-pip install python-multipart python-dotenv twilio websockets pydantic==1.10.7
+pip install python-multipart python-dotenv twilio websockets prometheus-client pydantic==1.10.7
 
 # Verify installation
 echo "Installed packages:"
@@ -0,0 +1,509 @@
+import cv2
+import numpy as np
+import time
+import base64
+import queue
+import threading
+import logging
+import os
+import struct
+
+# The drowsiness parameters and the EAR-based decision live in
+# drowsiness_state, which does not need OpenCV
+from drowsiness_state import DrowsinessState
+
+logger = logging.getLogger(__name__)
+
+# Define eye landmarks for MediaPipe (indexes are different from dlib)
+# These are the indexes for the eye landmarks in MediaPipe's 468 points model
+LEFT_EYE_INDEXES = [362, 385, 387, 263, 373, 380]
+RIGHT_EYE_INDEXES = [33, 160, 158, 133, 153, 144]
+
+# Face extremes (forehead, chin, both cheeks) used to track the face box
+FACE_BOUNDS_INDEXES = [10, 152, 234, 454]
+
+# Inference pre-processing. With ROI_CROP enabled, FaceMesh only sees a
+# padded box around the previous frame's face, downscaled so its longest
+# side is at most INFERENCE_SIZE pixels. When there is no face box yet (or
+# tracking was lost) the full frame is used, downscaled to at most
+# FULL_FRAME_INFERENCE_SIZE so small faces are still found.
+ROI_CROP = os.getenv("ROI_CROP", "1") != "0"
+ROI_PADDING = float(os.getenv("ROI_PADDING", 0.4))  # fraction of the face size added on each side
+INFERENCE_SIZE = int(os.getenv("INFERENCE_SIZE", 256))
+FULL_FRAME_INFERENCE_SIZE = int(os.getenv("FULL_FRAME_INFERENCE_SIZE", 640))
+
+# Reduced-scale JPEG decoding. libjpeg can decode at 1/2, 1/4 or 1/8 scale
+# directly from the DCT coefficients, which is much faster than a full
+# decode. The largest reduction that keeps the frame's longest side at least
+# FULL_FRAME_INFERENCE_SIZE is used, so inference sees the same detail.
+# REDUCED_DECODE is "auto" (only for results-only sessions, whose frames are
+# never sent back), "always" (annotated frames come back downscaled too) or
+# "never".
+REDUCED_DECODE = os.getenv("REDUCED_DECODE", "auto")
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+# JPEG start-of-frame markers (SOF0-SOF15 except DHT, JPG and DAC)
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Keyframe mode. With KEYFRAME_INTERVAL > 1, FaceMesh only runs on every
+# KEYFRAME_INTERVAL-th frame; in between, the eye landmarks are carried
+# forward with pyramidal Lucas-Kanade optical flow on a grayscale view of the
+# face (downscaled to at most FLOW_SIZE pixels). A keyframe is forced early
+# when any point's forward-backward flow error exceeds FLOW_MAX_ERROR pixels
+# or the EAR moves by more than KEYFRAME_EAR_DELTA between two frames, which
+# is what a blink or eye closure looks like.
+KEYFRAME_INTERVAL = max(1, int(os.getenv("KEYFRAME_INTERVAL", 1)))
+FLOW_MAX_ERROR = float(os.getenv("FLOW_MAX_ERROR", 0.5))
+KEYFRAME_EAR_DELTA = float(os.getenv("KEYFRAME_EAR_DELTA", 0.04))
+FLOW_SIZE = 480
+_LK_PARAMS = dict(winSize=(15, 15), maxLevel=2,
+                  criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+# Create a tracking MediaPipe FaceMesh (one per detector, never shared).
+# mediapipe takes most of a second to import, so it is only loaded where a
+# detector is actually built (the executor workers), not at server import.
+def create_face_mesh():
+    import mediapipe as mp
+
+    return mp.solutions.face_mesh.FaceMesh(
+        static_image_mode=False,
+        max_num_faces=1,
+        min_detection_confidence=0.5,
+        min_tracking_confidence=0.5
+    )
+
+# Left then right eye landmark indexes, in the row order used by eye_aspect_ratios
+EYE_INDEXES = LEFT_EYE_INDEXES + RIGHT_EYE_INDEXES
+
+# Point pairs for the EAR, as rows of the (12, 2) eye array: per eye the
+# horizontal pair (0, 3) and the vertical pairs (1, 5) and (2, 4)
+_EAR_FROM = np.array([0, 1, 2, 6, 7, 8])
+_EAR_TO = np.array([3, 5, 4, 9, 11, 10])
+
+# Convert MediaPipe landmarks to a contiguous (N, 2) float32 array of (x, y).
+# Reading protobuf fields dominates the cost, so only the requested landmark
+# indexes are converted (all 468 when indexes is None).
+def landmarks_to_array(landmarks, indexes=None):
+    if indexes is None:
+        indexes = range(len(landmarks))
+    return np.array([(landmarks[i].x, landmarks[i].y) for i in indexes], dtype=np.float32)
+
+# Calculate the eye aspect ratio of both eyes in one vectorized expression.
+# eye_points is a (12, 2) array of EYE_INDEXES landmarks, or (batch, 12, 2)
+# for a batch of frames; the result is (2,) or (batch, 2) holding the left
+# and right eye EAR.
+def eye_aspect_ratios(eye_points):
+    diff = eye_points[..., _EAR_FROM, :] - eye_points[..., _EAR_TO, :]
+    dists = np.hypot(diff[..., 0], diff[..., 1]).reshape(eye_points.shape[:-2] + (2, 3))
+    return (dists[..., 1] + dists[..., 2]) / (2.0 * dists[..., 0])
+
+# Padded, square pixel box (x0, y0, x1, y1) around normalized face points,
+# clipped to the frame
+def face_region(face_points, frame_w, frame_h):
+    (min_x, min_y), (max_x, max_y) = face_points.min(axis=0), face_points.max(axis=0)
+    center_x, center_y = (min_x + max_x) / 2 * frame_w, (min_y + max_y) / 2 * frame_h
+    half = max((max_x - min_x) * frame_w, (max_y - min_y) * frame_h) * (0.5 + ROI_PADDING)
+
+    x0, y0 = max(0, int(center_x - half)), max(0, int(center_y - half))
+    x1, y1 = min(frame_w, int(center_x + half)), min(frame_h, int(center_y + half))
+    if x1 - x0 < 16 or y1 - y0 < 16:
+        return None
+    return x0, y0, x1, y1
+
+# Whether a pixel box still contains normalized face points at a useful scale
+def region_holds_face(roi, face_points, frame_w, frame_h):
+    if roi is None:
+        return False
+    x0, y0, x1, y1 = roi
+    (min_x, min_y), (max_x, max_y) = face_points.min(axis=0), face_points.max(axis=0)
+    inside = (min_x * frame_w >= x0 and min_y * frame_h >= y0 and
+              max_x * frame_w <= x1 and max_y * frame_h <= y1)
+    face_size = max((max_x - min_x) * frame_w, (max_y - min_y) * frame_h)
+    return inside and face_size >= 0.25 * max(x1 - x0, y1 - y0)
+
+# Minimum decoded size for a session's frames, or None for full-size decoding
+def decode_min_size(annotate):
+    if REDUCED_DECODE == "always" or (REDUCED_DECODE == "auto" and not annotate):
+        return FULL_FRAME_INFERENCE_SIZE
+    return None
+
+# (width, height) from a JPEG's start-of-frame header, or None if the bytes
+# are not a JPEG. Only the marker segments before the image data are read.
+def jpeg_size(img_bytes):
+    data = memoryview(img_bytes)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", data, i + 5)
+            return width, height
+        i += 2 + struct.unpack_from(">H", data, i + 2)[0]
+    return None
+
+# Decode raw JPEG/PNG bytes (np.frombuffer wraps them without copying). With
+# min_size, JPEGs are decoded at the largest 1/2, 1/4 or 1/8 reduction whose
+# longest side is still at least min_size pixels.
+def decode_image_bytes(img_bytes, min_size=None):
+    try:
+        flags = cv2.IMREAD_COLOR
+        if min_size is not None:
+            size = jpeg_size(img_bytes)
+            if size is not None:
+                for factor, reduced_flags in _REDUCED_FLAGS:
+                    if max(size) // factor >= min_size:
+                        flags = reduced_flags
+                        break
+        img_np = np.frombuffer(img_bytes, dtype=np.uint8)
+        return cv2.imdecode(img_np, flags)
+    except Exception as e:
+        logger.error(f"Error decoding image bytes: {e}")
+        return None
+
+# Decode a base64 (optionally data URL) string to the encoded image bytes
+def decode_base64_payload(base64_img):
+    try:
+        # Remove data URL prefix if present
+        if "," in base64_img:
+            base64_img = base64_img.split(",")[1]
+
+        # Decode base64
+        return base64.b64decode(base64_img)
+    except Exception as e:
+        logger.error(f"Error decoding base64 image: {e}")
+        return None
+
+# Decode base64 image
+def decode_base64_image(base64_img, min_size=None):
+    img_bytes = decode_base64_payload(base64_img)
+    if img_bytes is None:
+        return None
+    return decode_image_bytes(img_bytes, min_size)
+
+# Add the time since `started` to a stage in an optional timings dict
+def add_timing(timings, stage, started):
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+# Grayscale view of a pixel box of the frame, scaled by `scale`, for optical flow
+def flow_image(frame, box, scale):
+    x0, y0, x1, y1 = box
+    region = frame[y0:y1, x0:x1]
+    if scale < 1:
+        region = cv2.resize(region, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+    return cv2.cvtColor(region, cv2.COLOR_BGR2GRAY)
+
+
+class DrowsinessDetector:
+    """
+    Drowsiness detection for a single driver session.
+
+    Each detector owns its DrowsinessState and a tracking FaceMesh, so
+    concurrent sessions never see each other's state.
+    """
+
+    def __init__(self, face_mesh=None, keyframe_interval: int = KEYFRAME_INTERVAL):
+        self.face_mesh = face_mesh or create_face_mesh()
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.state = DrowsinessState()
+        # Preallocated resize and RGB buffers, kept across frames and sessions
+        self._buffers = {}
+        self.reset()
+
+    def reset(self):
+        """Clear per-session state before the detector is handed to a new session"""
+        self.state.reset()
+        self.roi = None
+        self.frame_size = None
+        # Optical flow state between keyframes: (box, scale, gray image,
+        # (12, 1, 2) eye points in that image, EAR)
+        self.flow = None
+        self.since_keyframe = 0
+        self.keyframes = 0
+        self.tracked_frames = 0
+
+    def close(self):
+        self.face_mesh.close()
+
+    # Run FaceMesh on a BGR frame; returns the (12, 2) eye landmark array of
+    # the first face, normalized to the full frame, or None when no face was
+    # found. Inference runs on a downscaled crop around the previous face when
+    # one is known, and falls back to the full frame when tracking is lost.
+    # Stage durations in seconds are added to `timings` when one is passed.
+    # In keyframe mode, frames between keyframes are tracked with optical
+    # flow instead.
+    def detect_eyes(self, frame, timings=None):
+        # The face crop and flow state are in pixels of the previous frame;
+        # drop them if the client (or the decode scale) changed resolution
+        if frame.shape[:2] != self.frame_size:
+            self.frame_size = frame.shape[:2]
+            self.roi = None
+            self.flow = None
+
+        if self.flow is not None and self.since_keyframe < self.keyframe_interval - 1:
+            started = time.perf_counter()
+            points = self._track_eyes(frame)
+            add_timing(timings, "optical_flow", started)
+            if points is not None:
+                self.since_keyframe += 1
+                self.tracked_frames += 1
+                return points
+
+        points = self._detect_keyframe(frame, timings)
+        self.keyframes += 1
+        self.since_keyframe = 0
+        self.flow = None
+        if points is not None and self.keyframe_interval > 1:
+            started = time.perf_counter()
+            self._start_flow(frame, points)
+            add_timing(timings, "optical_flow", started)
+        return points
+
+    def _detect_keyframe(self, frame, timings=None):
+        if self.roi is not None:
+            # The tracking FaceMesh keeps the previous face position relative
+            # to its previous input, so the first frame after the crop changes
+            # can miss; the retry runs the face detector on the crop itself.
+            for _ in range(2):
+                points = self._detect_in_region(frame, self.roi, INFERENCE_SIZE, timings)
+                if points is not None:
+                    return points
+            self.roi = None
+
+        return self._detect_in_region(frame, None, FULL_FRAME_INFERENCE_SIZE, timings)
+
+    # Remember the keyframe's eye points in a grayscale view of the face box
+    # (or the whole frame when there is none) for tracking the next frames
+    def _start_flow(self, frame, eye_points):
+        frame_h, frame_w = frame.shape[:2]
+        box = self.roi or (0, 0, frame_w, frame_h)
+        scale = min(1.0, FLOW_SIZE / max(box[2] - box[0], box[3] - box[1]))
+        pixels = (eye_points * (frame_w, frame_h) - box[:2]) * scale
+        ear = float(eye_aspect_ratios(eye_points).mean())
+        self.flow = (box, scale, flow_image(frame, box, scale), pixels.reshape(-1, 1, 2).astype(np.float32), ear)
+
+    # Carry the eye points of the previous frame forward with optical flow;
+    # returns None when tracking is unreliable and a keyframe is needed
+    def _track_eyes(self, frame):
+        box, scale, prev_gray, prev_points, prev_ear = self.flow
+        gray = flow_image(frame, box, scale)
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, prev_points, None, **_LK_PARAMS)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, points, None, **_LK_PARAMS)
+        fb_error = np.linalg.norm((back - prev_points).reshape(-1, 2), axis=1)
+        if not (status.all() and back_status.all()) or fb_error.max() > FLOW_MAX_ERROR:
+            return None
+
+        frame_h, frame_w = frame.shape[:2]
+        eye_points = (points.reshape(-1, 2) / scale + box[:2]) / (frame_w, frame_h)
+        eye_points = eye_points.astype(np.float32)
+        ear = float(eye_aspect_ratios(eye_points).mean())
+        if abs(ear - prev_ear) > KEYFRAME_EAR_DELTA:
+            return None
+
+        self.flow = (box, scale, gray, points, ear)
+        return eye_points
+
+    # Reusable image buffer; only reallocated when the shape changes, which
+    # the ROI hysteresis keeps rare. The crop and full-frame paths use
+    # separate buffers so alternating between them does not reallocate.
+    def _buffer(self, name, shape):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self._buffers[name] = np.empty(shape, dtype=np.uint8)
+        return buffer
+
+    def _detect_in_region(self, frame, roi, max_size, timings=None):
+        frame_h, frame_w = frame.shape[:2]
+        x0, y0, x1, y1 = roi if roi is not None else (0, 0, frame_w, frame_h)
+        region = frame[y0:y1, x0:x1]
+        path = "full" if roi is None else "roi"
+
+        # Downscale to the inference size; normalized landmarks are unaffected
+        started = time.perf_counter()
+        scale = max_size / max(region.shape[:2])
+        if scale < 1:
+            size = (max(1, round(region.shape[1] * scale)), max(1, round(region.shape[0] * scale)))
+            region = cv2.resize(region, size, dst=self._buffer(f"{path}_resized", (size[1], size[0], 3)),
+                                interpolation=cv2.INTER_LINEAR)
+        add_timing(timings, "resize", started)
+
+        # Convert to RGB for MediaPipe
+        started = time.perf_counter()
+        region_rgb = cv2.cvtColor(region, cv2.COLOR_BGR2RGB, dst=self._buffer(f"{path}_rgb", region.shape))
+        add_timing(timings, "color_convert", started)
+
+        # Process the frame
+        started = time.perf_counter()
+        results = self.face_mesh.process(region_rgb)
+        add_timing(timings, "facemesh", started)
+        if not results.multi_face_landmarks:
+            return None
+
+        # Convert the needed landmarks of the first face once, then map them
+        # from region coordinates back to the full frame
+        points = landmarks_to_array(results.multi_face_landmarks[0].landmark, EYE_INDEXES + FACE_BOUNDS_INDEXES)
+        points *= ((x1 - x0) / frame_w, (y1 - y0) / frame_h)
+        points += (x0 / frame_w, y0 / frame_h)
+
+        # Only move the crop when the face leaves it or shrinks well inside
+        # it, so the tracker sees a stable view between frames
+        if ROI_CROP and not region_holds_face(self.roi, points[len(EYE_INDEXES):], frame_w, frame_h):
+            self.roi = face_region(points[len(EYE_INDEXES):], frame_w, frame_h)
+        return points[:len(EYE_INDEXES)]
+
+    # Advance the drowsiness state with one frame's detection. ear is the
+    # average EAR of eye_points (computed by the caller so a batch of frames
+    # can share one vectorized eye_aspect_ratios call). When the returned
+    # results have "alertSent" set, the caller is responsible for notifying
+    # the emergency contacts. timestamp is the frame's capture or arrival
+    # time in time.monotonic() seconds; it defaults to now.
+    def update(self, eye_points, ear, timestamp=None):
+        # Initialize result dictionary
+        detection_results = {
+            "isDrowsy": False,
+            "earValue": 0,
+            "drowsinessPercentage": 0,
+            "eyesClosedSeconds": 0,
+            "perclos": 0,
+            "alertSent": False,
+            "hasDetectedFace": False,
+            "eyeLandmarks": []
+        }
+
+        # Check if face is detected
+        if eye_points is not None:
+            detection_results["hasDetectedFace"] = True
+
+            # Normalized (x, y) of the left then right eye points
+            detection_results["eyeLandmarks"] = eye_points.tolist()
+            detection_results["earValue"] = ear
+            detection_results.update(self.state.update(ear, timestamp))
+
+        return detection_results
+
+    # Process frame for drowsiness detection using MediaPipe. With
+    # annotate=False nothing is drawn on the frame; clients get the
+    # normalized eye landmark coordinates in results["eyeLandmarks"] and
+    # draw their own overlay. Stage durations are added to `timings` if given.
+    def process_frame(self, frame, annotate=True, timings=None, timestamp=None):
+        if frame is None:
+            logger.warning("Received empty frame")
+            return None, self.update(None, 0, timestamp)
+
+        eye_points = self.detect_eyes(frame, timings)
+
+        # Average EAR of the left and right eyes
+        ear = float(eye_aspect_ratios(eye_points).mean()) if eye_points is not None else 0
+        detection_results = self.update(eye_points, ear, timestamp)
+
+        if annotate:
+            started = time.perf_counter()
+            annotate_frame(frame, detection_results)
+            add_timing(timings, "annotate", started)
+
+        return frame, detection_results
+
+
+# Draw eye landmarks, contours and status text for visualization
+def annotate_frame(frame, detection_results):
+    h, w, c = frame.shape
+
+    if detection_results["hasDetectedFace"]:
+        points = [(int(x * w), int(y * h)) for x, y in detection_results["eyeLandmarks"]]
+
+        # Draw eye landmarks
+        for point in points:
+            cv2.circle(frame, point, 2, (0, 255, 0), -1)
+
+        # Draw eye contours
+        cv2.polylines(frame, [np.array(points[:6], dtype=np.int32)], True, (0, 255, 0), 1)
+        cv2.polylines(frame, [np.array(points[6:], dtype=np.int32)], True, (0, 255, 0), 1)
+
+        # Add EAR text
+        cv2.putText(frame, f"EAR: {detection_results['earValue']:.2f}", (10, 30),
+            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 0), 2)
+
+        if detection_results["drowsinessPercentage"] > 0:
+            # Add drowsiness percentage text
+            cv2.putText(frame, f"Drowsiness: {detection_results['drowsinessPercentage']:.0f}%", (10, 60),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+
+        if detection_results["isDrowsy"]:
+            # Add ALERT text
+            cv2.putText(frame, "DROWSINESS ALERT!", (10, 90),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+
+    # Add face detection status text
+    face_text = "Face Detected" if detection_results["hasDetectedFace"] else "No Face Detected"
+    color = (0, 255, 0) if detection_results["hasDetectedFace"] else (0, 0, 255)
+    cv2.putText(frame, face_text, (w - 200, 30),
+        cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+
+
+class DetectorPool:
+    """
+    Bounded, thread-safe pool of DrowsinessDetector instances.
+
+    Detectors are created lazily up to `size` and recycled between sessions,
+    so the number of live FaceMesh graphs never exceeds the pool size.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_use(self) -> int:
+        return self._created - self._idle.qsize()
+
+    def acquire(self, timeout: float = 0):
+        """
+        Take a detector for a new session.
+
+        :param timeout: Seconds to wait for a free detector; 0 means do not wait
+        :return: A reset detector, or None if the pool is exhausted
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return DrowsinessDetector()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        if timeout <= 0:
+            return None
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, detector: DrowsinessDetector):
+        """Return a detector to the pool once its session has ended"""
+        detector.reset()
+        self._idle.put(detector)
+
+    def stats(self):
+        return {"size": self.size, "created": self._created, "in_use": self.in_use}
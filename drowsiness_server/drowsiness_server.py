@@ -1,20 +1,30 @@
-import cv2
-import numpy as np
-import mediapipe as mp  # Replace dlib with mediapipe
-from scipy.spatial import distance as dist
 import time
-import base64
 import json
-from fastapi import FastAPI, WebSocket, Request
+import uuid
+import hashlib
+from fastapi import FastAPI, WebSocket, Request, Header, HTTPException, Response, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import asyncio
 import uvicorn
 import os
+import shutil
+import tempfile
 import logging
-from twilio.rest import Client
 from pydantic import BaseModel
 from typing import List, Optional
 from dotenv import load_dotenv
+from frame_executor import FrameExecutor
+from batch_scheduler import BatchScheduler
+from video_analysis import VideoAnalyzer
+from session_store import create_session_store, worker_id
+from drowsiness_state import COOLDOWN_TIME
+from alert_outbox import AlertOutbox, LoggingSmsSender, TwilioSmsSender
+from telemetry import TelemetryRecorder, valid_trip_id
+import metrics
+from protocol import (PAYLOAD_LANDMARKS, PROTOCOL_BINARY, PROTOCOL_JSON, PROTOCOLS, RESPONSE_FRAME,
+                      RESPONSE_MODES, pack_landmarks, pack_result)
 
 load_dotenv()
 
@@ -53,220 +63,187 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Drowsiness detection parameters
-EYE_AR_THRESH = 0.3
-EYE_AR_CONSEC_FRAMES = 30
-COUNTER = 0
-ALARM_ON = False
-COOLDOWN_TIME = 300  # 5 minutes cooldown
-
-# Initialize MediaPipe FaceMesh
-mp_face_mesh = mp.solutions.face_mesh
-face_mesh = mp_face_mesh.FaceMesh(
-    static_image_mode=False,
-    max_num_faces=1,
-    min_detection_confidence=0.5,
-    min_tracking_confidence=0.5
+# Bounded pool of per-session detectors. Set DETECTOR_POOL_SIZE to an
+# integer, or to "auto" to size it to the number of CPU cores.
+def _detector_pool_size():
+    value = os.getenv("DETECTOR_POOL_SIZE", "32")
+    if value == "auto":
+        return os.cpu_count() or 1
+    return max(1, int(value))
+
+# Number of uvicorn worker processes sharing this machine (see start.sh)
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+
+# Frame pipeline execution stage: FRAME_EXECUTOR is one of inline, thread or
+# process; FRAME_WORKERS defaults to the CPU cores divided among the uvicorn
+# workers.
+frame_executor = FrameExecutor(
+    mode=os.getenv("FRAME_EXECUTOR", "process"),
+    workers=int(os.getenv("FRAME_WORKERS", 0)) or max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY),
+    pool_size=_detector_pool_size(),
 )
 
-# Define eye landmarks for MediaPipe (indexes are different from dlib)
-# These are the indexes for the eye landmarks in MediaPipe's 468 points model
-LEFT_EYE_INDEXES = [362, 385, 387, 263, 373, 380]
-RIGHT_EYE_INDEXES = [33, 160, 158, 133, 153, 144]
+# Micro-batching across sessions: frames arriving within BATCH_WINDOW_MS of
+# each other are sent to the workers together, up to BATCH_MAX_SIZE frames
+frame_scheduler = BatchScheduler(
+    frame_executor,
+    window_ms=float(os.getenv("BATCH_WINDOW_MS", 4)),
+    max_batch_size=int(os.getenv("BATCH_MAX_SIZE", 8)),
+)
 
-# Time of last alert
-last_alert_time = 0
+# Uploaded trip recordings are analyzed on their own process pool
+# (VIDEO_WORKERS, default one per core), in VIDEO_CHUNK_SECONDS chunks that
+# start VIDEO_CHUNK_OVERLAP seconds early to re-sync tracking
+video_analyzer = VideoAnalyzer(
+    workers=int(os.getenv("VIDEO_WORKERS", 0)) or None,
+    chunk_seconds=float(os.getenv("VIDEO_CHUNK_SECONDS", 10)),
+    overlap_seconds=float(os.getenv("VIDEO_CHUNK_OVERLAP", 1.0)),
+    keyframe_interval=int(os.getenv("KEYFRAME_INTERVAL", 1)),
+)
 
-# Connected clients
+# Connected clients of this worker
 connected_clients: List[WebSocket] = []
 
-# Calculate eye aspect ratio using MediaPipe landmarks
-def eye_aspect_ratio(landmarks, eye_indexes):
-    # Extract eye points using the indexes
-    points = [landmarks[i] for i in eye_indexes]
-    
-    # Horizontal distance (eye width)
-    h_dist = dist.euclidean(
-        (points[0].x, points[0].y), 
-        (points[3].x, points[3].y)
-    )
-    
-    # Two vertical distances
-    v_dist1 = dist.euclidean(
-        (points[1].x, points[1].y), 
-        (points[5].x, points[5].y)
-    )
-    v_dist2 = dist.euclidean(
-        (points[2].x, points[2].y), 
-        (points[4].x, points[4].y)
+# Session metadata, counters and alert cooldowns shared by all uvicorn
+# workers. SESSION_STORE is memory (single worker) or sqlite; it defaults to
+# sqlite when WEB_CONCURRENCY > 1. Live counters are written to the store
+# every SESSION_SYNC_INTERVAL seconds.
+session_store = create_session_store(
+    os.getenv("SESSION_STORE") or ("sqlite" if WEB_CONCURRENCY > 1 else "memory"),
+    os.getenv("SESSION_STORE_PATH", os.path.join(tempfile.gettempdir(), "drowsiness_sessions.db")),
+)
+SESSION_SYNC_INTERVAL = float(os.getenv("SESSION_SYNC_INTERVAL", 2.0))
+
+# Sessions opened with a trip_id have their EAR / drowsiness series and
+# statistics written under TELEMETRY_DIR (set it to an empty string to
+# disable recording). Session buffers hold TELEMETRY_BUFFER_SIZE frames and
+# are flushed when full or every TELEMETRY_FLUSH_INTERVAL seconds. Trips not
+# written to for TELEMETRY_RETENTION seconds (default 30 days, 0 keeps them
+# forever) are deleted; the check runs every TELEMETRY_PRUNE_INTERVAL seconds.
+TELEMETRY_DIR = os.getenv("TELEMETRY_DIR", "telemetry")
+telemetry_recorder = TelemetryRecorder(
+    TELEMETRY_DIR,
+    buffer_size=int(os.getenv("TELEMETRY_BUFFER_SIZE", 1024)),
+    flush_interval=float(os.getenv("TELEMETRY_FLUSH_INTERVAL", 10.0)),
+    retention=float(os.getenv("TELEMETRY_RETENTION", 30 * 86400)),
+) if TELEMETRY_DIR else None
+TELEMETRY_PRUNE_INTERVAL = float(os.getenv("TELEMETRY_PRUNE_INTERVAL", 3600))
+
+# SMS delivery backend: SMS_BACKEND=twilio (default) sends real messages,
+# SMS_BACKEND=log only logs them for local development
+def _create_sms_sender():
+    if os.getenv("SMS_BACKEND", "twilio") == "log":
+        return LoggingSmsSender()
+    return TwilioSmsSender(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER)
+
+# Alerts are delivered in the background; the frame path and the HTTP
+# endpoints only enqueue them
+alert_outbox = AlertOutbox(
+    _create_sms_sender(),
+    max_attempts=int(os.getenv("ALERT_MAX_ATTEMPTS", 3)),
+    retry_backoff=float(os.getenv("ALERT_RETRY_BACKOFF", 1.0)),
+    send_concurrency=int(os.getenv("ALERT_SEND_CONCURRENCY", 8)),
+    # Lets every worker answer /api/alerts/{alert_id}, for ALERT_STATUS_TTL seconds
+    status_store=session_store,
+    status_ttl=float(os.getenv("ALERT_STATUS_TTL", 86400)),
+)
+
+# Repeated accident posts for the same victim within ACCIDENT_DEDUP_WINDOW
+# seconds and ACCIDENT_LOCATION_PRECISION decimal degrees (3 is about 110 m)
+# of each other are treated as one accident, across all workers
+ACCIDENT_DEDUP_WINDOW = float(os.getenv("ACCIDENT_DEDUP_WINDOW", 300))
+ACCIDENT_LOCATION_PRECISION = int(os.getenv("ACCIDENT_LOCATION_PRECISION", 3))
+
+# Prometheus metrics: per-session frame counters and the pipeline stats,
+# both read when /metrics is scraped
+session_metrics = metrics.register(metrics.SessionCollector())
+metrics.register(metrics.PipelineCollector(frame_executor, frame_scheduler, alert_outbox))
+background_tasks: List[asyncio.Task] = []
+
+DROWSINESS_ALERT_MESSAGE = "DROWSINESS ALERT: The driver appears to be drowsy or falling asleep! Please check on them immediately."
+
+# Queue alerts to emergency contacts, at most once per COOLDOWN_TIME per
+# driver across all workers
+async def send_alerts(alert_key: str) -> bool:
+    claim_key = f"drowsiness:{alert_key}"
+    if not await run_in_threadpool(session_store.claim_alert, claim_key, COOLDOWN_TIME):
+        logger.info(f"Drowsiness alert for {alert_key} suppressed: still in cooldown")
+        return False
+    logger.info("ALERT: Driver is drowsy! Queueing notifications to emergency contacts")
+    # One alert per episode: claims of a key are at least COOLDOWN_TIME
+    # apart, so each falls in its own cooldown period
+    alert_outbox.enqueue(
+        "drowsiness", DROWSINESS_ALERT_MESSAGE, emergency_contacts,
+        idempotency_key=f"{claim_key}:{int(time.time() // COOLDOWN_TIME)}"
     )
-    
-    # Calculate EAR
-    ear = (v_dist1 + v_dist2) / (2.0 * h_dist)
-    return ear
-
-# Send alerts to emergency contacts
-def send_alerts():
-    logger.info("ALERT: Driver is drowsy! Sending notifications to emergency contacts")
-    successful_sends = 0
-    
-    try:
-        # Uncomment this section in production and add your Twilio credentials
-        account_sid = TWILIO_ACCOUNT_SID
-        auth_token = TWILIO_AUTH_TOKEN
-        from_number = TWILIO_PHONE_NUMBER  # Your Twilio number
-        
-        client = Client(account_sid, auth_token)
-        
-        for contact in emergency_contacts:
-            try:
-                # Uncomment this for actual SMS sending
-                message = client.messages.create(
-                    body="DROWSINESS ALERT: The driver appears to be drowsy or falling asleep! Please check on them immediately.",
-                    from_=from_number,
-                    to=contact
-                )
-                logger.info(f"Alert sent to {contact}: {message.sid}")
-                
-                # For development/testing without SMS
-                # logger.info(f"Would send alert to {contact} in production mode")
-                successful_sends += 1
-            except Exception as e:
-                logger.error(f"Failed to send alert to {contact}: {e}")
-    except Exception as e:
-        logger.error(f"Error initializing SMS client: {e}")
-    
-    return successful_sends
+    return True
+
+class LatestFrameMailbox:
+    """
+    One-slot mailbox between a session's receive task and its processing task.
+
+    A new frame replaces any frame that has not been picked up yet, so under
+    overload the processor always works on the newest frame and latency stays
+    bounded instead of growing with the socket backlog.
+    """
 
-# Decode base64 image
-def decode_base64_image(base64_img):
+    def __init__(self):
+        self._item = None
+        self._event = asyncio.Event()
+        self._closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, item):
+        self.received += 1
+        if self._item is not None:
+            self.dropped += 1
+        self._item = item
+        self._event.set()
+
+    def close(self):
+        self._closed = True
+        self._event.set()
+
+    async def get(self):
+        """Wait for the newest item; returns None once closed and drained"""
+        while self._item is None:
+            if self._closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        item, self._item = self._item, None
+        return item
+
+# Read frames off the socket as fast as they arrive and keep only the newest
+async def receive_frames(websocket: WebSocket, binary: bool, mailbox: LatestFrameMailbox):
+    frame_id = 0
     try:
-        # Remove data URL prefix if present
-        if "," in base64_img:
-            base64_img = base64_img.split(",")[1]
-        
-        # Decode base64
-        img_bytes = base64.b64decode(base64_img)
-        img_np = np.frombuffer(img_bytes, dtype=np.uint8)
-        
-        # Decode image
-        frame = cv2.imdecode(img_np, cv2.IMREAD_COLOR)
-        return frame
-    except Exception as e:
-        logger.error(f"Error decoding base64 image: {e}")
-        return None
+        while True:
+            if binary:
+                # Receive the raw JPEG bytes of one frame
+                frame_data = await websocket.receive_bytes()
+            else:
+                # Receive base64 encoded frame from client
+                data = await websocket.receive_text()
+                started = time.perf_counter()
+                try:
+                    json_data = json.loads(data)
+                except json.JSONDecodeError:
+                    logger.error("Error decoding JSON data from client")
+                    continue
+                metrics.observe_stage("json_parse", time.perf_counter() - started)
 
-# Process frame for drowsiness detection using MediaPipe
-def process_frame(frame):
-    global COUNTER, ALARM_ON, last_alert_time
-    
-    if frame is None:
-        logger.warning("Received empty frame")
-        return None, {
-            "isDrowsy": False,
-            "earValue": 0,
-            "drowsinessPercentage": 0,
-            "alertSent": False,
-            "hasDetectedFace": False
-        }
-    
-    # Convert to RGB for MediaPipe
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    
-    # Process the frame
-    results = face_mesh.process(frame_rgb)
-    
-    # Initialize result dictionary
-    detection_results = {
-        "isDrowsy": False,
-        "earValue": 0,
-        "drowsinessPercentage": 0,
-        "alertSent": False,
-        "hasDetectedFace": False
-    }
-    
-    # Check if face is detected
-    if results.multi_face_landmarks:
-        detection_results["hasDetectedFace"] = True
-        
-        # Get landmarks for the first face
-        face_landmarks = results.multi_face_landmarks[0]
-        
-        # Get frame dimensions for drawing
-        h, w, c = frame.shape
-        
-        # Draw eye landmarks for visualization
-        for idx in LEFT_EYE_INDEXES + RIGHT_EYE_INDEXES:
-            landmark = face_landmarks.landmark[idx]
-            x, y = int(landmark.x * w), int(landmark.y * h)
-            cv2.circle(frame, (x, y), 2, (0, 255, 0), -1)
-        
-        # Calculate EAR for left and right eyes
-        left_ear = eye_aspect_ratio(face_landmarks.landmark, LEFT_EYE_INDEXES)
-        right_ear = eye_aspect_ratio(face_landmarks.landmark, RIGHT_EYE_INDEXES)
-        
-        # Average EAR
-        ear = (left_ear + right_ear) / 2.0
-        detection_results["earValue"] = ear
-        
-        # Draw eye contours and connections for visualization
-        def draw_eye(landmarks, indexes, color=(0, 255, 0)):
-            points = []
-            for idx in indexes:
-                landmark = landmarks.landmark[idx]
-                x, y = int(landmark.x * w), int(landmark.y * h)
-                points.append((x, y))
-            
-            points = np.array(points, dtype=np.int32)
-            cv2.polylines(frame, [points], True, color, 1)
-        
-        # Draw eye contours
-        draw_eye(face_landmarks, LEFT_EYE_INDEXES, (0, 255, 0))
-        draw_eye(face_landmarks, RIGHT_EYE_INDEXES, (0, 255, 0))
-        
-        # Add EAR text
-        cv2.putText(frame, f"EAR: {ear:.2f}", (10, 30),
-            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 0), 2)
-        
-        # Check if eyes are closed
-        if ear < EYE_AR_THRESH:
-            COUNTER += 1
-            drowsiness_percentage = min(100, (COUNTER / EYE_AR_CONSEC_FRAMES) * 100)
-            detection_results["drowsinessPercentage"] = drowsiness_percentage
-            
-            # Add drowsiness percentage text
-            cv2.putText(frame, f"Drowsiness: {drowsiness_percentage:.0f}%", (10, 60),
-                cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-            
-            if COUNTER >= EYE_AR_CONSEC_FRAMES:
-                current_time = time.time()
-                detection_results["isDrowsy"] = True
-                
-                # Add ALERT text
-                cv2.putText(frame, "DROWSINESS ALERT!", (10, 90),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                
-                # Send alert if not in cooldown period
-                if not ALARM_ON and (current_time - last_alert_time) > COOLDOWN_TIME:
-                    ALARM_ON = True
-                    last_alert_time = current_time
-                    
-                    # Send alerts
-                    successful_sends = send_alerts()
-                    logger.info(f"Successfully sent alerts to {successful_sends} contacts")
-                    detection_results["alertSent"] = True
-        else:
-            COUNTER = 0
-            ALARM_ON = False
-            detection_results["drowsinessPercentage"] = 0
-    
-    # Add face detection status text
-    face_text = "Face Detected" if detection_results["hasDetectedFace"] else "No Face Detected"
-    color = (0, 255, 0) if detection_results["hasDetectedFace"] else (0, 0, 255)
-    cv2.putText(frame, face_text, (frame.shape[1] - 200, 30),
-        cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
-    
-    return frame, detection_results
+                if "frame" not in json_data:
+                    logger.warning("Received data without frame field")
+                    continue
+                frame_data = json_data["frame"]
+
+            frame_id += 1
+            # Arrival time drives the time-based drowsiness window
+            mailbox.put((frame_id, frame_data, time.monotonic()))
+    finally:
+        mailbox.close()
 
 # WebSocket endpoint to process video frames
 @app.websocket("/ws/drowsiness")
@@ -274,66 +251,138 @@ async def drowsiness_detection(websocket: WebSocket):
     global connected_clients
     
     await websocket.accept()
+
+    # Frame protocol is negotiated once per connection; JSON stays the default
+    # so existing clients keep working
+    protocol = websocket.query_params.get("protocol", PROTOCOL_JSON)
+    if protocol not in PROTOCOLS:
+        await websocket.close(code=1008, reason=f"Unsupported protocol {protocol!r}")
+        return
+    binary = protocol == PROTOCOL_BINARY
+
+    # Results-only clients draw their own overlay from the eye landmarks
+    response_mode = websocket.query_params.get("response", RESPONSE_FRAME)
+    if response_mode not in RESPONSE_MODES:
+        await websocket.close(code=1008, reason=f"Unsupported response mode {response_mode!r}")
+        return
+    annotate = response_mode == RESPONSE_FRAME
+
+    # Frames of all sessions with the same trip_id go to one telemetry trip;
+    # sessions without one are not recorded
+    trip_id = websocket.query_params.get("trip_id")
+    if trip_id is not None and not valid_trip_id(trip_id):
+        await websocket.close(code=1008, reason="trip_id must be 1-64 letters, digits, '-' or '_'")
+        return
+
+    # Sessions are only accepted once the workers are warm
+    if not frame_executor.ready:
+        await websocket.close(code=1013, reason="Server is warming up, try again later")
+        return
+
+    # Each session gets its own detector, pinned to one executor worker
+    session_id = uuid.uuid4().hex
+    if not await frame_executor.open_session(session_id):
+        logger.warning(f"Detector pool exhausted ({frame_executor.pool_size} in use), rejecting connection")
+        await websocket.close(code=1013, reason="Server at capacity, try again later")
+        return
+
+    # Alert cooldowns follow the driver across reconnects and workers when
+    # the client identifies them
+    driver_id = websocket.query_params.get("driver_id")
+    alert_key = driver_id or session_id
+    await run_in_threadpool(session_store.open_session, session_id,
+                            {"driver_id": driver_id, "protocol": protocol, "response_mode": response_mode})
+
     connected_clients.append(websocket)
-    logger.info(f"WebSocket connection established. Total connections: {len(connected_clients)}")
+    logger.info(f"WebSocket connection established ({protocol} protocol, {response_mode} responses). "
+                f"Worker connections: {len(connected_clients)}")
     
+    mailbox = LatestFrameMailbox()
+    frame_metrics = session_metrics.open(session_id, mailbox)
+    telemetry = telemetry_recorder.open(trip_id, session_id) if telemetry_recorder and trip_id else None
+    receiver = asyncio.create_task(receive_frames(websocket, binary, mailbox))
+    reported_dropped = 0
     try:
         while True:
-            # Receive base64 encoded frame from client
-            data = await websocket.receive_text()
-            
+            item = await mailbox.get()
+            if item is None:
+                break
+            frame_id, frame_data, received_at = item
+
             try:
-                json_data = json.loads(data)
+                # Decode, process and re-encode the frame off the event loop
+                output = await frame_scheduler.submit(session_id, frame_data, annotate, received_at)
                 
-                if "frame" not in json_data:
-                    logger.warning("Received data without frame field")
+                if output is None:
                     continue
-                    
-                # Decode base64 image
-                frame = decode_base64_image(json_data["frame"])
                 
-                if frame is None:
+                results, processed_frame, timings = output
+                metrics.observe_stages(timings)
+                frame_metrics.frame_processed(results["hasDetectedFace"])
+
+                if results["alertSent"]:
+                    results["alertSent"] = await send_alerts(alert_key)
+                    frame_metrics.alerts += results["alertSent"]
+
+                if telemetry is not None and telemetry.record(received_at, results):
+                    telemetry_recorder.flush(telemetry)
+
+                # Frames replaced in the mailbox since the previous response
+                dropped_frames = mailbox.dropped - reported_dropped
+                reported_dropped = mailbox.dropped
+
+                if binary:
+                    if annotate:
+                        message = pack_result(frame_id, results, processed_frame, dropped_frames)
+                    else:
+                        message = pack_result(frame_id, results, pack_landmarks(results["eyeLandmarks"]),
+                                              dropped_frames, PAYLOAD_LANDMARKS)
+                    started = time.perf_counter()
+                    await websocket.send_bytes(message)
+                    metrics.observe_stage("send", time.perf_counter() - started)
                     continue
                 
-                # Process the frame
-                processed_frame, results = process_frame(frame)
+                # Send the results and processed frame back to the client
+                response = {
+                    "is_drowsy": results["isDrowsy"],
+                    "ear": results["earValue"],
+                    "drowsiness_percentage": results["drowsinessPercentage"],
+                    "eyes_closed_seconds": results["eyesClosedSeconds"],
+                    "perclos": results["perclos"],
+                    "alert_sent": results["alertSent"],
+                    "face_detected": results["hasDetectedFace"],
+                    "dropped_frames": dropped_frames,
+                    "total_dropped_frames": mailbox.dropped
+                }
+                if annotate:
+                    response["processedFrame"] = f"data:image/jpeg;base64,{processed_frame}"
+                else:
+                    response["eye_landmarks"] = results["eyeLandmarks"]
                 
-                if processed_frame is not None:
-                    # Encode the processed frame to send back to client
-                    _, buffer = cv2.imencode('.jpg', processed_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                    processed_frame_base64 = base64.b64encode(buffer).decode('utf-8')
-                    
-                    # Send the results and processed frame back to the client
-                    response = {
-                        "is_drowsy": results["isDrowsy"],
-                        "ear": results["earValue"],
-                        "drowsiness_percentage": results["drowsinessPercentage"],
-                        "alert_sent": results["alertSent"],
-                        "face_detected": results["hasDetectedFace"],
-                        "processedFrame": f"data:image/jpeg;base64,{processed_frame_base64}"
-                    }
-                    
-                    await websocket.send_json(response)
-            except json.JSONDecodeError:
-                logger.error("Error decoding JSON data from client")
+                started = time.perf_counter()
+                await websocket.send_json(response)
+                metrics.observe_stage("send", time.perf_counter() - started)
             except Exception as e:
                 logger.error(f"Error processing frame: {e}")
-            
+
+        # Surface the reason the receive task stopped (usually a disconnect)
+        await receiver
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
     finally:
+        receiver.cancel()
+        await frame_executor.close_session(session_id)
+        session_metrics.close(session_id)
+        if telemetry is not None:
+            telemetry_recorder.flush(telemetry)
+        await run_in_threadpool(session_store.close_session, session_id)
         if websocket in connected_clients:
             connected_clients.remove(websocket)
-        logger.info(f"WebSocket connection closed. Remaining connections: {len(connected_clients)}")
+        logger.info(f"WebSocket connection closed. Received {mailbox.received} frames, dropped {mailbox.dropped}. "
+                    f"Worker connections: {len(connected_clients)}")
 
-def send_accident_alerts(alert_data: AccidentAlert):
-    """Send SMS alerts to emergency contacts when an accident is detected"""
-    logger.info("EMERGENCY ALERT: Accident detected! Sending notifications to emergency contacts")
-    
-    # Use provided emergency contacts or fall back to defaults
-    contacts = alert_data.emergencyContacts or emergency_contacts
-    logger.info(f"Using emergency contacts: {contacts}")
-    
+def build_accident_message(alert_data: AccidentAlert) -> str:
+    """Build the SMS body sent to emergency contacts when an accident is detected"""
     # Construct location link if coordinates are valid
     location_link = "Location unavailable"
     if len(alert_data.location) >= 2 and alert_data.location[0] != 0 and alert_data.location[1] != 0:
@@ -351,64 +400,222 @@ def send_accident_alerts(alert_data: AccidentAlert):
         message += "Vehicle was exceeding speed limit before the incident.\n"
     
     message += "Please respond immediately or contact emergency services!"
-    
-    successful_sends = 0
-    
-    try:
-        # Twilio credentials
-        account_sid = TWILIO_ACCOUNT_SID
-        auth_token = TWILIO_AUTH_TOKEN
-        from_number = TWILIO_PHONE_NUMBER  # Your Twilio number
-        
-        client = Client(account_sid, auth_token)
-        
-        for contact in contacts:
-            try:
-                # Send the SMS
-                sms = client.messages.create(
-                    body=message,
-                    from_=from_number,
-                    to=contact
-                )
-                logger.info(f"Accident alert sent to {contact}: {sms.sid}")
-                successful_sends += 1
-            except Exception as e:
-                logger.error(f"Failed to send accident alert to {contact}: {e}")
-    except Exception as e:
-        logger.error(f"Error initializing SMS client: {e}")
-    
-    return {
-        "success": successful_sends > 0,
-        "sent_count": successful_sends,
-        "total_contacts": len(contacts),
-        "message": message
-    }
+    return message
+
+# Identifies an accident by victim and location bucket, so client retries and
+# sensor bounce map to the same key
+def accident_dedup_key(alert_data: AccidentAlert) -> str:
+    victim = " ".join(alert_data.victimDetails.lower().split())
+    location = ",".join(f"{round(c, ACCIDENT_LOCATION_PRECISION):.{ACCIDENT_LOCATION_PRECISION}f}"
+                        for c in alert_data.location[:2])
+    return "accident:" + hashlib.sha256(f"{victim}|{location}".encode()).hexdigest()[:32]
 
 # Add this endpoint to handle accident alerts
 @app.post("/api/accident-alert")
-async def accident_alert(alert_data: AccidentAlert):
-    """Endpoint to handle accident alerts and send SMS notifications"""
+async def accident_alert(alert_data: AccidentAlert, idempotency_key: Optional[str] = Header(None)):
+    """Endpoint to handle accident alerts; SMS notifications are delivered in the background"""
     logger.info(f"Received accident alert: {alert_data}")
     
-    # Send alerts to emergency contacts
-    result = send_accident_alerts(alert_data)
+    # Use provided emergency contacts or fall back to defaults
+    contacts = alert_data.emergencyContacts or emergency_contacts
+
+    # The first post of an accident claims its keys for the dedup window: the
+    # client's Idempotency-Key header, if any, and the accident's content
+    # key. Repeats under either get the original alert id back without
+    # sending anything; a retry with the same header always does, even if
+    # its content changed.
+    keys = [f"accident-request:{idempotency_key}"] if idempotency_key else []
+    keys.append(accident_dedup_key(alert_data))
+    alert_id = uuid.uuid4().hex
+    claimed_id = await run_in_threadpool(session_store.claim_idempotency_keys, keys, alert_id,
+                                         ACCIDENT_DEDUP_WINDOW)
+    if claimed_id != alert_id:
+        logger.info(f"Duplicate accident alert, already handled as {claimed_id}")
+        status = await get_alert_status(claimed_id)
+        return {
+            "success": True,
+            "alert_id": claimed_id,
+            "duplicate": True,
+            "message": "Accident alert already received",
+            # The claiming worker may not have published the alert yet
+            "details": {"status": status["status"] if status else "queued"}
+        }
+
+    logger.info("EMERGENCY ALERT: Accident detected! Queueing notifications to emergency contacts")
+    logger.info(f"Using emergency contacts: {contacts}")
+    message = build_accident_message(alert_data)
+    alert_outbox.enqueue("accident", message, contacts, alert_id=alert_id)
     
     return {
-        "success": result["success"],
-        "message": f"Accident alert sent to {result['sent_count']} of {result['total_contacts']} emergency contacts",
-        "details": result
+        "success": True,
+        "alert_id": alert_id,
+        "duplicate": False,
+        "message": f"Accident alert queued for {len(contacts)} emergency contacts",
+        "details": {
+            "status": alert_outbox.status(alert_id)["status"],
+            "total_contacts": len(contacts),
+            "message": message
+        }
     }
 
+# This worker's own alerts are answered from memory, the others' from the
+# shared session store
+async def get_alert_status(alert_id: str) -> Optional[dict]:
+    status = alert_outbox.status(alert_id)
+    if status is None:
+        status = await run_in_threadpool(session_store.alert_status, alert_id)
+    return status
+
+@app.get("/api/alerts/{alert_id}")
+async def alert_status(alert_id: str):
+    """Delivery status of a queued drowsiness or accident alert, queued by any worker"""
+    status = await get_alert_status(alert_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown alert id")
+    return status
+
 
 @app.get("/")
 def read_root():
     return {
         "message": "Drowsiness detection server is running",
         "status": "online",
-        "connections": len(connected_clients),
-        "detector_status": "available" if face_mesh is not None else "unavailable"
+        "connections": session_store.connection_count(),
+        "worker": worker_id(),
+        "worker_connections": len(connected_clients),
+        "detector_status": "available" if frame_executor.active_sessions < frame_executor.pool_size else "at capacity",
+        "executor": frame_executor.stats(),
+        "batching": frame_scheduler.stats(),
+        "alerts": alert_outbox.stats(),
+        "telemetry": telemetry_recorder.stats() if telemetry_recorder else None
     }
 
+@app.get("/api/sessions")
+def list_sessions():
+    """Live sessions of all workers, with their frame and alert counters"""
+    return {"sessions": session_store.sessions()}
+
+@app.get("/api/trips/{trip_id}/stats")
+def trip_stats(trip_id: str):
+    """Aggregated EAR and drowsiness statistics of a trip, from its recorded telemetry"""
+    if telemetry_recorder is None:
+        raise HTTPException(status_code=404, detail="Telemetry recording is disabled")
+    if not valid_trip_id(trip_id):
+        raise HTTPException(status_code=400, detail="Invalid trip id")
+    stats = telemetry_recorder.trip_stats(trip_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Unknown trip id")
+    return stats
+
+# Copy an upload to a temporary file OpenCV can open by path
+def save_upload(upload, suffix: str) -> str:
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        shutil.copyfileobj(upload, f, length=1024 * 1024)
+        return f.name
+
+@app.post("/api/videos/analyze")
+async def analyze_video(file: UploadFile = File(...)):
+    """
+    Analyze an uploaded dashcam or cabin recording. The per-frame EAR and
+    drowsiness series and the drowsiness events are streamed back as
+    newline-delimited JSON while the video is processed.
+    """
+    path = await run_in_threadpool(save_upload, file.file, os.path.splitext(file.filename or "")[1] or ".mp4")
+    try:
+        await video_analyzer.probe(path)
+    except ValueError:
+        os.remove(path)
+        raise HTTPException(status_code=400, detail="Could not read the uploaded video")
+
+    async def stream():
+        try:
+            async for message in video_analyzer.analyze(path):
+                yield json.dumps(message) + "\n"
+        except Exception as e:
+            logger.error(f"Video analysis of {file.filename} failed: {e}")
+            yield json.dumps({"type": "error", "message": str(e)}) + "\n"
+        finally:
+            os.remove(path)
+
+    logger.info(f"Analyzing uploaded video {file.filename}")
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Pipeline stage histograms, frame counters and server stats in Prometheus text format"""
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/livez")
+def livez():
+    """Liveness: the process is up and serving requests"""
+    return {"status": "alive"}
+
+@app.get("/readyz")
+def readyz(response: Response):
+    """Readiness: every frame worker has been warmed up and can take sessions"""
+    if not frame_executor.ready:
+        response.status_code = 503
+        return {"status": "warming up"}
+    return {"status": "ready", "warm_up_seconds": frame_executor.warm_up_seconds}
+
+# Periodically write this worker's session counters to the shared store,
+# which also keeps its sessions from expiring
+async def sync_session_store():
+    while True:
+        await asyncio.sleep(SESSION_SYNC_INTERVAL)
+        counts = {
+            session_id: {"received": session.mailbox.received, "processed": session.processed,
+                         "dropped": session.mailbox.dropped, "alerts": session.alerts}
+            for session_id, session in session_metrics.sessions.items()
+        }
+        try:
+            await run_in_threadpool(session_store.sync_sessions, counts)
+        except Exception as e:
+            logger.error(f"Failed to sync sessions to the store: {e}")
+
+# Delete telemetry trips past their retention
+async def prune_telemetry():
+    while True:
+        try:
+            pruned = await run_in_threadpool(telemetry_recorder.prune)
+            if pruned:
+                logger.info(f"Deleted {pruned} telemetry trips older than the retention period")
+        except Exception as e:
+            logger.error(f"Failed to prune telemetry: {e}")
+        await asyncio.sleep(TELEMETRY_PRUNE_INTERVAL)
+
+async def warm_up_workers():
+    started = time.perf_counter()
+    try:
+        await frame_executor.warm_up()
+    except Exception:
+        logger.exception("Frame worker warm-up failed; a lane whose worker died reports ready once it is "
+                         "restarted and warm")
+        return
+    logger.info(f"{frame_executor.workers} frame workers warm after {time.perf_counter() - started:.2f}s")
+
+@app.on_event("startup")
+async def start_background_work():
+    await alert_outbox.start()
+    background_tasks.append(asyncio.create_task(metrics.monitor_event_loop_lag()))
+    background_tasks.append(asyncio.create_task(sync_session_store()))
+    if telemetry_recorder is not None and telemetry_recorder.retention:
+        background_tasks.append(asyncio.create_task(prune_telemetry()))
+    # Warm up in the background so /livez answers while the workers start
+    background_tasks.append(asyncio.create_task(warm_up_workers()))
+
+@app.on_event("shutdown")
+async def shutdown_background_work():
+    for task in background_tasks:
+        task.cancel()
+    await alert_outbox.stop()
+    if telemetry_recorder is not None:
+        await telemetry_recorder.drain()
+    frame_executor.shutdown()
+    video_analyzer.shutdown()
+    session_store.close()
+
 # For testing only: add a simple endpoint to test if the API is working
 @app.get("/api/ping")
 def ping():
@@ -0,0 +1,133 @@
+"""
+Drowsiness decision from per-frame EAR values.
+
+Kept apart from the FaceMesh / OpenCV pipeline in detector.py, so the
+server process, the video analyzer and telemetry can use the parameters
+and DrowsinessState without importing cv2 or mediapipe.
+"""
+import time
+
+import numpy as np
+
+# Drowsiness detection parameters. Eyes count as closed below
+# EYE_AR_THRESH; the driver is drowsy once the eyes stay closed for
+# EYE_CLOSED_SECONDS, or when the eyes were closed for PERCLOS_THRESH of the
+# last PERCLOS_WINDOW seconds. Both are measured on frame timestamps, so the
+# verdict does not depend on the client's frame rate.
+EYE_AR_THRESH = 0.3
+EYE_CLOSED_SECONDS = 1.0
+PERCLOS_WINDOW = 60.0
+PERCLOS_THRESH = 0.3
+PERCLOS_MIN_COVERAGE = 0.5  # fraction of the window that must be observed before PERCLOS counts
+MAX_SAMPLE_GAP = 1.0  # seconds a sample stands for at most (e.g. across face-lost gaps)
+CLOSURE_BUFFER_SIZE = 2048  # samples kept per session; 60 s at 30 fps fits
+COOLDOWN_TIME = 300  # 5 minutes cooldown
+
+
+class EyeClosureWindow:
+    """
+    Timestamped ring buffer of eye-closed samples for one session.
+
+    Samples are kept in preallocated NumPy arrays. PERCLOS is time-weighted:
+    every sample stands for the time until the next one (capped at
+    MAX_SAMPLE_GAP), so irregular or low frame rates give the same result as
+    a steady 30 fps stream.
+    """
+
+    def __init__(self, window: float = PERCLOS_WINDOW, capacity: int = CLOSURE_BUFFER_SIZE):
+        self.window = window
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.closed = np.zeros(capacity, dtype=bool)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.closed_since = None
+
+    def add(self, timestamp: float, closed: bool):
+        if self.count and timestamp - self.timestamps[(self.count - 1) % len(self.timestamps)] > MAX_SAMPLE_GAP:
+            # A long gap breaks the current closure
+            self.closed_since = None
+
+        i = self.count % len(self.timestamps)
+        self.timestamps[i] = timestamp
+        self.closed[i] = closed
+        self.count += 1
+
+        if not closed:
+            self.closed_since = None
+        elif self.closed_since is None:
+            self.closed_since = timestamp
+
+    def closed_duration(self, now: float) -> float:
+        """Seconds the eyes have been closed without interruption"""
+        return now - self.closed_since if self.closed_since is not None else 0.0
+
+    def perclos(self, now: float):
+        """
+        :return: (fraction of the window with eyes closed, fraction of the
+                 window covered by samples)
+        """
+        n = min(self.count, len(self.timestamps))
+        # Samples in chronological order
+        order = np.arange(self.count - n, self.count) % len(self.timestamps)
+        timestamps = self.timestamps[order]
+        recent = timestamps >= now - self.window
+        timestamps, closed = timestamps[recent], self.closed[order][recent]
+        if timestamps.size == 0:
+            return 0.0, 0.0
+
+        durations = np.minimum(np.diff(timestamps, append=now), MAX_SAMPLE_GAP)
+        observed = durations.sum()
+        if observed <= 0:
+            return 0.0, 0.0
+        return float(durations[closed].sum() / observed), float(observed / self.window)
+
+
+class DrowsinessState:
+    """
+    Drowsiness decision for one driver: eye closure window, alarm flag and
+    alert cooldown. Needs only the per-frame EAR and timestamp, so it can run
+    apart from FaceMesh (e.g. over EARs measured in parallel video chunks).
+    """
+
+    def __init__(self):
+        self.closure = EyeClosureWindow()
+        self.reset()
+
+    def reset(self):
+        self.closure.reset()
+        self.alarm_on = False
+        self.last_alert_time = None
+
+    # Record one frame's EAR; returns the isDrowsy, drowsinessPercentage,
+    # eyesClosedSeconds, perclos and alertSent results
+    def update(self, ear, timestamp=None):
+        # Record whether the eyes are closed and measure closure over time
+        now = time.monotonic() if timestamp is None else timestamp
+        self.closure.add(now, ear < EYE_AR_THRESH)
+        closed_seconds = self.closure.closed_duration(now)
+        perclos, coverage = self.closure.perclos(now)
+        if coverage < PERCLOS_MIN_COVERAGE:
+            perclos = 0.0
+
+        results = {
+            "isDrowsy": False,
+            "drowsinessPercentage": min(100, max(closed_seconds / EYE_CLOSED_SECONDS, perclos / PERCLOS_THRESH) * 100),
+            "eyesClosedSeconds": closed_seconds,
+            "perclos": perclos,
+            "alertSent": False,
+        }
+
+        if closed_seconds >= EYE_CLOSED_SECONDS or perclos >= PERCLOS_THRESH:
+            results["isDrowsy"] = True
+
+            # Flag an alert if not in cooldown period
+            if not self.alarm_on and (self.last_alert_time is None or now - self.last_alert_time > COOLDOWN_TIME):
+                self.alarm_on = True
+                self.last_alert_time = now
+                results["alertSent"] = True
+        else:
+            self.alarm_on = False
+
+        return results
@@ -0,0 +1,340 @@
+import asyncio
+import base64
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_MODES = ("inline", "thread", "process")
+
+# Size of the synthetic frame each worker runs once at startup
+WARM_UP_FRAME_SIZE = (480, 640)
+
+# Worker-side state. In process mode every worker process has its own pool
+# and session table; in inline/thread mode they are shared by all lanes of
+# the server process (DetectorPool is thread-safe, and a session is only ever
+# touched by the single thread of its lane).
+#
+# cv2 and the detector module are imported inside the worker functions: in
+# process mode they are only ever loaded by the worker processes, not by
+# the server process.
+_detector_pool = None
+_sessions = {}
+
+
+def _init_worker(pool_size: int):
+    from detector import DetectorPool
+
+    global _detector_pool
+    _detector_pool = DetectorPool(pool_size)
+
+
+def _warm_up_worker() -> float:
+    """
+    Build a detector and run the whole pipeline once on a synthetic frame, so
+    the first real frame does not pay for importing mediapipe, starting the
+    FaceMesh graph and initializing the JPEG codecs.
+
+    :return: Seconds the warm-up took
+    """
+    started = time.perf_counter()
+    detector = _detector_pool.acquire()
+    if detector is None:
+        return 0.0
+    try:
+        frame = np.full(WARM_UP_FRAME_SIZE + (3,), 128, dtype=np.uint8)
+        frame = _decode_frame(_encode_frame(frame, binary=True))
+        detector.process_frame(frame, annotate=True)
+    finally:
+        _detector_pool.release(detector)
+    return time.perf_counter() - started
+
+
+def _open_session(session_id: str) -> bool:
+    detector = _detector_pool.acquire()
+    if detector is None:
+        return False
+    _sessions[session_id] = detector
+    return True
+
+
+def _close_session(session_id: str):
+    detector = _sessions.pop(session_id, None)
+    if detector is not None:
+        _detector_pool.release(detector)
+
+
+def _decode_frame(frame_data, timings=None, min_size=None):
+    from detector import add_timing, decode_base64_payload, decode_image_bytes
+
+    if not isinstance(frame_data, (bytes, bytearray, memoryview)):
+        started = time.perf_counter()
+        frame_data = decode_base64_payload(frame_data)
+        add_timing(timings, "base64_decode", started)
+        if frame_data is None:
+            return None
+
+    started = time.perf_counter()
+    frame = decode_image_bytes(frame_data, min_size)
+    add_timing(timings, "jpeg_decode", started)
+    return frame
+
+
+# Encode an annotated frame in the same form its input arrived in
+def _encode_frame(frame, binary: bool, timings=None):
+    import cv2
+
+    from detector import add_timing
+
+    started = time.perf_counter()
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    encoded = buffer.tobytes() if binary else base64.b64encode(buffer).decode('utf-8')
+    add_timing(timings, "encode", started)
+    return encoded
+
+
+def _run_batch(jobs):
+    """
+    Run the decode -> FaceMesh -> annotate -> encode pipeline for a
+    micro-batch of (session_id, frame_data, annotate, timestamp) jobs in one
+    worker call.
+
+    FaceMesh runs per frame (each session has its own tracker), while the EAR
+    of every detected face in the batch is computed in one vectorized call.
+
+    Per job, frame_data is raw JPEG bytes (binary protocol) or a base64,
+    optionally data-URL, encoded JPEG string (JSON protocol); with annotate
+    False the drawing and JPEG encode are skipped entirely; timestamp is the
+    time.monotonic() arrival time used for the time-based drowsiness window.
+
+    :return: One entry per job: (results, annotated JPEG in the form the frame
+             arrived in or None when not annotating, stage timings in
+             seconds), None for frames that could not be decoded, or the
+             exception that job raised
+    """
+    from detector import add_timing, annotate_frame, decode_min_size, eye_aspect_ratios
+
+    outputs = [None] * len(jobs)
+    frames = [None] * len(jobs)
+    timings = [{} for _ in jobs]
+    detected = {}
+
+    for i, (session_id, frame_data, annotate, _) in enumerate(jobs):
+        try:
+            frames[i] = _decode_frame(frame_data, timings[i], decode_min_size(annotate))
+            if frames[i] is not None:
+                detected[i] = _sessions[session_id].detect_eyes(frames[i], timings[i])
+        except Exception as e:
+            outputs[i] = e
+
+    found = [i for i, points in detected.items() if points is not None]
+    ears = {}
+    if found:
+        batch_ears = eye_aspect_ratios(np.stack([detected[i] for i in found])).mean(axis=1)
+        ears = dict(zip(found, batch_ears.tolist()))
+
+    for i, (session_id, frame_data, annotate, timestamp) in enumerate(jobs):
+        if i not in detected:
+            continue
+        try:
+            results = _sessions[session_id].update(detected[i], ears.get(i, 0), timestamp)
+            if annotate:
+                started = time.perf_counter()
+                annotate_frame(frames[i], results)
+                add_timing(timings[i], "annotate", started)
+                outputs[i] = (results, _encode_frame(frames[i], not isinstance(frame_data, str), timings[i]),
+                              timings[i])
+            else:
+                outputs[i] = (results, None, timings[i])
+        except Exception as e:
+            outputs[i] = e
+
+    return outputs
+
+
+class FrameExecutor:
+    """
+    Execution stage for the per-frame pipeline.
+
+    Work is spread over `workers` lanes, each a single-worker executor. A
+    session is pinned to one lane when it opens, so its detector (and the
+    FaceMesh tracking state inside it) always stays on the same worker.
+
+    Modes:
+      - inline: run on the event loop (previous behaviour, for debugging)
+      - thread: one thread per lane, sharing the server's detector pool
+      - process: one worker process per lane, each with its own detector pool
+
+    If a lane's worker process dies (e.g. a native crash in MediaPipe or
+    OpenCV), the lane is rebuilt with a fresh, warmed-up worker and its
+    sessions are reopened there, losing only their tracking state. The
+    executor reports not ready until every lane is back.
+    """
+
+    def __init__(self, mode: str = "process", workers: int = None, pool_size: int = 32):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f"Unknown executor mode {mode!r}, expected one of {EXECUTOR_MODES}")
+
+        self.mode = mode
+        self.workers = 1 if mode == "inline" else max(1, workers or os.cpu_count() or 1)
+        self.pool_size = pool_size
+        self.warm_up_seconds = None
+        self.lane_restarts = 0
+        self._lane_ready = [False] * self.workers
+        self._lane_sessions = [0] * self.workers
+        self._session_lanes = {}
+
+        if mode == "process":
+            self._lanes = [self._new_process_lane() for _ in range(self.workers)]
+        else:
+            _init_worker(pool_size)
+            if mode == "thread":
+                self._lanes = [
+                    ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"frame-lane-{i}")
+                    for i in range(self.workers)
+                ]
+            else:
+                self._lanes = [None]
+
+    # Spawn keeps the workers independent of the server's threads and event
+    # loop; each worker gets its share of the detector budget.
+    def _new_process_lane(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(math.ceil(self.pool_size / self.workers),))
+
+    @property
+    def ready(self) -> bool:
+        return all(self._lane_ready)
+
+    @property
+    def active_sessions(self) -> int:
+        return len(self._session_lanes)
+
+    async def _call(self, lane: int, fn, *args):
+        executor = self._lanes[lane]
+        if executor is None:
+            return fn(*args)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            self._restart_lane(lane, executor)
+            raise
+
+    def _restart_lane(self, lane: int, broken: ProcessPoolExecutor):
+        """Replace a lane whose worker process died, unless that already happened"""
+        if self._lanes[lane] is not broken:
+            return
+        logger.error(f"Frame worker of lane {lane} died; restarting it")
+        broken.shutdown(wait=False, cancel_futures=True)
+        executor = self._new_process_lane()
+        self._lanes[lane] = executor
+        self._lane_ready[lane] = False
+        self.lane_restarts += 1
+
+        # Submitted before anything else can reach the new worker, so its
+        # sessions exist again before their next frame arrives
+        sessions = [session_id for session_id, pinned in self._session_lanes.items() if pinned == lane]
+        jobs = [executor.submit(_warm_up_worker)] + [executor.submit(_open_session, session_id)
+                                                     for session_id in sessions]
+        asyncio.get_running_loop().create_task(self._lane_restarted(lane, executor, sessions, jobs))
+
+    async def _lane_restarted(self, lane: int, executor, sessions, jobs):
+        try:
+            warm_up_seconds, *opened = await asyncio.gather(*map(asyncio.wrap_future, jobs))
+        except BrokenProcessPool:
+            # Crashed again during warm-up; _call restarts it on next use
+            logger.error(f"Restarted frame worker of lane {lane} died during warm-up")
+            self._restart_lane(lane, executor)
+            return
+        except Exception:
+            logger.exception(f"Failed to warm up restarted frame worker of lane {lane}")
+            return
+        lost = [session_id for session_id, ok in zip(sessions, opened) if not ok]
+        if lost:
+            logger.error(f"Could not reopen sessions {lost} on restarted lane {lane}")
+        if self._lanes[lane] is executor:
+            self._lane_ready[lane] = True
+            logger.info(f"Frame worker of lane {lane} restarted and warm after {warm_up_seconds:.2f}s, "
+                        f"{len(sessions) - len(lost)} sessions reopened")
+
+    async def warm_up(self):
+        """
+        Warm every lane up on a synthetic frame; each lane is ready once its
+        warm-up is done. A lane whose worker dies during warm-up is restarted
+        and becomes ready when the restarted worker is warm.
+
+        :raises Exception: The first lane's warm-up error, after all lanes finished
+        """
+        outcomes = await asyncio.gather(*[self._warm_up_lane(lane) for lane in range(self.workers)],
+                                        return_exceptions=True)
+        self.warm_up_seconds = [None if isinstance(outcome, Exception) else outcome for outcome in outcomes]
+        for outcome in outcomes:
+            if isinstance(outcome, Exception):
+                raise outcome
+
+    async def _warm_up_lane(self, lane: int) -> float:
+        executor = self._lanes[lane]
+        seconds = await self._call(lane, _warm_up_worker)
+        if self._lanes[lane] is executor:
+            self._lane_ready[lane] = True
+        return seconds
+
+    async def open_session(self, session_id: str) -> bool:
+        """Pin a session to the least-loaded ready lane and give it a detector"""
+        lane = min(range(self.workers), key=lambda i: (not self._lane_ready[i], self._lane_sessions[i]))
+        self._lane_sessions[lane] += 1
+        self._session_lanes[session_id] = lane
+
+        try:
+            opened = await self._call(lane, _open_session, session_id)
+        except Exception:
+            opened = False
+            logger.exception(f"Failed to open session {session_id} on lane {lane}")
+
+        if not opened:
+            self._lane_sessions[lane] -= 1
+            del self._session_lanes[session_id]
+        return opened
+
+    def lane_of(self, session_id: str) -> int:
+        return self._session_lanes[session_id]
+
+    async def process_batch(self, lane: int, jobs):
+        """Run a micro-batch of (session_id, frame_data, annotate, timestamp) jobs on one lane"""
+        return await self._call(lane, _run_batch, jobs)
+
+    async def close_session(self, session_id: str):
+        lane = self._session_lanes.pop(session_id, None)
+        if lane is None:
+            return
+        self._lane_sessions[lane] -= 1
+        try:
+            await self._call(lane, _close_session, session_id)
+        except Exception as e:
+            logger.error(f"Failed to close session {session_id} on lane {lane}: {e}")
+
+    def shutdown(self):
+        for executor in self._lanes:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "ready": self.ready,
+            "lanes_ready": list(self._lane_ready),
+            "lane_restarts": self.lane_restarts,
+            "warm_up_seconds": self.warm_up_seconds,
+            "detector_pool_size": self.pool_size,
+            "sessions": self.active_sessions,
+            "sessions_per_worker": list(self._lane_sessions),
+        }
@@ -0,0 +1,339 @@
+"""
+Synthetic multi-driver load generator for the drowsiness server.
+
+Opens N concurrent /ws/drowsiness sessions against a running server and
+sends frames at a fixed rate per session (open loop, like real cameras: a
+slow server does not slow the senders down). Each step of the --sessions
+list runs for --duration seconds after a --warmup period, and reports
+round-trip latency, late responses (slower than --deadline-ms), frames the
+server dropped in favour of newer ones, and server CPU. The final capacity
+report gives the largest session count that met the targets and the
+sustainable sessions per CPU core.
+
+Frames come from a corpus (a video file or a directory of JPEGs, resized to
+--resolution) or are generated: a drawn face that sways and blinks. Whether
+FaceMesh finds the generated face varies; full-frame searches cost more
+than tracked crops, so use a real corpus for capacity planning.
+
+Server CPU is read with psutil (pip install psutil) for the process tree
+listening on the server port, which includes the frame worker processes.
+Without psutil, the server's /metrics process_cpu_seconds_total is used,
+which only covers the uvicorn process itself.
+
+    python loadgen.py --sessions 1,2,4,8,16 --fps 10 --corpus frames/
+    python loadgen.py --sessions 8 --fps 15 --resolution 1280x720 --protocol binary --response results
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import re
+import time
+import urllib.request
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+
+from benchmark import load_frames, summarize
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def generate_frames(count: int, width: int, height: int, quality: int = 85):
+    """A drawn face that sways side to side and blinks every 30 frames"""
+    frames = []
+    rng = np.random.default_rng(0)
+    background = np.dstack([np.linspace(60, 140, width, dtype=np.float32)[None, :].repeat(height, 0)] * 3)
+    for i in range(count):
+        frame = (background + rng.normal(0, 4, background.shape)).clip(0, 255).astype(np.uint8)
+        s = min(width, height) / 480
+        cx = int(width / 2 + np.sin(i / 15) * 40 * s)
+        cy = int(height / 2 + np.cos(i / 20) * 10 * s)
+        cv2.ellipse(frame, (cx, cy), (int(110 * s), int(145 * s)), 0, 0, 360, (140, 170, 210), -1)
+        closed = i % 30 < 4
+        for dx in (-45, 45):
+            eye = (cx + int(dx * s), cy - int(30 * s))
+            cv2.line(frame, (eye[0] - int(25 * s), eye[1] - int(25 * s)), (eye[0] + int(25 * s), eye[1] - int(28 * s)),
+                     (40, 50, 70), max(1, int(5 * s)))
+            if closed:
+                cv2.line(frame, (eye[0] - int(20 * s), eye[1]), (eye[0] + int(20 * s), eye[1]), (50, 60, 80),
+                         max(1, int(3 * s)))
+            else:
+                cv2.ellipse(frame, eye, (int(20 * s), int(10 * s)), 0, 0, 360, (240, 240, 240), -1)
+                cv2.circle(frame, eye, int(7 * s), (50, 40, 30), -1)
+        cv2.line(frame, (cx, cy - int(10 * s)), (cx - int(8 * s), cy + int(35 * s)), (100, 130, 170), max(1, int(3 * s)))
+        cv2.ellipse(frame, (cx, cy + int(70 * s)), (int(35 * s), int(12 * s)), 0, 0, 180, (60, 60, 150),
+                    max(1, int(4 * s)))
+        frames.append(cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+    return frames
+
+
+def resize_frames(frames, width: int, height: int, quality: int = 85):
+    resized = []
+    for data in frames:
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            data = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        resized.append(data)
+    return resized
+
+
+class ServerCpu:
+    """CPU seconds used by the server, from psutil or the server's /metrics"""
+
+    def __init__(self, url: str, pid: int = None):
+        parsed = urlparse(url)
+        self.metrics_url = f"{'https' if parsed.scheme == 'wss' else 'http'}://{parsed.netloc}/metrics"
+        self.process = None
+        if psutil is not None:
+            pid = pid or self._pid_listening_on(parsed.port or 80)
+            if pid:
+                self.process = psutil.Process(pid)
+                # uvicorn --workers runs the app in children of the listening process
+                parent = self.process.parent()
+                if parent is not None and "uvicorn" in " ".join(parent.cmdline()):
+                    self.process = parent
+        self.source = ("psutil (server process tree)" if self.process is not None
+                       else "metrics (uvicorn process only, excludes frame workers)")
+
+    @staticmethod
+    def _pid_listening_on(port: int):
+        try:
+            for conn in psutil.net_connections("tcp"):
+                if conn.status == psutil.CONN_LISTEN and conn.laddr.port == port and conn.pid:
+                    return conn.pid
+        except psutil.AccessDenied:
+            pass
+        return None
+
+    def seconds(self):
+        if self.process is not None:
+            total = 0.0
+            for process in [self.process] + self.process.children(recursive=True):
+                try:
+                    times = process.cpu_times()
+                    total += times.user + times.system
+                except psutil.NoSuchProcess:
+                    pass
+            return total
+        try:
+            with urllib.request.urlopen(self.metrics_url, timeout=5) as response:
+                text = response.read().decode()
+        except OSError:
+            return None
+        match = re.search(r"^process_cpu_seconds_total (\S+)$", text, re.MULTILINE)
+        return float(match.group(1)) if match else None
+
+
+class SessionStats:
+    def __init__(self):
+        self.sent = 0
+        self.responses = 0
+        self.dropped = 0
+        self.late = 0
+        self.faces = 0
+        self.latencies = []
+        self.recording = False
+
+    def reset(self):
+        self.__init__()
+        self.recording = True
+
+
+# One simulated driver: sends frames on a fixed schedule and matches each
+# response to its frame. JSON responses carry no frame id, but every frame
+# is either answered or reported as dropped, in order, so the id follows
+# from the dropped_frames counts.
+async def run_session(url: str, payloads, fps: float, deadline: float, binary: bool, stats: SessionStats,
+                      stop: asyncio.Event, offset: float):
+    import websockets
+    from protocol import unpack_result
+
+    sent_at = {}
+    async with websockets.connect(url, max_size=None) as ws:
+        async def receive():
+            frame_id = 0
+            async for reply in ws:
+                now = time.perf_counter()
+                if binary:
+                    result = unpack_result(reply)
+                    frame_id = result["frame_id"]
+                else:
+                    result = json.loads(reply)
+                    frame_id += result["dropped_frames"] + 1
+                sent = sent_at.pop(frame_id, None)
+                # Frames sent before the measurement started are not counted
+                if sent is None or not stats.recording:
+                    continue
+                latency = now - sent
+                stats.responses += 1
+                stats.dropped += result["dropped_frames"]
+                stats.faces += result["face_detected"]
+                stats.late += latency > deadline
+                stats.latencies.append(latency)
+
+        receiver = asyncio.create_task(receive())
+        await asyncio.sleep(offset)
+        interval = 1 / fps
+        next_at = time.perf_counter()
+        frame_id = 0
+        try:
+            while not stop.is_set():
+                frame_id += 1
+                # Forget frames the server dropped long ago
+                if len(sent_at) > 4 * fps:
+                    for stale in [f for f in sent_at if f < frame_id - 4 * fps]:
+                        del sent_at[stale]
+                sent_at[frame_id] = time.perf_counter()
+                await ws.send(payloads[frame_id % len(payloads)])
+                stats.sent += stats.recording
+                next_at += interval
+                # Skip send slots that already passed rather than bursting
+                delay = next_at - time.perf_counter()
+                if delay < 0:
+                    next_at = time.perf_counter()
+                await asyncio.sleep(max(0.0, delay))
+        finally:
+            receiver.cancel()
+
+
+async def run_step(url: str, payloads, sessions: int, fps: float, deadline: float, binary: bool,
+                   warmup: float, duration: float, cpu: ServerCpu):
+    stop = asyncio.Event()
+    stats = [SessionStats() for _ in range(sessions)]
+    # Spread the sessions' send times over one frame interval
+    tasks = [asyncio.create_task(run_session(url, payloads, fps, deadline, binary, s, stop, i / fps / sessions))
+             for i, s in enumerate(stats)]
+
+    await asyncio.sleep(warmup)
+    for s in stats:
+        s.reset()
+    cpu_started = cpu.seconds()
+    started = time.perf_counter()
+    await asyncio.sleep(duration)
+    elapsed = time.perf_counter() - started
+    cpu_ended = cpu.seconds()
+    stop.set()
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [repr(o) for o in outcomes if isinstance(o, Exception)]
+
+    sent = sum(s.sent for s in stats)
+    responses = sum(s.responses for s in stats)
+    latencies = [latency for s in stats for latency in s.latencies]
+    return {
+        "sessions": sessions,
+        "elapsed_s": elapsed,
+        "frames_sent": sent,
+        "responses": responses,
+        "response_fps_per_session": responses / elapsed / sessions,
+        "dropped_ratio": sum(s.dropped for s in stats) / sent if sent else 0.0,
+        "late_ratio": sum(s.late for s in stats) / responses if responses else 0.0,
+        "face_detection_rate": sum(s.faces for s in stats) / responses if responses else 0.0,
+        "latency": summarize(latencies) if latencies else None,
+        "server_cpu_cores": ((cpu_ended - cpu_started) / elapsed
+                             if cpu_started is not None and cpu_ended is not None else None),
+        "errors": errors,
+    }
+
+
+def step_passed(step, max_drop: float, max_late: float) -> bool:
+    return (not step["errors"] and step["responses"] > 0 and step["dropped_ratio"] <= max_drop
+            and step["late_ratio"] <= max_late)
+
+
+def capacity_report(steps, cores: int, max_drop: float, max_late: float, cpu_complete: bool):
+    passed = [step for step in steps if step_passed(step, max_drop, max_late)]
+    best = max(passed, key=lambda step: step["sessions"]) if passed else None
+    report = {"sustainable_sessions": best["sessions"] if best else 0, "server_cores": cores,
+              "sessions_per_core": (best["sessions"] / cores) if best else 0.0,
+              "cpu_per_session_cores": None, "projected_sessions_per_core": None}
+    # CPU cost per session at the largest passing step, which is a better
+    # predictor for other machines than the session count on this one. Only
+    # meaningful when the frame workers' CPU was measured too.
+    if best and best["server_cpu_cores"] and cpu_complete:
+        report["cpu_per_session_cores"] = best["server_cpu_cores"] / best["sessions"]
+        report["projected_sessions_per_core"] = 1 / report["cpu_per_session_cores"]
+    return report
+
+
+def print_step(step, max_drop: float, max_late: float):
+    latency = step["latency"] or {}
+    cpu = step["server_cpu_cores"]
+    print(f"{step['sessions']:>4} sessions: {step['response_fps_per_session']:5.1f} fps/session  "
+          f"rtt p50 {latency.get('p50_ms', 0):6.1f}ms p95 {latency.get('p95_ms', 0):6.1f}ms "
+          f"p99 {latency.get('p99_ms', 0):6.1f}ms  late {step['late_ratio']:5.1%}  "
+          f"dropped {step['dropped_ratio']:5.1%}  face {step['face_detection_rate']:4.0%}  cpu {'n/a' if cpu is None else f'{cpu:.2f} cores'}  "
+          f"{'ok' if step_passed(step, max_drop, max_late) else 'OVERLOADED'}")
+    for error in step["errors"][:3]:
+        print(f"      error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the drowsiness server with synthetic drivers")
+    parser.add_argument("--url", default="ws://localhost:8001/ws/drowsiness")
+    parser.add_argument("--sessions", default="1,2,4,8", help="Comma-separated concurrent session counts to step through")
+    parser.add_argument("--fps", type=float, default=10.0, help="Frames per second sent by each session")
+    parser.add_argument("--resolution", default="640x480", help="WIDTHxHEIGHT of the sent frames")
+    parser.add_argument("--corpus", help="Video file or directory of JPEG frames (default: generated faces)")
+    parser.add_argument("--frames", type=int, default=120, help="Frames to load or generate")
+    parser.add_argument("--quality", type=int, default=85, help="JPEG quality of resized or generated frames")
+    parser.add_argument("--protocol", choices=["json", "binary"], default="json")
+    parser.add_argument("--response", choices=["frame", "results"], default="results")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds per step before measuring")
+    parser.add_argument("--duration", type=float, default=15.0, help="Measured seconds per step")
+    parser.add_argument("--deadline-ms", type=float, help="Responses slower than this are late "
+                                                          "(default: two frame intervals)")
+    parser.add_argument("--max-drop", type=float, default=0.05, help="Highest sustainable dropped frame ratio")
+    parser.add_argument("--max-late", type=float, default=0.05, help="Highest sustainable late response ratio")
+    parser.add_argument("--server-pid", type=int, help="Server process for CPU measurement (needs psutil)")
+    parser.add_argument("--server-cores", type=int, default=os.cpu_count(),
+                        help="CPU cores available to the server (default: this machine's)")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.resolution.lower().split("x"))
+    if args.corpus:
+        frames = resize_frames(load_frames(args.corpus, args.frames), width, height, args.quality)
+    else:
+        frames = generate_frames(args.frames, width, height, args.quality)
+    binary = args.protocol == "binary"
+    payloads = frames if binary else [
+        json.dumps({"frame": "data:image/jpeg;base64," + base64.b64encode(f).decode("ascii")}) for f in frames
+    ]
+    deadline = (args.deadline_ms / 1000) if args.deadline_ms else 2 / args.fps
+    url = f"{args.url}{'&' if '?' in args.url else '?'}protocol={args.protocol}&response={args.response}"
+    cpu = ServerCpu(args.url, args.server_pid)
+
+    print(f"{len(frames)} {'corpus' if args.corpus else 'generated'} frames at {width}x{height} "
+          f"({np.mean([len(f) for f in frames]) / 1024:.0f} KiB), {args.fps:g} fps per session, "
+          f"late after {deadline * 1000:.0f}ms, server CPU from {cpu.source}")
+    steps = []
+    for sessions in (int(n) for n in args.sessions.split(",")):
+        step = asyncio.run(run_step(url, payloads, sessions, args.fps, deadline, binary, args.warmup,
+                                    args.duration, cpu))
+        steps.append(step)
+        print_step(step, args.max_drop, args.max_late)
+
+    capacity = capacity_report(steps, args.server_cores, args.max_drop, args.max_late, cpu.process is not None)
+    print(f"\nSustainable: {capacity['sustainable_sessions']} sessions at {args.fps:g} fps "
+          f"(<= {args.max_drop:.0%} dropped, <= {args.max_late:.0%} late) on {capacity['server_cores']} cores, "
+          f"{capacity['sessions_per_core']:.2f} sessions per core")
+    if capacity["projected_sessions_per_core"]:
+        print(f"CPU per session {capacity['cpu_per_session_cores']:.3f} cores, "
+              f"projected {capacity['projected_sessions_per_core']:.1f} sessions per fully used core")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "steps": steps, "capacity": capacity, "timestamp": time.time()},
+                      f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import asyncio
+import time
+from typing import Dict
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Prometheus metrics for the drowsiness server, served on /metrics. The
+# default registry also carries the process collector (CPU seconds, memory,
+# open file descriptors) of the server process.
+
+# Frame pipeline stages, in pipeline order. Worker-side stages are timed in
+# the executor and returned with each frame's results; json_parse and send
+# are timed on the event loop.
+STAGES = ("json_parse", "base64_decode", "jpeg_decode", "resize", "color_convert", "facemesh",
+          "optical_flow", "annotate", "encode", "send")
+
+# 0.1 ms to 1 s
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.025, 0.05,
+                 0.075, 0.1, 0.25, 0.5, 1.0)
+
+stage_seconds = Histogram(
+    "drowsiness_stage_seconds", "Time spent in each frame pipeline stage", ["stage"], buckets=STAGE_BUCKETS
+)
+event_loop_lag_seconds = Histogram(
+    "drowsiness_event_loop_lag_seconds", "Delay between a scheduled event loop wake-up and when it ran",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+# Resolve the labelled children once instead of on every observation
+_stage_children = {stage: stage_seconds.labels(stage) for stage in STAGES}
+
+
+def observe_stage(stage: str, seconds: float):
+    _stage_children[stage].observe(seconds)
+
+
+def observe_stages(timings: Dict[str, float]):
+    for stage, seconds in timings.items():
+        observe_stage(stage, seconds)
+
+
+def register(collector):
+    REGISTRY.register(collector)
+    return collector
+
+
+def render():
+    """Current metrics in the Prometheus text format, with its content type"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class SessionMetrics:
+    """Frame counters of one WebSocket session"""
+
+    def __init__(self, mailbox):
+        # The session's LatestFrameMailbox already counts received and
+        # dropped frames
+        self.mailbox = mailbox
+        self.processed = 0
+        self.faces = 0
+        self.alerts = 0
+
+    def frame_processed(self, face_detected: bool):
+        self.processed += 1
+        self.faces += face_detected
+
+
+class SessionCollector:
+    """
+    Exports frame counters for live sessions and running totals.
+
+    Sessions update plain integers on the hot path; the Prometheus metric
+    families are only built when /metrics is scraped. Per-session series
+    disappear when the session closes, and its counts are folded into the
+    server-wide totals.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, SessionMetrics] = {}
+        self._closed = {"received": 0, "processed": 0, "dropped": 0, "faces": 0}
+
+    def open(self, session_id: str, mailbox) -> SessionMetrics:
+        self.sessions[session_id] = SessionMetrics(mailbox)
+        return self.sessions[session_id]
+
+    def close(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            for name, value in self._counts(session).items():
+                self._closed[name] += value
+
+    @staticmethod
+    def _counts(session: SessionMetrics):
+        return {
+            "received": session.mailbox.received,
+            "processed": session.processed,
+            "dropped": session.mailbox.dropped,
+            "faces": session.faces,
+        }
+
+    def collect(self):
+        totals = dict(self._closed)
+        per_session = {name: GaugeMetricFamily(f"drowsiness_session_frames_{name}",
+                                               f"Frames {name} in the current session", labels=["session"])
+                       for name in ("received", "processed", "dropped")}
+        face_rate = GaugeMetricFamily("drowsiness_session_face_detection_ratio",
+                                      "Fraction of processed frames with a detected face", labels=["session"])
+
+        for session_id, session in list(self.sessions.items()):
+            counts = self._counts(session)
+            for name, value in counts.items():
+                totals[name] += value
+            for name, family in per_session.items():
+                family.add_metric([session_id], counts[name])
+            if session.processed:
+                face_rate.add_metric([session_id], session.faces / session.processed)
+
+        yield from per_session.values()
+        yield face_rate
+        yield GaugeMetricFamily("drowsiness_sessions", "Open WebSocket sessions", value=len(self.sessions))
+        yield CounterMetricFamily("drowsiness_frames_received", "Frames received from clients",
+                                  value=totals["received"])
+        yield CounterMetricFamily("drowsiness_frames_processed", "Frames run through the pipeline",
+                                  value=totals["processed"])
+        yield CounterMetricFamily("drowsiness_frames_dropped", "Frames replaced by a newer frame before processing",
+                                  value=totals["dropped"])
+        yield CounterMetricFamily("drowsiness_faces_detected", "Processed frames with a detected face",
+                                  value=totals["faces"])
+
+
+class PipelineCollector:
+    """Exports the executor, batch scheduler and alert outbox stats at scrape time"""
+
+    def __init__(self, executor, scheduler, outbox):
+        self.executor = executor
+        self.scheduler = scheduler
+        self.outbox = outbox
+
+    def collect(self):
+        executor = self.executor.stats()
+        sessions = GaugeMetricFamily("drowsiness_executor_sessions", "Sessions pinned to each executor worker",
+                                     labels=["worker"])
+        for worker, count in enumerate(executor["sessions_per_worker"]):
+            sessions.add_metric([str(worker)], count)
+        yield sessions
+        yield GaugeMetricFamily("drowsiness_detector_pool_size", "Maximum number of concurrent detectors",
+                                value=executor["detector_pool_size"])
+
+        batching = self.scheduler.stats()
+        yield CounterMetricFamily("drowsiness_batches", "Micro-batches dispatched to the executor",
+                                  value=batching["batches"])
+        yield CounterMetricFamily("drowsiness_batched_frames", "Frames dispatched in micro-batches",
+                                  value=batching["frames"])
+        yield CounterMetricFamily("drowsiness_batch_queue_wait_seconds",
+                                  "Total time frames waited for their batch to be dispatched",
+                                  value=self.scheduler.queue_wait_total)
+        yield GaugeMetricFamily("drowsiness_batch_queue_wait_max_seconds",
+                                "Longest time a frame waited for its batch", value=self.scheduler.queue_wait_max)
+        batch_sizes = CounterMetricFamily("drowsiness_batch_size", "Micro-batches dispatched, by batch size",
+                                          labels=["size"])
+        for size, count in batching["batch_size_counts"].items():
+            batch_sizes.add_metric([str(size)], count)
+        yield batch_sizes
+
+        alerts = self.outbox.stats()
+        yield GaugeMetricFamily("drowsiness_alerts_queued", "Alerts waiting for delivery", value=alerts["queued"])
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Measure how late the event loop wakes a sleeping task, forever"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, time.perf_counter() - started - interval))
@@ -0,0 +1,109 @@
+import struct
+
+import numpy as np
+
+# WebSocket frame protocols for /ws/drowsiness, negotiated with the
+# `protocol` query parameter when the socket is opened:
+#
+#   json   (default) text messages {"frame": "data:image/jpeg;base64,..."},
+#          answered with a JSON object carrying a base64 processedFrame
+#   binary binary messages holding the raw JPEG bytes of one frame,
+#          answered with a RESULT_HEADER followed by the payload bytes
+#
+# The `response` query parameter picks what comes back for each frame:
+#
+#   frame   (default) the annotated frame re-encoded as JPEG
+#   results metrics and the 12 normalized eye landmarks only; the server
+#           skips all drawing and JPEG encoding
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "binary"
+PROTOCOLS = (PROTOCOL_JSON, PROTOCOL_BINARY)
+
+RESPONSE_FRAME = "frame"
+RESPONSE_RESULTS = "results"
+RESPONSE_MODES = (RESPONSE_FRAME, RESPONSE_RESULTS)
+
+RESULT_MAGIC = b"SDR2"
+
+# Binary result header, little-endian, 28 bytes:
+#   magic                  4s  RESULT_MAGIC
+#   flags                  B   FLAG_* bits
+#   payload_type           B   PAYLOAD_* value describing the trailing bytes
+#   dropped_frames         H   frames dropped since the previous result
+#                              (saturates at 65535)
+#   frame_id               I   sequence number of the frame in this session
+#   ear                    f   average eye aspect ratio
+#   drowsiness_percentage  f   0-100
+#   eyes_closed_seconds    f   length of the current eye closure
+#   perclos                f   fraction of the PERCLOS window with eyes closed
+RESULT_HEADER = struct.Struct("<4sBBHIffff")
+
+# Version 1 header: the same without eyes_closed_seconds and perclos.
+# unpack_result still reads it, for tooling run against older servers.
+RESULT_MAGIC_V1 = b"SDR1"
+RESULT_HEADER_V1 = struct.Struct("<4sBBHIff")
+
+FLAG_DROWSY = 1 << 0
+FLAG_ALERT_SENT = 1 << 1
+FLAG_FACE_DETECTED = 1 << 2
+
+PAYLOAD_JPEG = 1
+# Little-endian float32 (x, y) pairs for the left then right eye landmarks,
+# normalized to the frame size; empty when no face was detected
+PAYLOAD_LANDMARKS = 2
+
+
+def pack_landmarks(eye_landmarks) -> bytes:
+    return np.asarray(eye_landmarks, dtype="<f4").tobytes()
+
+
+def pack_result(frame_id: int, results: dict, payload: bytes, dropped_frames: int = 0,
+                payload_type: int = PAYLOAD_JPEG) -> bytes:
+    """Build a binary result message from detection results and a payload"""
+    flags = 0
+    if results["isDrowsy"]:
+        flags |= FLAG_DROWSY
+    if results["alertSent"]:
+        flags |= FLAG_ALERT_SENT
+    if results["hasDetectedFace"]:
+        flags |= FLAG_FACE_DETECTED
+
+    header = RESULT_HEADER.pack(
+        RESULT_MAGIC, flags, payload_type, min(dropped_frames, 0xFFFF), frame_id & 0xFFFFFFFF,
+        results["earValue"], results["drowsinessPercentage"], results["eyesClosedSeconds"], results["perclos"]
+    )
+    return header + payload
+
+
+def unpack_result(message: bytes) -> dict:
+    """Parse a binary result message (used by clients and tooling)"""
+    magic = bytes(message[:len(RESULT_MAGIC)])
+    if magic == RESULT_MAGIC:
+        header = RESULT_HEADER
+        _, flags, payload_type, dropped, frame_id, ear, percentage, closed_seconds, perclos = \
+            header.unpack_from(message)
+    elif magic == RESULT_MAGIC_V1:
+        header = RESULT_HEADER_V1
+        _, flags, payload_type, dropped, frame_id, ear, percentage = header.unpack_from(message)
+        closed_seconds = perclos = None
+    else:
+        raise ValueError(f"Bad result magic {magic!r}")
+
+    payload = memoryview(message)[header.size:]
+    if payload_type == PAYLOAD_LANDMARKS:
+        payload = np.frombuffer(payload, dtype="<f4").reshape(-1, 2)
+
+    return {
+        "frame_id": frame_id,
+        "dropped_frames": dropped,
+        "is_drowsy": bool(flags & FLAG_DROWSY),
+        "alert_sent": bool(flags & FLAG_ALERT_SENT),
+        "face_detected": bool(flags & FLAG_FACE_DETECTED),
+        "ear": ear,
+        "drowsiness_percentage": percentage,
+        # None in version 1 results
+        "eyes_closed_seconds": closed_seconds,
+        "perclos": perclos,
+        "payload_type": payload_type,
+        "payload": payload,
+    }
@@ -0,0 +1,330 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+# Sessions whose worker has not refreshed them for this many seconds are
+# considered gone (e.g. the worker process crashed)
+SESSION_TTL = 30.0
+
+COUNTERS = ("received", "processed", "dropped", "alerts")
+
+
+def worker_id() -> str:
+    """Identifies this server process among the workers sharing a store"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SessionStore(ABC):
+    """
+    Session metadata, frame counters and alert cooldowns shared by all
+    server workers.
+
+    Every uvicorn worker holds its own sessions (and their detectors) in
+    memory; the store is what lets them agree on global connection counts
+    and on whether an alert for a driver is still in cooldown. A networked
+    backend (e.g. Redis: a hash per session with a TTL, SET NX EX for alert
+    claims) only has to implement these methods.
+    """
+
+    @abstractmethod
+    def open_session(self, session_id: str, metadata: Dict):
+        """Register a session opened by this worker"""
+
+    @abstractmethod
+    def close_session(self, session_id: str):
+        """Remove a session"""
+
+    @abstractmethod
+    def sync_sessions(self, counts: Dict[str, Dict[str, int]]):
+        """
+        Store the latest counters of this worker's sessions and mark them as
+        alive. Called periodically by every worker.
+
+        :param counts: {session_id: {counter: value}}, values are totals
+        """
+
+    @abstractmethod
+    def sessions(self) -> List[Dict]:
+        """All live sessions of all workers, with metadata and counters"""
+
+    @abstractmethod
+    def connection_count(self) -> int:
+        """Number of live sessions across all workers"""
+
+    @abstractmethod
+    def claim_alert(self, key: str, cooldown: float) -> bool:
+        """
+        Atomically claim the right to send the alert identified by `key`.
+
+        :return: True if no claim for `key` was made in the last `cooldown`
+                 seconds (the caller should send the alert), else False
+        """
+
+    @abstractmethod
+    def claim_idempotency_keys(self, keys: List[str], value: str, ttl: float) -> str:
+        """
+        Atomically bind `value` (e.g. a new alert id) to `keys`, which all
+        identify the same request, for `ttl` seconds. If one of the keys is
+        already bound, the first such key's value is bound to the others
+        instead, so a repeat under any of them finds the original.
+
+        :return: The value bound to the keys: `value` if this call claimed
+                 them, else the value of the earlier, unexpired claim
+        """
+
+    @abstractmethod
+    def save_alert_status(self, alert_id: str, status: Dict, revision: int, ttl: float):
+        """
+        Publish the delivery status of an alert for `ttl` seconds, so any
+        worker can answer status queries for it.
+
+        :param revision: Increases with every update of the alert; an update
+                         older than the stored one is ignored
+        """
+
+    @abstractmethod
+    def alert_status(self, alert_id: str) -> Optional[Dict]:
+        """Latest published status of an alert, or None if unknown or expired"""
+
+    def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store for a single server worker (and for development)"""
+
+    def __init__(self):
+        self._sessions: Dict[str, Dict] = {}
+        self._claims: Dict[str, float] = {}  # key -> end of its cooldown
+        self._keys: Dict[str, tuple] = {}
+        self._alert_statuses: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def open_session(self, session_id: str, metadata: Dict):
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = {"session_id": session_id, "worker": worker_id(), **metadata,
+                                          "opened_at": now, "last_seen": now, **dict.fromkeys(COUNTERS, 0)}
+
+    def close_session(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def sync_sessions(self, counts: Dict[str, Dict[str, int]]):
+        now = time.time()
+        with self._lock:
+            for session_id, values in counts.items():
+                session = self._sessions.get(session_id)
+                if session is not None:
+                    session.update(values, last_seen=now)
+
+    def sessions(self) -> List[Dict]:
+        with self._lock:
+            return [dict(session) for session in self._sessions.values()]
+
+    def connection_count(self) -> int:
+        return len(self._sessions)
+
+    def claim_alert(self, key: str, cooldown: float) -> bool:
+        now = time.time()
+        with self._lock:
+            for expired in [k for k, expires_at in self._claims.items() if expires_at <= now]:
+                del self._claims[expired]
+            if key in self._claims:
+                return False
+            self._claims[key] = now + cooldown
+            return True
+
+    def claim_idempotency_keys(self, keys: List[str], value: str, ttl: float) -> str:
+        now = time.time()
+        with self._lock:
+            for expired in [k for k, (_, expires_at) in self._keys.items() if expires_at <= now]:
+                del self._keys[expired]
+            bound = next((self._keys[key][0] for key in keys if key in self._keys), value)
+            for key in keys:
+                self._keys.setdefault(key, (bound, now + ttl))
+            return bound
+
+    def save_alert_status(self, alert_id: str, status: Dict, revision: int, ttl: float):
+        now = time.time()
+        with self._lock:
+            for expired in [k for k, (_, _, expires_at) in self._alert_statuses.items() if expires_at <= now]:
+                del self._alert_statuses[expired]
+            current = self._alert_statuses.get(alert_id)
+            if current is None or current[1] < revision:
+                self._alert_statuses[alert_id] = (dict(status), revision, now + ttl)
+
+    def alert_status(self, alert_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._alert_statuses.get(alert_id)
+            if entry is None or entry[2] <= time.time():
+                return None
+            return dict(entry[0])
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Store shared by the workers on one machine through a SQLite database in
+    WAL mode, so readers never block the writer. Alert claims are a single
+    write transaction, which SQLite executes atomically across processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                worker TEXT NOT NULL,
+                driver_id TEXT,
+                protocol TEXT,
+                response_mode TEXT,
+                opened_at REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                received INTEGER NOT NULL DEFAULT 0,
+                processed INTEGER NOT NULL DEFAULT 0,
+                dropped INTEGER NOT NULL DEFAULT 0,
+                alerts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS alert_cooldowns (
+                key TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS alert_cooldowns_expires_at ON alert_cooldowns (expires_at);
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at ON idempotency_keys (expires_at);
+            CREATE TABLE IF NOT EXISTS alert_statuses (
+                alert_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                revision INTEGER NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS alert_statuses_expires_at ON alert_statuses (expires_at);
+        """)
+
+    def open_session(self, session_id: str, metadata: Dict):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, worker, driver_id, protocol, response_mode, "
+                "opened_at, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, worker_id(), metadata.get("driver_id"), metadata.get("protocol"),
+                 metadata.get("response_mode"), now, now)
+            )
+
+    def close_session(self, session_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def sync_sessions(self, counts: Dict[str, Dict[str, int]]):
+        now = time.time()
+        rows = [(values.get("received", 0), values.get("processed", 0), values.get("dropped", 0),
+                 values.get("alerts", 0), now, session_id) for session_id, values in counts.items()]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "UPDATE sessions SET received = ?, processed = ?, dropped = ?, alerts = ?, last_seen = ? "
+                    "WHERE session_id = ?", rows
+                )
+                # Sessions of workers that died without closing them
+                self._db.execute("DELETE FROM sessions WHERE last_seen < ?", (now - SESSION_TTL,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def sessions(self) -> List[Dict]:
+        with self._lock:
+            cursor = self._db.execute("SELECT * FROM sessions WHERE last_seen >= ?", (time.time() - SESSION_TTL,))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def connection_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sessions WHERE last_seen >= ?",
+                                    (time.time() - SESSION_TTL,)).fetchone()[0]
+
+    def claim_alert(self, key: str, cooldown: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("DELETE FROM alert_cooldowns WHERE expires_at <= ?", (now,))
+                cursor = self._db.execute("INSERT OR IGNORE INTO alert_cooldowns (key, expires_at) VALUES (?, ?)",
+                                          (key, now + cooldown))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return cursor.rowcount == 1
+
+    def claim_idempotency_keys(self, keys: List[str], value: str, ttl: float) -> str:
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so the read of an
+            # earlier claim and the new claims see the same state in every
+            # process
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+                bound = value
+                for key in keys:
+                    row = self._db.execute("SELECT value FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        bound = row[0]
+                        break
+                self._db.executemany("INSERT OR IGNORE INTO idempotency_keys (key, value, expires_at) VALUES (?, ?, ?)",
+                                     [(key, bound, now + ttl) for key in keys])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return bound
+
+    def save_alert_status(self, alert_id: str, status: Dict, revision: int, ttl: float):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("DELETE FROM alert_statuses WHERE expires_at <= ?", (now,))
+                self._db.execute(
+                    "INSERT INTO alert_statuses (alert_id, status, revision, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(alert_id) DO UPDATE SET status = excluded.status, revision = excluded.revision, "
+                    "expires_at = excluded.expires_at WHERE alert_statuses.revision < excluded.revision",
+                    (alert_id, json.dumps(status), revision, now + ttl)
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def alert_status(self, alert_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute("SELECT status FROM alert_statuses WHERE alert_id = ? AND expires_at > ?",
+                                   (alert_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_session_store(backend: str, path: str = None) -> SessionStore:
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        return SqliteSessionStore(path)
+    raise ValueError(f"Unknown session store {backend!r}, expected 'memory' or 'sqlite'")
@@ -1,3 +1,5 @@
 #!/usr/bin/env bash
 echo "Starting server on port $PORT"
-uvicorn drowsiness_server:app --host 0.0.0.0 --port $PORT
+# WEB_CONCURRENCY uvicorn workers share one port; with more than one, session
+# counts and alert cooldowns are shared through a SQLite session store
+uvicorn drowsiness_server:app --host 0.0.0.0 --port $PORT --workers ${WEB_CONCURRENCY:-1}
@@ -0,0 +1,288 @@
+"""
+Per-trip drowsiness telemetry.
+
+Every processed frame of a session opened with a trip_id is recorded into
+preallocated NumPy column buffers. Full (or old) buffers are flushed off the event loop to
+append-only column files, one directory per trip:
+
+    <TELEMETRY_DIR>/<trip_id>/t.float64        wall-clock seconds
+                              ear.float32      0 when no face was found
+                              perclos.float32
+                              flags.uint8      FLAG_* bits
+                              stats.json       running aggregates
+
+The column files are raw little-endian arrays (np.fromfile) and may hold
+several sessions of the same trip, e.g. after a reconnect. stats.json is
+updated with every flush, so trip statistics never require reading the
+series. Flushes of one trip are serialized with a file lock, which also
+covers sessions of the same trip on different uvicorn workers.
+
+Trips that have not been written to for the recorder's `retention` seconds
+are deleted by prune(), which the server runs periodically.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import numpy as np
+
+from drowsiness_state import MAX_SAMPLE_GAP
+
+logger = logging.getLogger(__name__)
+
+FLAG_FACE = 1
+FLAG_DROWSY = 2
+FLAG_ALERT = 4
+
+COLUMNS = {"t": np.float64, "ear": np.float32, "perclos": np.float32, "flags": np.uint8}
+
+# Trip ids become directory names
+TRIP_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def valid_trip_id(trip_id: str) -> bool:
+    return bool(TRIP_ID_PATTERN.match(trip_id))
+
+
+def _column_path(trip_dir: str, name: str) -> str:
+    return os.path.join(trip_dir, f"{name}.{np.dtype(COLUMNS[name]).name}")
+
+
+class TelemetryBuffer:
+    """Column buffers of one session, reused after every flush"""
+
+    def __init__(self, trip_id: str, session_id: str, size: int = 1024, flush_interval: float = 10.0):
+        self.trip_id = trip_id
+        self.session_id = session_id
+        self.flush_interval = flush_interval
+        self.columns = {name: np.zeros(size, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self.length = 0
+        self.flushed_at = time.monotonic()
+        # Latest write of this buffer; the next one waits for it
+        self.last_write: Optional[asyncio.Future] = None
+        # Frame timestamps are time.monotonic(); the files store wall-clock time
+        self._clock_offset = time.time() - time.monotonic()
+
+    def record(self, timestamp: float, results: Dict) -> bool:
+        """
+        Append one frame's results.
+
+        :return: True when the buffer is full or has not been flushed for
+                 flush_interval seconds, i.e. take() should be called
+        """
+        i = self.length
+        face = results["hasDetectedFace"]
+        self.columns["t"][i] = timestamp + self._clock_offset
+        self.columns["ear"][i] = results["earValue"] if face else 0.0
+        self.columns["perclos"][i] = results["perclos"]
+        self.columns["flags"][i] = (FLAG_FACE * face | FLAG_DROWSY * results["isDrowsy"]
+                                    | FLAG_ALERT * results["alertSent"])
+        self.length += 1
+        return self.length == len(self.columns["t"]) or timestamp - self.flushed_at >= self.flush_interval
+
+    def take(self) -> Optional[Dict[str, np.ndarray]]:
+        """Copy out the recorded samples and empty the buffer; None if there are none"""
+        self.flushed_at = time.monotonic()
+        if not self.length:
+            return None
+        chunk = {name: column[:self.length].copy() for name, column in self.columns.items()}
+        self.length = 0
+        return chunk
+
+
+class TelemetryRecorder:
+    """Writes session buffers to the per-trip files and maintains trip statistics"""
+
+    def __init__(self, directory: str, buffer_size: int = 1024, flush_interval: float = 10.0,
+                 retention: float = None):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self._pending = set()
+        self.flushes = 0
+        self.samples_written = 0
+        self.trips_pruned = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, trip_id: str, session_id: str) -> TelemetryBuffer:
+        return TelemetryBuffer(trip_id, session_id, self.buffer_size, self.flush_interval)
+
+    def flush(self, buffer: TelemetryBuffer):
+        """
+        Schedule the buffer's samples to be written in a worker thread.
+
+        Writes of one buffer run one after another, so a session's samples
+        are appended in order even when a flush is scheduled before the
+        previous one finished.
+        """
+        chunk = buffer.take()
+        if chunk is None:
+            return
+        task = asyncio.ensure_future(self._write_after(buffer.last_write, buffer.trip_id, buffer.session_id, chunk))
+        buffer.last_write = task
+        self._pending.add(task)
+        task.add_done_callback(self._flushed)
+
+    async def _write_after(self, previous: Optional[asyncio.Future], trip_id: str, session_id: str,
+                           chunk: Dict[str, np.ndarray]):
+        if previous is not None:
+            # Whatever its outcome; failures are logged by _flushed
+            await asyncio.wait([previous])
+        await asyncio.get_running_loop().run_in_executor(None, self.write, trip_id, session_id, chunk)
+
+    def _flushed(self, task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Failed to write telemetry: {task.exception()}")
+
+    async def drain(self):
+        """Wait for all scheduled writes"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    @contextmanager
+    def _locked(self, trip_dir: str):
+        with open(os.path.join(trip_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def write(self, trip_id: str, session_id: str, chunk: Dict[str, np.ndarray]):
+        """Append a chunk to the trip's column files and fold it into stats.json"""
+        trip_dir = os.path.join(self.directory, trip_id)
+        os.makedirs(trip_dir, exist_ok=True)
+        with self._locked(trip_dir):
+            for name, values in chunk.items():
+                with open(_column_path(trip_dir, name), "ab") as f:
+                    f.write(values.tobytes())
+            stats = self._read_stats(trip_dir) or {"trip_id": trip_id}
+            self._update_stats(stats, session_id, chunk)
+            stats_path = os.path.join(trip_dir, "stats.json")
+            with open(stats_path + ".tmp", "w") as f:
+                json.dump(stats, f)
+            os.replace(stats_path + ".tmp", stats_path)
+        self.flushes += 1
+        self.samples_written += len(chunk["t"])
+
+    @staticmethod
+    def _read_stats(trip_dir: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(trip_dir, "stats.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # Running aggregates. Durations weight each sample by the time to the
+    # next one (capped like the drowsiness window does), and the last sample
+    # of a session carries over to its next chunk.
+    @staticmethod
+    def _update_stats(stats: Dict, session_id: str, chunk: Dict[str, np.ndarray]):
+        t, ear, perclos, flags = chunk["t"], chunk["ear"], chunk["perclos"], chunk["flags"]
+        face = (flags & FLAG_FACE).astype(bool)
+        drowsy = (flags & FLAG_DROWSY).astype(bool)
+
+        carry = stats.setdefault("sessions", {}).get(session_id)
+        times = t if carry is None else np.concatenate(([carry["last_t"]], t))
+        was_drowsy = np.concatenate(([carry is not None and carry["last_drowsy"]], drowsy))
+        gaps = np.minimum(np.diff(times), MAX_SAMPLE_GAP)
+        # Each gap is attributed to the sample it starts from
+        gap_drowsy = was_drowsy[:-1] if carry is not None else drowsy[:-1]
+
+        stats["samples"] = stats.get("samples", 0) + len(t)
+        stats["face_samples"] = stats.get("face_samples", 0) + int(face.sum())
+        stats["drowsy_samples"] = stats.get("drowsy_samples", 0) + int(drowsy.sum())
+        stats["alerts"] = stats.get("alerts", 0) + int(np.count_nonzero(flags & FLAG_ALERT))
+        stats["drowsy_episodes"] = stats.get("drowsy_episodes", 0) + int(np.count_nonzero(
+            was_drowsy[1:] & ~was_drowsy[:-1]))
+        stats["duration_seconds"] = stats.get("duration_seconds", 0.0) + float(gaps.sum())
+        stats["drowsy_seconds"] = stats.get("drowsy_seconds", 0.0) + float(gaps[gap_drowsy].sum())
+        stats["ear_sum"] = stats.get("ear_sum", 0.0) + float(ear[face].sum(dtype=np.float64))
+        if face.any():
+            stats["ear_min"] = min(stats.get("ear_min", 1.0), float(ear[face].min()))
+        stats["perclos_max"] = max(stats.get("perclos_max", 0.0), float(perclos.max()))
+        stats["start"] = min(stats.get("start", float(t[0])), float(t[0]))
+        stats["end"] = max(stats.get("end", float(t[-1])), float(t[-1]))
+        stats["sessions"][session_id] = {"last_t": float(t[-1]), "last_drowsy": bool(drowsy[-1])}
+
+    def trip_stats(self, trip_id: str) -> Optional[Dict]:
+        """Aggregated statistics of a trip, or None if nothing was recorded for it"""
+        trip_dir = os.path.join(self.directory, trip_id)
+        if not os.path.isdir(trip_dir):
+            return None
+        with self._locked(trip_dir):
+            stats = self._read_stats(trip_dir)
+        if stats is None:
+            return None
+
+        samples, face_samples = stats["samples"], stats["face_samples"]
+        return {
+            "trip_id": trip_id,
+            "sessions": len(stats["sessions"]),
+            "start": stats["start"],
+            "end": stats["end"],
+            "samples": samples,
+            "duration_seconds": stats["duration_seconds"],
+            "face_detection_rate": face_samples / samples if samples else 0.0,
+            "mean_ear": stats["ear_sum"] / face_samples if face_samples else None,
+            "min_ear": stats.get("ear_min"),
+            "perclos_max": stats["perclos_max"],
+            "drowsy_seconds": stats["drowsy_seconds"],
+            "drowsy_ratio": stats["drowsy_seconds"] / stats["duration_seconds"] if stats["duration_seconds"] else 0.0,
+            "drowsy_episodes": stats["drowsy_episodes"],
+            "alerts": stats["alerts"],
+            # Input of the analysis server's risk model
+            "drowsiness_state": int(stats["drowsy_samples"] > 0),
+        }
+
+    def prune(self) -> int:
+        """
+        Delete the trips last written more than `retention` seconds ago (no-op
+        without a retention)
+
+        :return: Number of trips deleted
+        """
+        if not self.retention:
+            return 0
+        cutoff = time.time() - self.retention
+        pruned = 0
+        for trip_id in os.listdir(self.directory):
+            trip_dir = os.path.join(self.directory, trip_id)
+            if not valid_trip_id(trip_id) or not os.path.isdir(trip_dir) or self._last_write(trip_dir) >= cutoff:
+                continue
+            with self._locked(trip_dir):
+                # A write may have come in while waiting for the lock
+                if self._last_write(trip_dir) >= cutoff:
+                    continue
+                shutil.rmtree(trip_dir)
+            pruned += 1
+        self.trips_pruned += pruned
+        return pruned
+
+    @staticmethod
+    def _last_write(trip_dir: str) -> float:
+        try:
+            return os.path.getmtime(os.path.join(trip_dir, "stats.json"))
+        except FileNotFoundError:
+            return os.path.getmtime(trip_dir)
+
+    def read_series(self, trip_id: str) -> Dict[str, np.ndarray]:
+        """Load a trip's raw column files"""
+        trip_dir = os.path.join(self.directory, trip_id)
+        with self._locked(trip_dir):
+            return {name: np.fromfile(_column_path(trip_dir, name), dtype=dtype)
+                    for name, dtype in COLUMNS.items()}
+
+    def stats(self):
+        return {"directory": self.directory, "flushes": self.flushes, "samples_written": self.samples_written,
+                "pending_flushes": len(self._pending), "retention_seconds": self.retention,
+                "trips_pruned": self.trips_pruned}
@@ -0,0 +1,129 @@
+import random
+
+import pytest
+
+from drowsiness_state import (COOLDOWN_TIME, EYE_AR_THRESH, EYE_CLOSED_SECONDS, MAX_SAMPLE_GAP, PERCLOS_WINDOW,
+                              DrowsinessState, EyeClosureWindow)
+
+OPEN_EAR = EYE_AR_THRESH + 0.1
+CLOSED_EAR = EYE_AR_THRESH - 0.1
+
+
+# Eyes closed for the first 400 ms of every second. Counted in whole
+# milliseconds, so float rounding cannot move samples across the boundary;
+# 400 ms is a whole number of frames at every rate tested.
+def closed_at(timestamp):
+    return round(timestamp * 1000) % 1000 < 400
+
+
+def fill(window, timestamps):
+    for t in timestamps:
+        window.add(t, closed_at(t))
+    return window.perclos(timestamps[-1])
+
+
+@pytest.mark.parametrize("fps", [5, 10, 15, 30])
+def test_perclos_independent_of_frame_rate(fps):
+    timestamps = [i / fps for i in range(int(PERCLOS_WINDOW * fps))]
+    perclos, coverage = fill(EyeClosureWindow(), timestamps)
+    assert perclos == pytest.approx(0.4, abs=0.005)
+    assert coverage == pytest.approx(1.0, abs=0.005)
+
+
+def test_perclos_with_irregular_frame_intervals():
+    rng = random.Random(0)
+    timestamps, t = [], 0.0
+    while t < PERCLOS_WINDOW:
+        timestamps.append(t)
+        t += rng.uniform(1 / 60, 1 / 8)
+    perclos, _ = fill(EyeClosureWindow(), timestamps)
+    assert perclos == pytest.approx(0.4, abs=0.02)
+
+
+def test_perclos_only_counts_the_window():
+    window = EyeClosureWindow(window=10.0)
+    # 20 s closed, then 10 s open: the closed part has left the window
+    for i in range(300):
+        window.add(i / 10, i < 200)
+    perclos, coverage = window.perclos(29.9)
+    assert perclos == pytest.approx(0.0, abs=0.02)
+    assert coverage == pytest.approx(1.0, abs=0.02)
+
+
+def test_ring_buffer_wraps_around():
+    window = EyeClosureWindow(window=5.0, capacity=64)
+    timestamps = [i / 30 for i in range(900)]
+    perclos, coverage = fill(window, timestamps)
+    # 64 samples cover about 2 s of the 5 s window
+    assert coverage == pytest.approx(63 / 30 / 5.0, abs=0.01)
+    assert perclos == pytest.approx(0.4, abs=0.1)
+
+
+def test_gap_longer_than_max_sample_gap_resets_closure():
+    window = EyeClosureWindow()
+    for i in range(16):
+        window.add(i / 30, True)
+    assert window.closed_duration(15 / 30) == pytest.approx(0.5)
+
+    resumed = 15 / 30 + MAX_SAMPLE_GAP + 0.5
+    window.add(resumed, True)
+    assert window.closed_duration(resumed) == 0.0
+    window.add(resumed + 0.2, True)
+    assert window.closed_duration(resumed + 0.2) == pytest.approx(0.2)
+
+
+def test_gap_within_max_sample_gap_keeps_closure():
+    window = EyeClosureWindow()
+    window.add(0.0, True)
+    window.add(MAX_SAMPLE_GAP * 0.9, True)
+    assert window.closed_duration(MAX_SAMPLE_GAP * 0.9) == pytest.approx(MAX_SAMPLE_GAP * 0.9)
+
+
+def test_sample_before_a_gap_counts_at_most_max_sample_gap():
+    window = EyeClosureWindow(window=20.0)
+    for i in range(100):
+        window.add(i / 10, False)
+    # One closed sample, then nothing for 10 s
+    window.add(10.0, True)
+    window.add(20.0, False)
+    perclos, coverage = window.perclos(20.0)
+    assert perclos * coverage * 20.0 == pytest.approx(MAX_SAMPLE_GAP)
+
+
+def feed(state, start, seconds, ear, fps=10):
+    return [state.update(ear, start + i / fps) for i in range(int(seconds * fps))]
+
+
+def test_drowsy_after_eyes_closed_for_eye_closed_seconds():
+    state = DrowsinessState()
+    results = feed(state, 0.0, EYE_CLOSED_SECONDS + 0.5, CLOSED_EAR)
+    drowsy = [r["isDrowsy"] for r in results]
+    first = drowsy.index(True)
+    assert results[first]["eyesClosedSeconds"] >= EYE_CLOSED_SECONDS
+    assert results[first - 1]["eyesClosedSeconds"] < EYE_CLOSED_SECONDS
+    assert all(drowsy[first:])
+
+
+def test_alert_sent_once_per_episode_and_respects_cooldown():
+    state = DrowsinessState()
+    first = feed(state, 0.0, 3.0, CLOSED_EAR)
+    assert sum(r["alertSent"] for r in first) == 1
+
+    # Eyes open again, then a second closure well within the cooldown
+    assert not any(r["isDrowsy"] for r in feed(state, 3.0, 1.0, OPEN_EAR))
+    second = feed(state, 4.0, 3.0, CLOSED_EAR)
+    assert any(r["isDrowsy"] for r in second)
+    assert not any(r["alertSent"] for r in second)
+
+    # After the cooldown a new closure alerts again
+    later = COOLDOWN_TIME + 10
+    feed(state, later, 1.0, OPEN_EAR)
+    third = feed(state, later + 1.0, 3.0, CLOSED_EAR)
+    assert sum(r["alertSent"] for r in third) == 1
+
+
+def test_reset_clears_cooldown():
+    state = DrowsinessState()
+    feed(state, 0.0, 3.0, CLOSED_EAR)
+    state.reset()
+    assert sum(r["alertSent"] for r in feed(state, 5.0, 3.0, CLOSED_EAR)) == 1
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("mediapipe")
+
+from benchmark import load_frames, run_keyframes  # noqa: E402
+
+# A recorded cabin clip with a face in view; not shipped with the repo
+CLIP = os.getenv("KEYFRAME_TEST_CLIP", os.path.join(os.path.dirname(__file__), "fixtures", "keyframe_clip.mp4"))
+CLIP_FRAMES = 300
+
+# Keyframe tracking must stay this close to full inference on every frame
+MAX_EAR_MAE = 0.02
+MAX_EAR_P95_ERROR = 0.05
+MIN_EYE_CLOSED_AGREEMENT = 0.95
+MAX_DETECTION_MISMATCH_RATE = 0.02
+
+
+@pytest.fixture(scope="module")
+def frames():
+    if not os.path.exists(CLIP):
+        pytest.skip(f"Fixture clip {CLIP} not found; set KEYFRAME_TEST_CLIP")
+    return load_frames(CLIP, CLIP_FRAMES)
+
+
+@pytest.mark.parametrize("interval", [2, 3, 5])
+def test_keyframe_tracking_matches_full_inference(frames, interval):
+    accuracy = run_keyframes(frames, 1, interval)["accuracy"]
+    assert accuracy["frames_compared"] >= len(frames) // 2, "too few frames with a face to compare"
+    assert accuracy["detection_mismatches"] <= MAX_DETECTION_MISMATCH_RATE * len(frames)
+    assert accuracy["ear_mae"] <= MAX_EAR_MAE
+    assert accuracy["ear_p95_error"] <= MAX_EAR_P95_ERROR
+    assert accuracy["eye_closed_agreement"] >= MIN_EYE_CLOSED_AGREEMENT
@@ -0,0 +1,37 @@
+import struct
+
+import numpy as np
+import pytest
+
+from protocol import (PAYLOAD_LANDMARKS, RESULT_HEADER_V1, RESULT_MAGIC_V1, pack_landmarks, pack_result,
+                      unpack_result)
+
+RESULTS = {"isDrowsy": True, "alertSent": False, "hasDetectedFace": True, "earValue": 0.18,
+           "drowsinessPercentage": 75.0, "eyesClosedSeconds": 1.25, "perclos": 0.4}
+
+
+def test_result_round_trip():
+    landmarks = [[0.25, 0.5]] * 12
+    message = pack_result(7, RESULTS, pack_landmarks(landmarks), dropped_frames=3, payload_type=PAYLOAD_LANDMARKS)
+    result = unpack_result(message)
+    assert result["frame_id"] == 7
+    assert result["dropped_frames"] == 3
+    assert (result["is_drowsy"], result["alert_sent"], result["face_detected"]) == (True, False, True)
+    assert result["ear"] == pytest.approx(0.18)
+    assert result["drowsiness_percentage"] == pytest.approx(75.0)
+    assert result["eyes_closed_seconds"] == pytest.approx(1.25)
+    assert result["perclos"] == pytest.approx(0.4)
+    assert np.array_equal(result["payload"], np.full((12, 2), [0.25, 0.5], dtype=np.float32))
+
+
+def test_version_1_result_is_still_read():
+    message = RESULT_HEADER_V1.pack(RESULT_MAGIC_V1, 0, 1, 0, 9, 0.3, 10.0) + b"jpeg"
+    result = unpack_result(message)
+    assert result["frame_id"] == 9
+    assert result["eyes_closed_seconds"] is None and result["perclos"] is None
+    assert bytes(result["payload"]) == b"jpeg"
+
+
+def test_bad_magic():
+    with pytest.raises(ValueError):
+        unpack_result(b"XXXX" + bytes(struct.calcsize("<BBHIffff")))
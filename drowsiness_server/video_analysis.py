@@ -0,0 +1,237 @@
+"""
+Offline drowsiness analysis of recorded trip videos.
+
+The video is split into chunks that are analyzed in parallel on a process
+pool. Every chunk starts `overlap` seconds early so FaceMesh tracking (and
+the face crop / keyframe state) has re-synced by the first frame the chunk
+reports. Workers return the EAR of every frame; the drowsiness state
+(closure duration, PERCLOS, alert cooldown) is then advanced in frame order
+with the same DrowsinessState the live sessions use, so chunk boundaries do
+not cut the PERCLOS window.
+
+Output is a stream of JSON messages, one per line:
+
+    {"type": "video", ...}    frame count, fps and chunk plan
+    {"type": "series", ...}   per-frame columns for one chunk
+    {"type": "event", ...}    drowsy_start, drowsy_end and alert events
+    {"type": "summary", ...}  totals, once the whole video is done
+
+    python video_analysis.py trip.mp4 --workers 4 > trip.ndjson
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# cv2 and the detector are imported where frames are read, so the server
+# process can import VideoAnalyzer without loading OpenCV
+from drowsiness_state import DrowsinessState
+
+logger = logging.getLogger(__name__)
+
+# Worker-side detector, reused across the chunks a worker analyzes
+_video_detector = None
+
+
+def probe_video(path: str):
+    """:return: (frame count, frames per second) of a video file"""
+    import cv2
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video {path}")
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    capture.release()
+    return frame_count, fps
+
+
+def plan_chunks(frame_count: int, fps: float, chunk_seconds: float, overlap_seconds: float):
+    """:return: List of (warm-up start, first reported, end) frame indexes"""
+    chunk_frames = max(1, int(chunk_seconds * fps))
+    overlap_frames = int(overlap_seconds * fps)
+    return [(max(0, start - overlap_frames), start, min(frame_count, start + chunk_frames))
+            for start in range(0, max(frame_count, 1), chunk_frames)]
+
+
+def _analyze_chunk(path: str, warmup_start: int, start: int, end: int, keyframe_interval: int, last: bool):
+    """
+    Measure the EAR of frames [start, end) of a video, after running the
+    frames from warmup_start on to re-sync tracking. The last chunk reads to
+    the end of the file, since container frame counts are not always exact.
+
+    :return: (ear float32 array, face detected bool array), one entry per
+             frame; ear is 0 where no face was found
+    """
+    import cv2
+
+    from detector import DrowsinessDetector, eye_aspect_ratios
+
+    global _video_detector
+    if _video_detector is None or _video_detector.keyframe_interval != keyframe_interval:
+        _video_detector = DrowsinessDetector(keyframe_interval=keyframe_interval)
+    detector = _video_detector
+    detector.reset()
+
+    capture = cv2.VideoCapture(path)
+    if warmup_start:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, warmup_start)
+
+    ears, faces = [], []
+    index = warmup_start
+    try:
+        while last or index < end:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            eye_points = detector.detect_eyes(frame)
+            if index >= start:
+                faces.append(eye_points is not None)
+                ears.append(float(eye_aspect_ratios(eye_points).mean()) if eye_points is not None else 0.0)
+            index += 1
+    finally:
+        capture.release()
+
+    return np.asarray(ears, dtype=np.float32), np.asarray(faces, dtype=bool)
+
+
+class VideoAnalyzer:
+    """Analyzes uploaded or local video files on a dedicated process pool"""
+
+    def __init__(self, workers: int = None, chunk_seconds: float = 10.0, overlap_seconds: float = 1.0,
+                 keyframe_interval: int = 1):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.chunk_seconds = chunk_seconds
+        self.overlap_seconds = overlap_seconds
+        self.keyframe_interval = keyframe_interval
+        self._pool = None
+
+    @property
+    def pool(self):
+        # Created on first use, so servers that never analyze a video do not
+        # start the worker processes
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def probe(self, path: str):
+        """probe_video on the pool, so the calling process never loads OpenCV"""
+        return await asyncio.get_running_loop().run_in_executor(self.pool, probe_video, path)
+
+    async def analyze(self, path: str):
+        """Analyze a video file, yielding output messages as chunks complete in order"""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        frame_count, fps = await self.probe(path)
+        chunks = plan_chunks(frame_count, fps, self.chunk_seconds, self.overlap_seconds)
+
+        yield {"type": "video", "frames": frame_count, "fps": fps, "chunks": len(chunks),
+               "chunk_seconds": self.chunk_seconds, "overlap_seconds": self.overlap_seconds}
+
+        # All chunks are queued at once; results are consumed in order so the
+        # drowsiness state sees the frames in sequence
+        futures = [
+            loop.run_in_executor(self.pool, _analyze_chunk, path, warmup_start, start, end,
+                                 self.keyframe_interval, i == len(chunks) - 1)
+            for i, (warmup_start, start, end) in enumerate(chunks)
+        ]
+
+        state = DrowsinessState()
+        drowsy_since = None
+        processed = faces_found = alerts = 0
+        drowsy_frames = 0
+        try:
+            for (_, start, _), future in zip(chunks, futures):
+                ears, faces = await future
+                series = {"t": [], "ear": [], "face": [], "drowsy": [], "perclos": []}
+                events = []
+
+                for offset, (ear, face) in enumerate(zip(ears.tolist(), faces.tolist())):
+                    frame = start + offset
+                    timestamp = frame / fps
+                    results = state.update(ear, timestamp) if face else None
+                    drowsy = bool(results and results["isDrowsy"])
+
+                    series["t"].append(round(timestamp, 3))
+                    series["ear"].append(round(ear, 4))
+                    series["face"].append(int(face))
+                    series["drowsy"].append(int(drowsy))
+                    series["perclos"].append(round(results["perclos"], 4) if results else None)
+
+                    if drowsy and drowsy_since is None:
+                        drowsy_since = timestamp
+                        events.append({"type": "event", "event": "drowsy_start", "frame": frame, "t": timestamp})
+                    elif face and not drowsy and drowsy_since is not None:
+                        events.append({"type": "event", "event": "drowsy_end", "frame": frame, "t": timestamp,
+                                       "duration": timestamp - drowsy_since})
+                        drowsy_since = None
+                    if results and results["alertSent"]:
+                        alerts += 1
+                        events.append({"type": "event", "event": "alert", "frame": frame, "t": timestamp,
+                                       "eyes_closed_seconds": results["eyesClosedSeconds"],
+                                       "perclos": results["perclos"]})
+
+                    processed += 1
+                    faces_found += face
+                    drowsy_frames += drowsy
+
+                yield {"type": "series", "start_frame": start, "frames": len(ears), **series}
+                for event in events:
+                    yield event
+        finally:
+            for future in futures:
+                future.cancel()
+
+        elapsed = time.perf_counter() - started
+        yield {
+            "type": "summary",
+            "frames_processed": processed,
+            "face_detection_rate": faces_found / processed if processed else 0,
+            "drowsy_seconds": drowsy_frames / fps,
+            "alerts": alerts,
+            "elapsed_s": elapsed,
+            "fps": processed / elapsed if elapsed else 0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze a trip recording for drowsiness")
+    parser.add_argument("video")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: CPU count)")
+    parser.add_argument("--chunk-seconds", type=float, default=10.0)
+    parser.add_argument("--overlap-seconds", type=float, default=1.0)
+    parser.add_argument("--keyframe-interval", type=int, default=1)
+    parser.add_argument("--output", help="Write NDJSON here instead of stdout")
+    args = parser.parse_args()
+
+    analyzer = VideoAnalyzer(args.workers, args.chunk_seconds, args.overlap_seconds, args.keyframe_interval)
+    out = open(args.output, "w") if args.output else sys.stdout
+
+    async def run():
+        async for message in analyzer.analyze(args.video):
+            out.write(json.dumps(message) + "\n")
+            out.flush()
+
+    try:
+        asyncio.run(run())
+    finally:
+        analyzer.shutdown()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()